@@ -0,0 +1,37 @@
+import docopt
+
+import teuthology.bench.locking
+
+doc = """
+usage: teuthology-benchmark-locking -h
+       teuthology-benchmark-locking [options]
+
+Measure lock server throughput and latency under contention. Simulated jobs
+repeatedly list machines, lock a few of them, hold them briefly and unlock
+them, all at once. Unless --lock-server is given, a temporary lock server is
+started with a SQLite database holding --machines machines of each type.
+Results are printed as JSON.
+
+optional arguments:
+  -h, --help                  Show this help message and exit
+  --clients <n>               Number of simulated jobs [default: 100]
+  --duration <seconds>        How long to run for [default: 30]
+  --machines <n>              Number of machines of each type to create
+                              [default: 50]
+  --machine-types <types>     Comma-separated machine types to lock
+                              [default: plana]
+  --max-machines <n>          The most machines a job locks at once
+                              [default: 3]
+  --hold <seconds>            How long jobs keep their machines
+                              [default: 0.1]
+  --wait <seconds>            How long lock requests may wait for machines
+                              to be free [default: 0]
+  --lock-server <url>         Use this lock server instead of starting one;
+                              it will lock and unlock its machines
+  -o <file>, --output <file>  Write results to this file instead of stdout
+"""
+
+
+def main():
+    args = docopt.docopt(doc)
+    teuthology.bench.locking.main(args)
@@ -0,0 +1,45 @@
+import docopt
+
+import teuthology.bench.scheduling
+
+doc = """
+usage: teuthology-benchmark-suite -h
+       teuthology-benchmark-suite [options]
+
+Measure scheduling throughput. Generate a synthetic suite (or use an existing
+one), then time building the job matrix, filtering, parsing the yaml fragments
+and submitting the jobs to an in-memory queue (or, with --sqlite, a temporary
+SQLite-backed one). Results are printed as JSON.
+
+With the default of 10 fragments per facet, 3, 5 and 6 facets give suites of
+1k, 100k and 1M combinations, respectively.
+
+optional arguments:
+  -h, --help                  Show this help message and exit
+  --facets <n>                Number of facets per '%' directory
+                              [default: 3]
+  --fragments <n>             Number of yaml fragments per facet
+                              [default: 10]
+  --depth <n>                 Levels of nested '%' directories
+                              [default: 1]
+  --concat <n>                Number of fragments in an extra '+' facet
+                              [default: 0]
+  --fragment-size <bytes>     Approximate size of each fragment
+                              [default: 256]
+  --suite-dir <dir>           Benchmark an existing suite directory instead
+                              of generating one
+  --keep                      Don't remove the generated suite
+  -l <jobs>, --limit <jobs>   Process at most this many jobs after building
+                              the matrix [default: 0]
+  --filter <string>           Only process jobs containing this string
+  --filter-out <string>       Skip jobs containing this string
+  --no-parse                  Don't time parsing the yaml fragments
+  --no-submit                 Don't time submitting jobs
+  --sqlite                    Submit jobs to a temporary SQLite-backed queue
+  -o <file>, --output <file>  Write results to this file instead of stdout
+"""
+
+
+def main():
+    args = docopt.docopt(doc)
+    teuthology.bench.scheduling.main(args)
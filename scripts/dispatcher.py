@@ -0,0 +1,45 @@
+import argparse
+
+import teuthology.dispatcher
+
+
+def main():
+    teuthology.dispatcher.main(parse_args())
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="""
+Move jobs from a tube's pending tube into the tube itself, sharing machines
+fairly between owners and runs. Used when fair_share is set in
+~/.teuthology.yaml; see fair_share_weights and owner_max_running there.
+""")
+    parser.add_argument(
+        '-v', '--verbose',
+        action='store_true', default=None,
+        help='be more verbose',
+    )
+    parser.add_argument(
+        '-l', '--log-dir',
+        help='path in which to store logs and per-owner queue stats',
+        required=True,
+    )
+    parser.add_argument(
+        '-t', '--tube',
+        help='which tube workers read jobs from',
+        required=True,
+    )
+    parser.add_argument(
+        '-b', '--backlog',
+        type=int,
+        default=2,
+        help='how many ready jobs to keep in the tube. Lower is fairer; ' +
+        'higher keeps workers from waiting on the dispatcher',
+    )
+    parser.add_argument(
+        '-i', '--interval',
+        type=int,
+        default=5,
+        help='how many seconds to wait between checks of the tube',
+    )
+
+    return parser.parse_args()
@@ -7,6 +7,7 @@ doc = """
 usage: teuthology-queue -h
        teuthology-queue [-d|-f] -m MACHINE_TYPE
        teuthology-queue [-r] -m MACHINE_TYPE
+       teuthology-queue -e -m MACHINE_TYPE
        teuthology-queue -m MACHINE_TYPE -D PATTERN
 
 List Jobs in queue.
@@ -22,6 +23,10 @@ optional arguments:
   -D, --delete PATTERN  Delete Jobs with PATTERN in their name
   -d, --description     Show job descriptions
   -r, --runs            Only show run names
+  -e, --eta             Show each run's job count and machine-hours, and
+                        estimate when it will start and finish, based on how
+                        long the same jobs took before and how many machines
+                        are free
   -f, --full            Print the entire job config. Use with caution.
 """.format(archive_base=teuthology.config.config.archive_base)
 
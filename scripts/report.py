@@ -8,6 +8,7 @@ usage:
     teuthology-report [-v] [-R] [-n] [-s SERVER] [-a ARCHIVE] [-D] -r RUN ...
     teuthology-report [-v] [-s SERVER] [-a ARCHIVE] [-D] -r RUN -j JOB ...
     teuthology-report [-v] [-R] [-n] [-s SERVER] [-a ARCHIVE] --all-runs
+    teuthology-report [-v] [-a ARCHIVE] --phases (--all-runs | -r RUN ...)
 
 Submit test results to a web service
 
@@ -33,6 +34,9 @@ optional arguments:
                         behavior.
   -D, --dead            Mark all given jobs (or entire runs) with status
                         'dead'. Implies --refresh.
+  --phases              Instead of submitting anything, print how long the
+                        given runs' jobs spent in each phase between being
+                        queued and running their tasks
   -v, --verbose         be more verbose
 """.format(archive_base=teuthology.config.config.archive_base)
 
@@ -67,6 +67,11 @@ Scheduler arguments:
                               [default: 32400]
   --filter <string>           Only run jobs containing the string specified.
   --filter-out <string>       Do not run jobs containing the string specified.
+  --order <order>             Queue the jobs in this order instead of the
+                              suite's: 'longest-first' to start the jobs that
+                              took longest in past runs first, or 'fail-first'
+                              to start the jobs that failed most often first.
+                              Uses the results in the archive.
 
 """
 
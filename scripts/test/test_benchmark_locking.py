@@ -0,0 +1,5 @@
+from script import Script
+
+
+class TestBenchmarkLocking(Script):
+    script_name = 'teuthology-benchmark-locking'
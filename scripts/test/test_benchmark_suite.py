@@ -0,0 +1,5 @@
+from script import Script
+
+
+class TestBenchmarkSuite(Script):
+    script_name = 'teuthology-benchmark-suite'
@@ -49,6 +49,9 @@ setup(
             'teuthology-report = scripts.report:main',
             'teuthology-kill = scripts.kill:main',
             'teuthology-queue = scripts.queue:main',
+            'teuthology-benchmark-suite = scripts.benchmark_suite:main',
+            'teuthology-benchmark-locking = scripts.benchmark_locking:main',
+            'teuthology-dispatcher = scripts.dispatcher:main',
             ],
         },
 
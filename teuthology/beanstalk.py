@@ -1,26 +1,22 @@
-import beanstalkc
 import yaml
 import logging
+import os
 import pprint
 import sys
+import time
 from collections import OrderedDict
+from datetime import datetime
 
 from .config import config
+from . import durations
+from . import job_queue
+from . import lock
+from . import misc
 from . import report
 
 log = logging.getLogger(__name__)
 
 
-def connect():
-    host = config.queue_host
-    port = config.queue_port
-    if host is None or port is None:
-        raise RuntimeError(
-            'Beanstalk queue information not found in {conf_path}'.format(
-                conf_path=config.teuthology_yaml))
-    return beanstalkc.Connection(host=host, port=port)
-
-
 def watch_tube(connection, tube_name):
     """
     Watch a given tube, potentially correcting to 'multi' if necessary. Returns
@@ -34,9 +30,12 @@ def watch_tube(connection, tube_name):
     return tube_name
 
 
-def walk_jobs(connection, tube_name, processor, pattern=None):
+def walk_jobs(connection, tube_name, processor, pattern=None,
+              queue_index=None):
     """
     def callback(jobs_dict)
+
+    :param queue_index: Optional. A QueueIndex to add each job to
     """
     log.info("Checking Beanstalk Queue...")
     job_count = connection.stats_tube(tube_name)['current-jobs-ready']
@@ -54,6 +53,8 @@ def walk_jobs(connection, tube_name, processor, pattern=None):
         job_config = yaml.safe_load(job.body)
         job_name = job_config['name']
         job_id = job.stats()['id']
+        if queue_index:
+            queue_index.add(job_id, tube_name, job_config)
         if pattern is not None and pattern not in job_name:
             continue
         processor.add_job(job_id, job_config, job)
@@ -61,6 +62,53 @@ def walk_jobs(connection, tube_name, processor, pattern=None):
     processor.complete()
 
 
+def walk_index(connection, tube_name, processor, queue_index, pattern=None,
+               full=False):
+    """
+    Like walk_jobs(), but without reserving anything: the jobs are found in
+    queue_index, and beanstalkd is only asked whether each one is still
+    queued, i.e. ready or delayed; see job_queue.find_indexed_jobs().
+
+    If the tube has ready jobs the index doesn't know about, walk_jobs() is
+    used instead, and adds them to the index so that it isn't needed next
+    time.
+
+    :param queue_index: A QueueIndex, or None to just use walk_jobs()
+    :param full:        Whether to fetch each job's complete config, rather
+                        than just what the index holds
+    """
+    log.info("Checking Beanstalk Queue...")
+    job_infos, missing = job_queue.find_indexed_jobs(connection, tube_name,
+                                                     queue_index)
+    if missing['ready']:
+        if queue_index:
+            log.warning("%d ready jobs in %s are missing from the queue "
+                        "index; reserving each job to list them",
+                        missing['ready'], tube_name)
+        walk_jobs(connection, tube_name, processor, pattern, queue_index)
+        return
+    if missing['delayed']:
+        log.warning("%d deferred jobs in %s are missing from the queue "
+                    "index and won't be listed", missing['delayed'],
+                    tube_name)
+    gone = list()
+    for job_info in job_infos:
+        if pattern is not None and pattern not in job_info['name']:
+            continue
+        job_id = job_info['job_id']
+        job_config = job_info
+        if full:
+            job = connection.peek(job_id)
+            if job is None:
+                gone.append(job_id)
+                continue
+            job_config = yaml.safe_load(job.body)
+        processor.add_job(job_id, job_config)
+    if gone:
+        queue_index.remove(gone)
+    processor.complete()
+
+
 def print_progress(index, total, message=None):
     msg = "{m} ".format(m=message) if message else ''
     sys.stderr.write("{msg}{i}/{total}\r".format(
@@ -155,24 +203,109 @@ class JobDeleter(JobProcessor):
         report.try_delete_jobs(job_name, job_id)
 
 
+class ETAPrinter(JobProcessor):
+    """
+    Collect the queued jobs, then print how many each run has, how many
+    machine-hours they will take and when the run should start and finish;
+    see durations.forecast().
+    """
+    def __init__(self, machine_type, store):
+        """
+        :param machine_type: The machine type(s) the queue is for
+        :param store:        A DurationStore
+        """
+        super(ETAPrinter, self).__init__()
+        self.machine_type = machine_type
+        self.store = store
+
+    def get_capacity(self):
+        """
+        :returns: A tuple of how many machines of self.machine_type are up,
+                  and how many of those are locked
+        """
+        machine_types = lock.get_machine_types(refresh=True) or dict()
+        up = locked = 0
+        for machine_type in misc.get_multi_machine_types(self.machine_type):
+            type_info = machine_types.get(machine_type) or dict()
+            up += type_info.get('up', 0)
+            locked += min(type_info.get('locked', 0), type_info.get('up', 0))
+        return up, locked
+
+    def report(self, now=None):
+        if now is None:
+            now = time.time()
+        up, locked = self.get_capacity()
+        jobs = [dict(name=job['job_config']['name'],
+                     description=job['job_config'].get('description'))
+                for job in self.jobs.values()]
+        total, runs = durations.forecast(jobs, self.store, up, locked, now)
+        print '{machine_type}: {jobs} jobs, {hours:.1f} machine-hours; ' \
+            '{free} of {up} machines free'.format(
+                machine_type=self.machine_type, jobs=total['jobs'],
+                hours=total['machine_hours'], free=up - locked, up=up)
+        if not runs:
+            return
+        print '{name:<60} {jobs:>5} {hours:>8} {start:>16} ' \
+            '{finish:>16}'.format(
+            name='Run', jobs='Jobs', hours='M-hours', start='Start',
+            finish='Finish')
+        for name, run in runs.items():
+            print '{name:<60} {jobs:>5} {hours:>8.1f} {start:>16} ' \
+                '{finish:>16}'.format(
+                    name=name, jobs=run['jobs'], hours=run['machine_hours'],
+                    start=self.format_time(run['start'], now),
+                    finish=self.format_time(run['finish'], now))
+
+    @staticmethod
+    def format_time(timestamp, now):
+        if timestamp is None:
+            return 'unknown'
+        if timestamp <= now:
+            return 'now'
+        return datetime.fromtimestamp(timestamp).strftime('%Y-%m-%d %H:%M')
+
+
 def main(args):
     machine_type = args['--machine_type']
     delete = args['--delete']
     runs = args['--runs']
     show_desc = args['--description']
     full = args['--full']
+    eta = args['--eta']
+    connection = job_queue.connect()
+    queue_index = connection.index
     try:
-        connection = connect()
-        watch_tube(connection, machine_type)
         if delete:
-            walk_jobs(connection, machine_type,
-                      JobDeleter(delete))
+            processor = JobDeleter(delete)
+        elif eta:
+            store = durations.get_duration_store()
+            if store is None:
+                raise RuntimeError("Could not open the job duration database")
+            if os.path.isdir(config.archive_base):
+                store.update_from_archive(config.archive_base,
+                                          max_age=config.max_job_time)
+            processor = ETAPrinter(machine_type, store)
         elif runs:
-            walk_jobs(connection, machine_type,
-                      RunPrinter())
+            processor = RunPrinter()
         else:
-            walk_jobs(connection, machine_type,
-                      JobPrinter(show_desc=show_desc, full=full))
+            processor = JobPrinter(show_desc=show_desc, full=full)
+        # With fair_share, jobs may also be waiting in a pending tube
+        watched = None
+        for tube in job_queue.get_tubes(machine_type):
+            real_tube = watch_tube(connection, tube)
+            # beanstalkd won't let us ignore the only tube we're watching
+            if watched:
+                connection.ignore(watched)
+            watched = real_tube
+            if delete:
+                job_queue.delete_jobs(connection, tube,
+                                      lambda name: delete in name,
+                                      queue_index, processor)
+            else:
+                walk_index(connection, tube, processor, queue_index,
+                           full=full)
+        if eta:
+            processor.report()
     except KeyboardInterrupt:
         log.info("Interrupted.")
     finally:
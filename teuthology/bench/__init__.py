@@ -0,0 +1,41 @@
+import contextlib
+import os
+import sys
+import time
+
+
+class Timer(object):
+    """
+    Accumulate named wall-clock timings::
+
+        timer = Timer()
+        with timer.time('build_matrix'):
+            build_matrix(path)
+        timer.timings  # {'build_matrix': 0.42}
+    """
+    def __init__(self):
+        self.timings = dict()
+
+    @contextlib.contextmanager
+    def time(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.timings[name] = self.timings.get(name, 0) + \
+                time.time() - start
+
+
+@contextlib.contextmanager
+def quiet_stdout():
+    """
+    Send anything printed to stdout to /dev/null, so that it doesn't get mixed
+    up with benchmark results.
+    """
+    saved = sys.stdout
+    with file(os.devnull, 'w') as devnull:
+        sys.stdout = devnull
+        try:
+            yield
+        finally:
+            sys.stdout = saved
@@ -0,0 +1,284 @@
+"""
+Measure how the lock server copes with many clients at once.
+
+Simulated clients behave like teuthology jobs: each repeatedly lists the
+machines of a type, locks a few of them with lock_many(), holds them for a
+while and releases them with unlock_many(). The lock server is either an
+existing one, or a temporary one started from teuthology/locker with a
+SQLite database holding generated machines. Throughput, latency percentiles
+and the numbers of failed and retried requests are reported as JSON.
+"""
+import json
+import logging
+import math
+import os
+import random
+import requests
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import web
+
+from .. import lock
+from .. import lockstatus
+from ..config import config
+from ..locker import schema
+from ..parallel import parallel
+
+log = logging.getLogger(__name__)
+
+operations = ('list', 'lock', 'unlock')
+
+
+def main(args):
+    params = dict(
+        clients=int(args['--clients']),
+        duration=float(args['--duration']),
+        max_machines=int(args['--max-machines']),
+        hold=float(args['--hold']),
+        wait=float(args['--wait']),
+    )
+    machine_types = args['--machine-types'].split(',')
+    server = None
+    if args['--lock-server']:
+        config.lock_server = args['--lock-server']
+    else:
+        server = LockServer(int(args['--machines']), machine_types)
+        server.start()
+        config.lock_server = server.url
+    # lock_many() and friends log every failure; we count them instead
+    for logger_name in (lock.__name__, lockstatus.__name__):
+        logging.getLogger(logger_name).setLevel(logging.CRITICAL)
+    try:
+        results = run_benchmark(machine_types=machine_types, **params)
+    finally:
+        if server:
+            server.stop()
+    params['machine_types'] = machine_types
+    params['machines'] = int(args['--machines']) if server else None
+    results['params'] = params
+    output = json.dumps(results, sort_keys=True, indent=4)
+    if args['--output']:
+        with file(args['--output'], 'w') as out_file:
+            out_file.write(output + '\n')
+    else:
+        print output
+
+
+class LockServer(object):
+    """
+    A lock server running in a subprocess, with a temporary SQLite database.
+    """
+    def __init__(self, machines, machine_types):
+        """
+        :param machines:      How many machines of each type to create
+        :param machine_types: A list of machine types
+        """
+        self.machines = machines
+        self.machine_types = machine_types
+        self.proc = None
+        self.db_dir = None
+
+    def start(self, timeout=30):
+        self.db_dir = tempfile.mkdtemp(prefix='teuthology-bench-locker-')
+        db_path = os.path.join(self.db_dir, 'locker.db')
+        populate(db_path, self.machines, self.machine_types)
+        port = get_free_port()
+        self.url = 'http://127.0.0.1:{port}/lock'.format(port=port)
+        locker_path = os.path.join(os.path.dirname(schema.__file__),
+                                   'locker.py')
+        env = dict(os.environ, TEUTHOLOGY_LOCKER_SQLITE=db_path,
+                   TEUTHOLOGY_LOCKER_KEYSCAN='0')
+        with file(os.devnull, 'w') as devnull:
+            self.proc = subprocess.Popen(
+                [sys.executable, locker_path, '127.0.0.1:%d' % port],
+                env=env, stdout=devnull, stderr=devnull)
+        deadline = time.time() + timeout
+        while True:
+            try:
+                socket.create_connection(('127.0.0.1', port), 1).close()
+                break
+            except socket.error:
+                if self.proc.poll() is not None or time.time() > deadline:
+                    self.stop()
+                    raise RuntimeError("The lock server failed to start")
+                time.sleep(0.1)
+
+    def stop(self):
+        if self.proc and self.proc.poll() is None:
+            self.proc.terminate()
+            self.proc.wait()
+        if self.db_dir:
+            shutil.rmtree(self.db_dir, ignore_errors=True)
+
+
+def get_free_port():
+    sock = socket.socket()
+    try:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+    finally:
+        sock.close()
+
+
+def populate(db_path, machines, machine_types):
+    """
+    Create a SQLite lock server database with some free machines in it.
+
+    :param db_path:       Where to create the database
+    :param machines:      How many machines of each type to create
+    :param machine_types: A list of machine types
+    """
+    db = web.database(dbn='sqlite', db=db_path)
+    # Don't print every INSERT
+    db.printing = False
+    schema.create_sqlite(db)
+    with db.transaction():
+        for machine_type in machine_types:
+            db.multiple_insert('machine', [
+                dict(name='ubuntu@{type}{i:03d}'.format(type=machine_type,
+                                                        i=i),
+                     type=machine_type, arch='x86_64', up=True, locked=False,
+                     sshpubkey='ssh-rsa {i}'.format(i=i))
+                for i in range(machines)])
+
+
+def percentile(values, fraction):
+    """
+    :param values:   A sorted list of numbers
+    :param fraction: e.g. 0.99 for the 99th percentile
+    :returns:        The smallest value at least fraction of values are no
+                     greater than, or None if there are no values
+    """
+    if not values:
+        return None
+    index = max(0, int(math.ceil(fraction * len(values))) - 1)
+    return values[min(index, len(values) - 1)]
+
+
+class Client(object):
+    """
+    One simulated teuthology job, locking and unlocking machines until the
+    benchmark ends.
+    """
+    def __init__(self, index, machine_types, max_machines, hold, wait,
+                 deadline):
+        self.user = 'bench{i}@bench'.format(i=index)
+        self.machine_types = machine_types
+        self.max_machines = max_machines
+        self.hold = hold
+        self.wait = wait
+        self.deadline = deadline
+        self.random = random.Random(index)
+        self.latencies = dict([(op, list()) for op in operations])
+        self.errors = dict([(op, 0) for op in operations])
+        # Lock attempts that failed and had to be made again
+        self.lock_retries = 0
+
+    def timed(self, op, func, *args, **kwargs):
+        """
+        Call func, recording how long it took.
+
+        :returns: What func returned, or None if it raised an exception
+        """
+        start = time.time()
+        try:
+            return func(*args, **kwargs)
+        except Exception:
+            log.debug("%s failed", op, exc_info=True)
+            return None
+        finally:
+            self.latencies[op].append(time.time() - start)
+
+    def run(self):
+        num = None
+        while time.time() < self.deadline:
+            if num is None:
+                machine_type = self.random.choice(self.machine_types)
+                num = self.random.randint(1, self.max_machines)
+                # Our place in the lock server's queue; like lock_machines(),
+                # keep it until we get the machines
+                reservation = dict()
+            if self.timed('list', lock.list_locks,
+                          machine_type=machine_type) is None:
+                self.errors['list'] += 1
+            locked = self.timed('lock', lock.lock_many, None, num,
+                                machine_type, self.user, self.user,
+                                wait=self.wait, reservation=reservation)
+            if locked is None:
+                self.errors['lock'] += 1
+            if not locked:
+                # Not enough machines were free; try again
+                self.lock_retries += 1
+                time.sleep(self.random.uniform(0, 0.1))
+                continue
+            num = None
+            time.sleep(self.hold)
+            unlocked = self.timed('unlock', lock.unlock_many, None,
+                                  locked.keys(), self.user)
+            if unlocked is None or len(unlocked) < len(locked):
+                self.errors['unlock'] += 1
+        return self
+
+
+def run_benchmark(clients=100, duration=30, machine_types=('plana',),
+                  max_machines=3, hold=0.1, wait=0):
+    """
+    Run clients against config.lock_server for a while.
+
+    :param clients:       How many clients to run at once
+    :param duration:      For how many seconds
+    :param machine_types: A list of the machine types to lock
+    :param max_machines:  The most machines a client locks at once
+    :param hold:          How long clients keep their machines, in seconds
+    :param wait:          How long lock requests may wait for machines, in
+                          seconds
+    :returns:             A dict with, for each operation, its 'count',
+                          'errors', 'rate' per second and 'latency'
+                          percentiles in seconds; and the numbers of
+                          'lock_retries', lock attempts that failed and were
+                          made again, and of 'request_retries', requests
+                          retried because the lock server couldn't be reached
+    """
+    # Let every client keep its connection open, as separate processes would
+    adapter = requests.adapters.HTTPAdapter(pool_maxsize=clients)
+    lockstatus.get_session().mount('http://', adapter)
+    lockstatus.get_session().mount('https://', adapter)
+    start_retries = lockstatus.retry_count
+    start = time.time()
+    deadline = start + duration
+    finished = list()
+    with parallel() as p:
+        for index in range(clients):
+            client = Client(index, machine_types, max_machines, hold, wait,
+                            deadline)
+            p.spawn(client.run)
+        for client in p:
+            finished.append(client)
+    elapsed = time.time() - start
+
+    results = dict(
+        elapsed=elapsed,
+        lock_retries=sum([client.lock_retries for client in finished]),
+        request_retries=lockstatus.retry_count - start_retries,
+        operations=dict(),
+    )
+    for op in operations:
+        latencies = sorted(sum([client.latencies[op] for client in finished],
+                               []))
+        results['operations'][op] = dict(
+            count=len(latencies),
+            errors=sum([client.errors[op] for client in finished]),
+            rate=len(latencies) / elapsed,
+            latency=dict(
+                mean=sum(latencies) / len(latencies) if latencies else None,
+                p50=percentile(latencies, 0.5),
+                p90=percentile(latencies, 0.9),
+                p99=percentile(latencies, 0.99),
+                max=latencies[-1] if latencies else None,
+            ),
+        )
+    return results
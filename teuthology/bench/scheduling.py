@@ -0,0 +1,250 @@
+"""
+Measure how long it takes to turn a suite into queued jobs.
+
+A synthetic ceph-qa-suite tree is generated with a configurable number of
+facets, fragments per facet, '%' nesting depth and fragment size; then the same
+steps teuthology-suite and teuthology-schedule perform are timed: building the
+matrix, filtering, parsing the yaml fragments and submitting each job to an
+in-memory stand-in for the beanstalk queue, or to a temporary SQLiteQueue.
+"""
+import json
+import logging
+import os
+import random
+import shutil
+import tempfile
+import yaml
+
+from . import Timer, quiet_stdout
+from .. import schedule
+from .. import suite
+from ..config import config
+from ..job_queue import SQLiteQueue
+
+log = logging.getLogger(__name__)
+
+
+def main(args):
+    suite_dir = args['--suite-dir']
+    keep = args['--keep']
+    params = dict(
+        facets=int(args['--facets']),
+        fragments=int(args['--fragments']),
+        depth=int(args['--depth']),
+        concat=int(args['--concat']),
+        fragment_size=int(args['--fragment-size']),
+    )
+    if not suite_dir:
+        suite_dir = tempfile.mkdtemp(prefix='teuthology-bench-')
+        log.info("Generating a suite with %d combinations in %s",
+                 make_suite(suite_dir, **params), suite_dir)
+    else:
+        keep = True
+    queue = None
+    queue_dir = None
+    if args['--sqlite']:
+        queue_dir = tempfile.mkdtemp(prefix='teuthology-bench-queue-')
+        queue = SQLiteQueue(os.path.join(queue_dir, 'queue.db'))
+    try:
+        results = run_benchmark(
+            suite_dir,
+            limit=int(args['--limit']),
+            filter_in=args['--filter'],
+            filter_out=args['--filter-out'],
+            parse=not args['--no-parse'],
+            submit=not args['--no-submit'],
+            queue=queue,
+        )
+    finally:
+        if not keep:
+            shutil.rmtree(suite_dir, ignore_errors=True)
+        if queue_dir:
+            queue.close()
+            shutil.rmtree(queue_dir, ignore_errors=True)
+    results['params'] = params
+    results['queue'] = 'sqlite' if queue_dir else 'memory'
+    output = json.dumps(results, sort_keys=True, indent=4)
+    if args['--output']:
+        with file(args['--output'], 'w') as out_file:
+            out_file.write(output + '\n')
+    else:
+        print output
+
+
+def make_suite(path, facets=3, fragments=10, depth=1, concat=0,
+               fragment_size=256, seed=0):
+    """
+    Generate a synthetic suite. Every directory is a '%' directory with
+    'facets' subdirectories, each of which holds 'fragments' yaml files. When
+    depth is greater than 1, the first facet at each level is itself a '%'
+    directory, nested depth levels deep. If concat is nonzero, an extra '+'
+    facet with that many fragments is added to the top level; it contributes
+    its fragments to every job without adding combinations.
+
+    :param path:          The directory to create the suite in
+    :param facets:        The number of facets per '%' directory
+    :param fragments:     The number of yaml fragments per facet
+    :param depth:         How many levels of '%' directories to create
+    :param concat:        The number of fragments in the '+' facet
+    :param fragment_size: The approximate size of each fragment, in bytes
+    :param seed:          Seed for the generated fragment contents
+    :returns:             The number of combinations the suite generates
+    """
+    rand = random.Random(seed)
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    open(os.path.join(path, '%'), 'w').close()
+    combinations = 1
+    for facet_index in range(facets):
+        facet_name = 'facet{i}'.format(i=facet_index)
+        facet_path = os.path.join(path, facet_name)
+        if facet_index == 0 and depth > 1:
+            combinations *= make_suite(facet_path, facets, fragments,
+                                       depth - 1, 0, fragment_size,
+                                       rand.random())
+            continue
+        os.mkdir(facet_path)
+        for fragment_index in range(fragments):
+            fragment_path = os.path.join(
+                facet_path, '{i}.yaml'.format(i=fragment_index))
+            make_fragment(fragment_path, facet_name, fragment_size, rand)
+        combinations *= fragments
+    if concat:
+        concat_path = os.path.join(path, 'concat')
+        os.mkdir(concat_path)
+        open(os.path.join(concat_path, '+'), 'w').close()
+        for fragment_index in range(concat):
+            fragment_path = os.path.join(
+                concat_path, '{i}.yaml'.format(i=fragment_index))
+            make_fragment(fragment_path, 'concat', fragment_size, rand)
+    return combinations
+
+
+def make_fragment(path, section, size, rand):
+    """
+    Write a yaml fragment of roughly 'size' bytes that looks like a typical
+    set of ceph config overrides.
+    """
+    conf = dict()
+    fragment = dict(overrides=dict(ceph=dict(conf={section: conf})))
+    while len(yaml.safe_dump(fragment)) < size:
+        key = 'debug {n}'.format(n=rand.randint(0, 1 << 20))
+        conf[key] = rand.randint(0, 20)
+    with file(path, 'w') as fragment_file:
+        yaml.safe_dump(fragment, fragment_file, default_flow_style=False)
+
+
+class InMemoryQueue(object):
+    """
+    Just enough of a beanstalkc.Connection to stand in for beanstalkd when
+    submitting jobs.
+    """
+    def __init__(self):
+        self.tube = 'default'
+        self.jobs = list()
+        self.index = None
+
+    def use(self, tube):
+        self.tube = tube
+
+    def put(self, body, priority=2 ** 31, delay=0, ttr=120):
+        self.jobs.append((self.tube, priority, body))
+        return len(self.jobs)
+
+    def put_many(self, bodies, priority=2 ** 31, delay=0, ttr=120):
+        return [self.put(body, priority, delay, ttr) for body in bodies]
+
+    def close(self):
+        pass
+
+
+def run_benchmark(path, suite_name='bench', limit=0, filter_in=None,
+                  filter_out=None, parse=True, submit=True, queue=None):
+    """
+    Time each scheduling step for the suite at path.
+
+    :param path:       The suite directory
+    :param suite_name: The name to prefix job descriptions with
+    :param limit:      Stop after this many jobs pass the filters; 0 means no
+                       limit
+    :param filter_in:  Like teuthology-suite --filter
+    :param filter_out: Like teuthology-suite --filter-out
+    :param parse:      Whether to time parsing the yaml fragments
+    :param submit:     Whether to time submitting jobs to the queue
+    :param queue:      Optional. The queue to submit jobs to; defaults to an
+                       InMemoryQueue
+    :returns:          A dict of counts, timings (in seconds) and rates (in
+                       jobs per second)
+    """
+    timer = Timer()
+    with timer.time('build_matrix'):
+        configs = [(suite.combine_path(suite_name, item[0]), item[1]) for
+                   item in suite.build_matrix(path)]
+
+    with timer.time('filter'):
+        filtered = list()
+        for description, fragment_paths in configs:
+            if limit > 0 and len(filtered) >= limit:
+                break
+            if suite.match_filters(description, fragment_paths, filter_in,
+                                   filter_out):
+                filtered.append((description, fragment_paths))
+
+    if parse:
+        with timer.time('parse'):
+            for description, fragment_paths in filtered:
+                suite.parse_fragments(fragment_paths)
+
+    queue = queue or InMemoryQueue()
+    submitted = 0
+    if submit:
+        # Don't report queued jobs to the results server
+        results_server = config.results_server
+        config.results_server = None
+        try:
+            with timer.time('submit'), quiet_stdout():
+                submitted = submit_jobs(queue, suite_name, filtered)
+        finally:
+            config.results_server = results_server
+
+    rates = dict()
+    for (step, count) in (('build_matrix', len(configs)),
+                          ('filter', len(configs)),
+                          ('parse', len(filtered)),
+                          ('submit', len(filtered))):
+        seconds = timer.timings.get(step)
+        if seconds:
+            rates[step] = count / seconds
+    return dict(
+        combinations=len(configs),
+        jobs=len(filtered),
+        submitted=submitted,
+        timings=timer.timings,
+        rates=rates,
+    )
+
+
+def submit_jobs(queue, run_name, configs):
+    """
+    Build and queue a job config for each (description, fragment_paths) pair,
+    the way teuthology-schedule does.
+
+    :returns: The number of jobs submitted
+    """
+    submitted = 0
+    for description, fragment_paths in configs:
+        args = {
+            '--name': run_name,
+            '--description': description,
+            '--last-in-suite': False,
+            '--email': None,
+            '--owner': 'bench',
+            '--verbose': False,
+            '--worker': 'plana',
+            '--priority': '1000',
+            '--timeout': None,
+            '<conf_file>': fragment_paths,
+        }
+        job_config = schedule.build_config(args)
+        submitted += len(schedule.schedule_job(job_config, connection=queue))
+    return submitted
@@ -0,0 +1,51 @@
+import os
+import shutil
+import tempfile
+import web
+
+from ...config import config
+from .. import locking
+
+
+class TestLocking(object):
+    def setup(self):
+        self.path = tempfile.mkdtemp(prefix='teuthology-bench-test-')
+        self.lock_server = config.lock_server
+
+    def teardown(self):
+        config.lock_server = self.lock_server
+        shutil.rmtree(self.path)
+
+    def test_percentile(self):
+        values = range(1, 101)
+        assert locking.percentile(values, 0.5) == 50
+        assert locking.percentile(values, 0.99) == 99
+        assert locking.percentile(values, 1) == 100
+        assert locking.percentile([3], 0.9) == 3
+        assert locking.percentile([], 0.5) is None
+
+    def test_populate(self):
+        db_path = os.path.join(self.path, 'locker.db')
+        locking.populate(db_path, 3, ['plana', 'mira'])
+        db = web.database(dbn='sqlite', db=db_path)
+        db.printing = False
+        rows = list(db.select('machine', where='up = 1 AND locked = 0'))
+        assert sorted([row.name for row in rows if row.type == 'mira']) == \
+            ['ubuntu@mira000', 'ubuntu@mira001', 'ubuntu@mira002']
+        assert len(rows) == 6
+
+    def test_run_benchmark(self):
+        server = locking.LockServer(4, ['plana'])
+        server.start()
+        try:
+            config.lock_server = server.url
+            results = locking.run_benchmark(clients=4, duration=1,
+                                            max_machines=2, hold=0)
+        finally:
+            server.stop()
+        operations = results['operations']
+        assert operations['lock']['count'] > 0
+        assert operations['unlock']['count'] > 0
+        for op in locking.operations:
+            assert operations[op]['errors'] == 0
+        assert not os.path.exists(server.db_dir)
@@ -0,0 +1,56 @@
+import os
+import shutil
+import tempfile
+
+from ... import suite
+from .. import scheduling
+
+
+class TestScheduling(object):
+    def setup(self):
+        self.path = tempfile.mkdtemp(prefix='teuthology-bench-test-')
+
+    def teardown(self):
+        shutil.rmtree(self.path)
+
+    def test_make_suite_flat(self):
+        combinations = scheduling.make_suite(self.path, facets=3, fragments=4)
+        assert combinations == 64
+        assert len(suite.build_matrix(self.path)) == combinations
+
+    def test_make_suite_nested(self):
+        combinations = scheduling.make_suite(self.path, facets=2, fragments=3,
+                                             depth=3)
+        assert combinations == 3 ** 4
+        assert len(suite.build_matrix(self.path)) == combinations
+
+    def test_make_suite_concat(self):
+        combinations = scheduling.make_suite(self.path, facets=2, fragments=2,
+                                             concat=3)
+        matrix = suite.build_matrix(self.path)
+        assert len(matrix) == combinations == 4
+        for description, fragment_paths in matrix:
+            assert len(fragment_paths) == 2 + 3
+
+    def test_fragment_size(self):
+        scheduling.make_suite(self.path, facets=1, fragments=1,
+                              fragment_size=4096)
+        size = os.path.getsize(os.path.join(self.path, 'facet0', '0.yaml'))
+        assert 4096 <= size < 4096 * 1.5
+
+    def test_run_benchmark(self):
+        scheduling.make_suite(self.path, facets=2, fragments=5)
+        results = scheduling.run_benchmark(self.path, filter_out='facet1/0')
+        assert results['combinations'] == 25
+        assert results['jobs'] == 20
+        assert results['submitted'] == 20
+        assert set(results['timings'].keys()) == set(
+            ['build_matrix', 'filter', 'parse', 'submit'])
+
+    def test_run_benchmark_limit(self):
+        scheduling.make_suite(self.path, facets=2, fragments=5)
+        results = scheduling.run_benchmark(self.path, limit=7, parse=False,
+                                           submit=False)
+        assert results['jobs'] == 7
+        assert results['submitted'] == 0
+        assert 'parse' not in results['timings']
@@ -109,10 +109,24 @@ class TeuthologyConfig(YamlConfig):
         'archive_base': '/var/lib/teuthworker/archive',
         'automated_scheduling': False,
         'ceph_git_base_url': 'https://github.com/ceph/',
+        'duration_db_path': None,
+        'fair_share': False,
+        'fair_share_weights': {},
+        'fetch_max_age': 300,
+        'job_defer_delay': 60,
         'lock_server': 'http://teuthology.front.sepia.ceph.com/locker/lock',
+        'lock_server_timeout': 60,
+        'max_job_defers': 30,
         'max_job_time': 259200,  # 3 days
+        'mirror_max_age': 60,
+        'owner_max_running': {},
+        'prefetch_interval': 60,
+        'queue_backend': 'beanstalk',
+        'queue_index_path': None,
+        'queue_sqlite_path': os.path.expanduser('~/.teuthology_queue.db'),
         'results_server': 'http://paddles.front.sepia.ceph.com/',
         'src_base_path': os.path.expanduser('~/src'),
+        'venv_cache_max_age': 1209600,  # 2 weeks
         'verify_host_keys': True,
         'watchdog_interval': 600,
     }
@@ -0,0 +1,253 @@
+"""
+Share machines fairly between owners and runs.
+
+With config.fair_share set, teuthology-schedule puts jobs in a pending tube
+(see job_queue.pending_tube()) that no worker watches. teuthology-dispatcher
+moves them from there into the tube the workers read from, keeping only a
+small backlog of ready jobs in it, and each time picking the job whose owner
+has the fewest jobs dispatched and not yet finished relative to its weight in
+config.fair_share_weights. Within an owner, runs with fewer jobs in flight go
+first; job priority breaks any remaining ties. config.owner_max_running
+optionally caps how many jobs an owner may have in flight at once.
+
+How long each owner's jobs waited in the pending tube is logged and written,
+along with their pending and in-flight job counts, to a yaml file next to
+the dispatcher's log.
+"""
+import beanstalkc
+import logging
+import os
+import time
+import yaml
+
+from collections import Counter, defaultdict, deque
+
+from teuthology import setup_log_file
+from . import job_queue
+from . import report
+from .config import config as teuth_config
+from .worker import install_except_hook
+
+log = logging.getLogger(__name__)
+
+# The states a dispatched job may be in until it finishes: workers bury the
+# jobs they run, and release the jobs they defer with a delay
+ACTIVE_STATES = ('ready', 'reserved', 'delayed', 'buried')
+
+
+def main(ctx):
+    loglevel = logging.INFO
+    if ctx.verbose:
+        loglevel = logging.DEBUG
+    log.setLevel(loglevel)
+
+    log_file_path = os.path.join(ctx.log_dir, 'dispatcher.{tube}.{pid}'.format(
+        pid=os.getpid(), tube=ctx.tube,))
+    setup_log_file(log_file_path)
+
+    install_except_hook()
+
+    queue = job_queue.connect()
+    if queue.index is None:
+        raise RuntimeError(
+            "The dispatcher needs to list queued jobs; check that the queue "
+            "index can be opened, or use the sqlite queue_backend")
+    fair_share = FairShare(teuth_config.fair_share_weights,
+                           teuth_config.owner_max_running)
+    dispatcher = Dispatcher(queue, ctx.tube, fair_share, backlog=ctx.backlog,
+                            state_file_path=log_file_path + '.stats')
+    while True:
+        dispatcher.dispatch()
+        time.sleep(ctx.interval)
+
+
+class FairShare(object):
+    """
+    Decide which pending job to dispatch next.
+    """
+    def __init__(self, weights=None, limits=None):
+        """
+        :param weights: Optional. A dict mapping owners to their share of the
+                        machines; owners not listed have a weight of 1
+        :param limits:  Optional. A dict mapping owners to the most jobs they
+                        may have in flight
+        """
+        self.weights = weights or dict()
+        self.limits = limits or dict()
+
+    def choose(self, pending, active):
+        """
+        :param pending: A list of dicts describing pending jobs, with 'job_id',
+                        'name', 'owner' and 'priority' keys
+        :param active:  A list of (owner, run_name) tuples, one for each job
+                        in flight
+        :returns:       The dict from pending to dispatch next, or None if no
+                        owner with pending jobs is under its limit
+        """
+        owner_active = Counter([owner for (owner, run) in active])
+        run_active = Counter([run for (owner, run) in active])
+
+        def share_key(job_info):
+            owner = job_info['owner']
+            weight = float(self.weights.get(owner, 1))
+            return (owner_active[owner] / weight, run_active[job_info['name']],
+                    job_info['priority'], job_info['job_id'])
+
+        candidates = [job_info for job_info in pending if
+                      owner_active[job_info['owner']] <
+                      self.limits.get(job_info['owner'], float('inf'))]
+        if not candidates:
+            return None
+        return min(candidates, key=share_key)
+
+
+class Dispatcher(object):
+    # How many recent queue wait times to keep per owner
+    wait_samples = 100
+
+    def __init__(self, queue, tube, fair_share, backlog=2,
+                 state_file_path=None):
+        """
+        :param queue:           A queue from job_queue.connect()
+        :param tube:            The tube workers read from
+        :param fair_share:      A FairShare
+        :param backlog:         How many ready jobs to keep in tube
+        :param state_file_path: Optional. Where to write per-owner stats
+        """
+        self.queue = queue
+        self.tube = tube
+        self.pending_tube = job_queue.pending_tube(tube)
+        self.fair_share = fair_share
+        self.backlog = backlog
+        self.state_file_path = state_file_path
+        # job id -> (owner, run name), for each job dispatched to tube that
+        # hasn't finished yet
+        self.active = dict()
+        self.waits = defaultdict(lambda: deque(maxlen=self.wait_samples))
+        # Pick up jobs that were dispatched before we started
+        for job_info in self.queue.index.jobs(tube=self.tube,
+                                              states=ACTIVE_STATES):
+            self.active[job_info['job_id']] = (job_info['owner'],
+                                               job_info['name'])
+
+    def update_active(self):
+        """
+        Forget about jobs that workers have finished, or that were killed.
+        """
+        for job_id in self.active.keys():
+            try:
+                self.queue.stats_job(job_id)
+            except beanstalkc.CommandFailed:
+                del self.active[job_id]
+
+    def count_ready(self):
+        try:
+            return self.queue.stats_tube(self.tube)['current-jobs-ready']
+        except beanstalkc.CommandFailed:
+            # beanstalkd doesn't know about tubes nobody has used
+            return 0
+
+    def dispatch(self):
+        """
+        Move pending jobs into the workers' tube, fairest first, until it
+        holds self.backlog ready jobs.
+
+        :returns: A list of the ids the dispatched jobs have in the workers'
+                  tube
+        """
+        self.update_active()
+        pending = self.queue.index.jobs(tube=self.pending_tube)
+        dispatched = list()
+        ready = self.count_ready()
+        while ready < self.backlog:
+            job_info = self.fair_share.choose(pending, self.active.values())
+            if job_info is None:
+                break
+            pending.remove(job_info)
+            job_id = self.promote(job_info)
+            if job_id is not None:
+                dispatched.append(job_id)
+                ready += 1
+        self.write_state(pending)
+        return dispatched
+
+    def promote(self, job_info):
+        """
+        Delete a pending job and put a copy of it in the workers' tube. The
+        original is deleted first, so that a job teuthology-kill deletes in
+        the meantime isn't run anyway. The copy gets a new id, so the results
+        server is told about it, and the original is deleted from there too.
+
+        :returns: The new job's id, or None if the pending job is gone
+        """
+        old_id = job_info['job_id']
+        job = self.queue.peek(old_id)
+        if job is not None:
+            try:
+                job.delete()
+            except beanstalkc.CommandFailed:
+                # e.g. teuthology-kill deleted it after we peeked at it
+                job = None
+        self.queue.index.remove([old_id])
+        if job is None:
+            log.warn("Pending job %s disappeared before it was dispatched",
+                     old_id)
+            return None
+        self.queue.use(self.tube)
+        job_id = self.queue.put(job.body, priority=job_info['priority'],
+                                ttr=60 * 60 * 24)
+        self.queue.index.add(job_id, self.tube, job_info)
+        job_config = yaml.safe_load(job.body)
+        job_config['job_id'] = str(job_id)
+        report.try_push_job_info(job_config, dict(status='queued'))
+        report.try_delete_jobs(job_info['name'], str(old_id),
+                               delete_empty_run=False)
+        owner = job_info['owner']
+        self.active[job_id] = (owner, job_info['name'])
+        wait = time.time() - job_info['queued_at']
+        self.waits[owner].append(wait)
+        log.info("Dispatched %s/%s for %s as job %s after %ds",
+                 job_info['name'], old_id, owner, job_id, wait)
+        return job_id
+
+    def get_stats(self, pending):
+        """
+        :param pending: The pending jobs still waiting, as passed to
+                        FairShare.choose()
+        :returns:       A dict mapping each owner to a dict with its numbers of
+                        'pending' and 'active' jobs, and the 'mean_wait',
+                        'max_wait' of its recently dispatched jobs and
+                        'oldest_pending' wait, in seconds
+        """
+        now = time.time()
+        owners = set([owner for (owner, run) in self.active.values()])
+        owners.update([job_info['owner'] for job_info in pending])
+        owners.update(self.waits.keys())
+        stats = dict()
+        for owner in owners:
+            owner_pending = [job_info for job_info in pending
+                             if job_info['owner'] == owner]
+            waits = self.waits[owner]
+            stats[owner] = dict(
+                pending=len(owner_pending),
+                active=len([1 for (o, run) in self.active.values()
+                            if o == owner]),
+                mean_wait=int(sum(waits) / len(waits)) if waits else None,
+                max_wait=int(max(waits)) if waits else None,
+                oldest_pending=int(now - min(
+                    [job_info['queued_at'] for job_info in owner_pending]))
+                if owner_pending else None,
+            )
+        return stats
+
+    def write_state(self, pending):
+        stats = self.get_stats(pending)
+        for owner in sorted(stats):
+            log.debug("%s: %s", owner, stats[owner])
+        if not self.state_file_path:
+            return
+        try:
+            with file(self.state_file_path, 'w') as state_file:
+                yaml.safe_dump(stats, state_file, default_flow_style=False)
+        except IOError:
+            log.exception("Failed to write dispatcher stats")
@@ -0,0 +1,378 @@
+"""
+Remember how long jobs took, and how often they failed.
+
+Every finished job leaves a summary.yaml in the archive with its description,
+duration and whether it succeeded. DurationStore collects those into a small
+sqlite database, keyed by the job's normalized
+description, so that teuthology-suite can predict how long each job of a new
+run will take and how likely it is to fail, and queue the jobs in a more
+useful order than build_matrix() produces, and so that teuthology-queue can
+estimate when queued runs will start and finish.
+
+The database is at config.duration_db_path or, by default, next to the
+archive, so that everyone scheduling runs from the same archive shares it.
+"""
+import logging
+import os
+import sqlite3
+import time
+import yaml
+
+from collections import OrderedDict
+
+from .config import config
+from .phases import median
+from .report import ResultsSerializer
+
+log = logging.getLogger(__name__)
+
+orders = ('longest-first', 'fail-first')
+# How many priorities prioritize_jobs() spreads a run's jobs over
+PRIORITY_LEVELS = 10
+
+
+def normalize_description(description):
+    """
+    Make descriptions of the same job from different runs compare equal.
+    teuthology-suite writes the suite part of a description with ':' in place
+    of '/', and the whitespace in the facet list isn't significant.
+
+    :param description: A job description, e.g. 'rados:thrash/{a.yaml b.yaml}'
+    :returns:           The normalized description
+    """
+    return ' '.join(description.replace(':', '/').split())
+
+
+class DurationStore(object):
+    schema = [
+        """CREATE TABLE IF NOT EXISTS jobs (
+            run_name TEXT NOT NULL,
+            job_id TEXT NOT NULL,
+            key TEXT NOT NULL,
+            duration REAL,
+            success INTEGER,
+            finished_at REAL,
+            machines INTEGER,
+            PRIMARY KEY (run_name, job_id)
+        )""",
+        "CREATE INDEX IF NOT EXISTS jobs_key ON jobs (key, finished_at)",
+        # Runs whose every job had finished when we last looked; we don't
+        # need to look at them again
+        """CREATE TABLE IF NOT EXISTS runs (
+            run_name TEXT PRIMARY KEY
+        )""",
+    ]
+    # Columns added since the jobs table was first created
+    added_columns = [('machines', 'INTEGER')]
+    # How many of a job's most recent results to predict from
+    history = 10
+    # How many descriptions to look up per query
+    chunk_size = 500
+
+    def __init__(self, path):
+        self.path = path
+        dir_path = os.path.dirname(path)
+        if dir_path and not os.path.isdir(dir_path):
+            os.makedirs(dir_path)
+        self.db = sqlite3.connect(path, timeout=60)
+        with self.db:
+            for statement in self.schema:
+                self.db.execute(statement)
+            columns = [row[1] for row in
+                       self.db.execute("PRAGMA table_info(jobs)")]
+            for column, column_type in self.added_columns:
+                if column not in columns:
+                    self.db.execute("ALTER TABLE jobs ADD COLUMN %s %s" %
+                                    (column, column_type))
+
+    def record(self, run_name, job_id, description, duration, success,
+               finished_at=None, machines=None):
+        """
+        Record the result of one job. Recording the same job twice has no
+        effect.
+
+        :param machines: Optional. How many machines the job used
+        """
+        with self.db:
+            self.db.execute(
+                "INSERT OR IGNORE INTO jobs (run_name, job_id, key, duration, "
+                "success, finished_at, machines) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (run_name, str(job_id), normalize_description(description),
+                 duration, int(bool(success)), finished_at or time.time(),
+                 machines),
+            )
+
+    def update_from_archive(self, archive_base=None, max_age=None):
+        """
+        Record the results of every finished job in the archive that hasn't
+        been recorded yet. Runs are looked at again until all their jobs have
+        finished.
+
+        :param archive_base: Optional. The archive to read; defaults to
+                             config.archive_base
+        :param max_age:      Optional. Once a run's archive directory hasn't
+                             changed in this many seconds, none of its jobs
+                             can still be running, e.g. config.max_job_time:
+                             its results are recorded one last time and it
+                             isn't looked at again, even if some jobs died
+                             without a summary
+        :returns:            The number of jobs recorded
+        """
+        serializer = ResultsSerializer(archive_base)
+        archive_base = serializer.archive_base
+        done = set([row[0] for row in
+                    self.db.execute("SELECT run_name FROM runs")])
+        count = 0
+        for run_name in serializer.all_runs:
+            if run_name in done:
+                continue
+            run_dir = os.path.join(archive_base, run_name)
+            final = bool(max_age) and \
+                time.time() - os.path.getmtime(run_dir) > max_age
+            count += self.update_run(serializer, run_name, final)
+        return count
+
+    def update_run(self, serializer, run_name, final=False):
+        """
+        Record the results of a run's finished jobs that haven't been
+        recorded yet.
+
+        :param final: Whether to stop looking at the run afterwards, even if
+                      some of its jobs haven't finished
+        :returns:     The number of jobs recorded
+        """
+        recorded = set([row[0] for row in self.db.execute(
+            "SELECT job_id FROM jobs WHERE run_name = ?", (run_name,))])
+        finished = True
+        count = 0
+        for job_id, job_dir in serializer.jobs_for_run(run_name).items():
+            if job_id in recorded:
+                continue
+            summary_path = os.path.join(job_dir, 'summary.yaml')
+            if not os.path.exists(summary_path):
+                finished = False
+                continue
+            with file(summary_path) as summary_file:
+                summary = yaml.safe_load(summary_file) or dict()
+            if not summary.get('description') or 'duration' not in summary:
+                continue
+            self.record(run_name, job_id, summary['description'],
+                        summary['duration'], summary.get('success'),
+                        os.path.getmtime(summary_path),
+                        get_machine_count(job_dir))
+            count += 1
+        if finished or final:
+            with self.db:
+                self.db.execute("INSERT OR IGNORE INTO runs VALUES (?)",
+                                (run_name,))
+        return count
+
+    def predict(self, description):
+        """
+        :param description: A job description
+        :returns:           A tuple of the job's predicted duration in seconds
+                            and its failure rate over its most recent results,
+                            or None if it has never been recorded
+        """
+        prediction = self.predict_many([description]).get(
+            normalize_description(description))
+        if prediction is None:
+            return None
+        return prediction[:2]
+
+    def predict_many(self, descriptions):
+        """
+        Like predict(), but for many jobs at once, and also predicting how
+        many machines each job needs.
+
+        :param descriptions: A list of job descriptions
+        :returns:            A dict mapping the normalized description of
+                             each job that has been recorded to a tuple of its
+                             predicted duration, failure rate and number of
+                             machines; the latter is None if unknown
+        """
+        keys = list(set([normalize_description(description) for description
+                         in descriptions]))
+        rows = dict()
+        for i in range(0, len(keys), self.chunk_size):
+            chunk = keys[i:i + self.chunk_size]
+            query = ("SELECT key, duration, success, machines FROM jobs "
+                     "WHERE key IN (%s) ORDER BY finished_at DESC" %
+                     ', '.join('?' * len(chunk)))
+            for row in self.db.execute(query, chunk):
+                key_rows = rows.setdefault(row[0], list())
+                if len(key_rows) < self.history:
+                    key_rows.append(row[1:])
+        predictions = dict()
+        for key, key_rows in rows.items():
+            durations = [duration for (duration, _, _) in key_rows]
+            failures = len([1 for (_, success, _) in key_rows
+                            if not success])
+            machines = [count for (_, _, count) in key_rows if count]
+            predictions[key] = (median(durations),
+                                failures / float(len(key_rows)),
+                                max(machines) if machines else None)
+        return predictions
+
+    def close(self):
+        self.db.close()
+
+
+def get_machine_count(job_dir):
+    """
+    :returns: The number of roles in a job's config in the archive, i.e. how
+              many machines it locked, or None if it can't be found
+    """
+    for yaml_name in ('orig.config.yaml', 'config.yaml'):
+        yaml_path = os.path.join(job_dir, yaml_name)
+        if not os.path.exists(yaml_path):
+            continue
+        with file(yaml_path) as yaml_file:
+            job_config = yaml.safe_load(yaml_file) or dict()
+        if 'roles' in job_config:
+            return len(job_config['roles'])
+    return None
+
+
+def get_duration_db_path():
+    """
+    :returns: config.duration_db_path, or by default 'job_durations.db' next
+              to config.archive_base
+    """
+    if config.duration_db_path:
+        return config.duration_db_path
+    archive_base = os.path.abspath(config.archive_base)
+    return os.path.join(os.path.dirname(archive_base), 'job_durations.db')
+
+
+def get_duration_store():
+    """
+    :returns: A DurationStore, or None if its database can't be opened
+    """
+    path = get_duration_db_path()
+    try:
+        return DurationStore(path)
+    except (OSError, sqlite3.Error):
+        log.exception("Could not open the job duration database at %s",
+                      path)
+        return None
+
+
+def prioritize_jobs(descriptions, order, store, priority):
+    """
+    Decide in which order to queue a run's jobs, and give each its own
+    priority so that the order holds among other runs' jobs too.
+
+    'longest-first' queues the jobs predicted to take longest first, so that
+    they don't start last and stretch out the whole run. 'fail-first' queues
+    the jobs most likely to fail first, longest first among equals, so that
+    failures show up early. Jobs with no history are assumed to take as long,
+    and to fail as often, as the average job with a history.
+
+    Each job's priority is the run's, made sooner by one for every hour it is
+    predicted to take ('longest-first') or every tenth of its past runs that
+    failed ('fail-first'), by at most PRIORITY_LEVELS - 1; so workers going
+    through several runs start the longest jobs of all of them first, while
+    each run still competes with the others by about its own priority.
+
+    :param descriptions: A list of job descriptions
+    :param order:        'longest-first' or 'fail-first'
+    :param store:        A DurationStore
+    :param priority:     The run's priority
+    :returns:            A list of (index into descriptions, priority)
+                         tuples, in the order to queue them
+    """
+    if order not in orders:
+        raise ValueError("Unknown job order: %s" % order)
+    by_key = store.predict_many(descriptions)
+    predictions = [by_key.get(normalize_description(description))
+                   for description in descriptions]
+    predictions = [p[:2] if p else None for p in predictions]
+    known = [p for p in predictions if p is not None]
+    if known:
+        default = (sum([p[0] for p in known]) / len(known),
+                   sum([p[1] for p in known]) / len(known))
+    else:
+        default = (0, 0)
+    predictions = [p or default for p in predictions]
+
+    def order_key(index):
+        duration, failure_rate = predictions[index]
+        if order == 'fail-first':
+            return (-failure_rate, -duration, index)
+        return (-duration, index)
+
+    def job_priority(index):
+        duration, failure_rate = predictions[index]
+        if order == 'fail-first':
+            levels = int(failure_rate * 10)
+        else:
+            levels = int(duration // 3600)
+        return max(0, priority - min(levels, PRIORITY_LEVELS - 1))
+
+    return [(index, job_priority(index)) for index in
+            sorted(range(len(descriptions)), key=order_key)]
+
+
+def forecast(jobs, store, capacity, busy=0, now=None):
+    """
+    Estimate when the runs with jobs in a queue will start and finish.
+
+    Machines are treated as one pool: each job needs its predicted duration
+    times its number of machines of the pool's time, and starts once the work
+    queued ahead of it, plus what the busy machines are still doing, has been
+    spread over the whole pool. Busy machines are assumed to be half way
+    through a job of the average length of the queued jobs.
+
+    :param jobs:     A list of dicts with 'name' and 'description' keys, in
+                     the order the queue will hand them out
+    :param store:    A DurationStore
+    :param capacity: How many machines can run the jobs
+    :param busy:     How many of those are currently locked
+    :param now:      Optional. The time to estimate from
+    :returns:        A tuple of a dict with the queue's total 'jobs' and
+                     'machine_hours' and an OrderedDict mapping each run name
+                     to a dict with its 'jobs', 'machine_hours', and estimated
+                     'start' and 'finish' times; those are None if capacity is
+                     zero
+    """
+    if now is None:
+        now = time.time()
+    by_key = store.predict_many([job['description'] or '' for job in jobs])
+    known = by_key.values()
+    if known:
+        default_duration = sum([p[0] for p in known]) / len(known)
+    else:
+        default_duration = 0
+    counts = [p[2] for p in known if p[2]]
+    default_machines = max(1, int(round(sum(counts) / float(len(counts))))) \
+        if counts else 1
+
+    # Machine-seconds of work to get through before the next job can start
+    backlog = busy * default_duration / 2.0
+    total = dict(jobs=0, machine_hours=0)
+    runs = OrderedDict()
+    for job in jobs:
+        prediction = by_key.get(normalize_description(job['description'] or
+                                                      ''))
+        if prediction:
+            duration, _, machines = prediction
+            machines = machines or default_machines
+        else:
+            duration, machines = default_duration, default_machines
+        work = duration * machines
+        run = runs.get(job['name'])
+        if run is None:
+            run = runs[job['name']] = dict(jobs=0, machine_hours=0,
+                                           start=None, finish=None)
+            if capacity:
+                run['start'] = now + backlog / capacity
+        run['jobs'] += 1
+        run['machine_hours'] += work / 3600.0
+        if capacity:
+            finish = now + backlog / capacity + duration
+            run['finish'] = max(run['finish'], finish)
+        backlog += work
+        total['jobs'] += 1
+        total['machine_hours'] += work / 3600.0
+    return total, runs
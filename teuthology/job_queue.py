@@ -0,0 +1,713 @@
+"""
+The job queue teuthology-schedule puts jobs in and teuthology-worker takes
+them out of.
+
+Callers get a queue from connect(), which picks a backend according to
+config.queue_backend:
+
+    beanstalk: The beanstalkd server at config.queue_host:config.queue_port
+    sqlite:    A sqlite database at config.queue_sqlite_path; meant for small
+               labs, tests and benchmarks, where running beanstalkd is more
+               trouble than it's worth
+
+Both backends act like a beanstalkc.Connection - use(), watch(), ignore(),
+put(), reserve(), peek(), peek_ready(), peek_delayed(), stats_tube(),
+stats_job() and close(), with reserved jobs that have bury(), release(),
+delete(), touch() and stats() - and add:
+
+    put_many(bodies, ...): Put several jobs in the used tube at once
+    delete_by_run(tube, run_name): Delete a run's ready and delayed jobs
+    index: Something that can list a tube's ready jobs without reserving
+           them, like a QueueIndex; or None
+
+The functions that BeanstalkQueue.delete_by_run() uses to find and delete a
+run's jobs, and get_run_name(), live here too, so that teuthology-queue (see
+beanstalk.py) can use them as well.
+"""
+import beanstalkc
+import logging
+import os
+import re
+import sqlite3
+import time
+import uuid
+import yaml
+
+from .config import config
+from .queue_index import get_queue_index
+
+log = logging.getLogger(__name__)
+
+DEFAULT_PRIORITY = 2 ** 31
+DEFAULT_TTR = 120
+# The states of jobs that are still waiting to run: ready ones, and those
+# that workers deferred (see worker.defer_job())
+QUEUED_STATES = ('ready', 'delayed')
+
+
+def connect():
+    """
+    :returns: A queue using the backend named by config.queue_backend
+    """
+    backend = config.queue_backend
+    if backend == 'beanstalk':
+        return BeanstalkQueue(connect_beanstalk())
+    elif backend == 'sqlite':
+        return SQLiteQueue(config.queue_sqlite_path)
+    raise ValueError("Unknown queue_backend: %s" % backend)
+
+
+def connect_beanstalk():
+    """
+    :returns: A beanstalkc.Connection to config.queue_host:config.queue_port
+    """
+    host = config.queue_host
+    port = config.queue_port
+    if host is None or port is None:
+        raise RuntimeError(
+            'Beanstalk queue information not found in {conf_path}'.format(
+                conf_path=config.teuthology_yaml))
+    return beanstalkc.Connection(host=host, port=port)
+
+
+def pending_tube(tube):
+    """
+    :returns: The name of the tube that jobs for tube wait in until
+              teuthology-dispatcher moves them there; see dispatcher.py
+    """
+    return tube + '-pending'
+
+
+def get_tubes(tube):
+    """
+    :returns: A list of the tubes that jobs for tube may be queued in
+    """
+    if config.fair_share:
+        return [tube, pending_tube(tube)]
+    return [tube]
+
+
+def get_run_name(job_body):
+    """
+    Find the run name in a job's yaml without parsing the whole thing.
+    """
+    return get_job_value(job_body, 'name')
+
+
+def get_job_value(job_body, key):
+    """
+    Find the value of a top-level key in a job's yaml, only parsing the
+    whole thing if the value spans several lines.
+    """
+    if job_body is None:
+        return None
+    # A top-level key whose value isn't continued onto the next line
+    found = re.search('^%s: .*$(?!\\n )' % re.escape(key), job_body,
+                      re.MULTILINE)
+    if found:
+        return yaml.safe_load(found.group(0))[key]
+    return (yaml.safe_load(job_body) or dict()).get(key)
+
+
+def find_indexed_jobs(connection, tube_name, queue_index):
+    """
+    Look up a tube's jobs in queue_index, and ask beanstalkd which of them are
+    still queued, without reserving anything. Entries for jobs that are gone
+    are removed from the index.
+
+    :param queue_index: A QueueIndex, or None
+    :returns:           A tuple: the index entries of the jobs that are still
+                        queued, each with its 'state' added; and a dict
+                        mapping each of QUEUED_STATES to how many jobs in that
+                        state the tube has that the index doesn't know about,
+                        e.g. because they were scheduled before the index
+                        existed
+    """
+    job_infos = list()
+    gone = list()
+    if queue_index:
+        for job_info in queue_index.jobs(tube=tube_name,
+                                         states=QUEUED_STATES):
+            try:
+                state = connection.stats_job(job_info['job_id'])['state']
+            except beanstalkc.CommandFailed:
+                gone.append(job_info['job_id'])
+                continue
+            if state in QUEUED_STATES:
+                job_infos.append(dict(job_info, state=state))
+        if gone:
+            queue_index.remove(gone)
+    try:
+        stats = connection.stats_tube(tube_name)
+    except beanstalkc.CommandFailed:
+        # beanstalkd doesn't know about tubes nobody has used
+        stats = dict()
+    missing = dict()
+    for state in QUEUED_STATES:
+        indexed = len([job_info for job_info in job_infos
+                       if job_info['state'] == state])
+        missing[state] = max(stats.get('current-jobs-' + state, 0) - indexed,
+                             0)
+    return job_infos, missing
+
+
+def delete_jobs(connection, tube_name, match, queue_index=None,
+                processor=None):
+    """
+    Delete the ready and delayed jobs in a tube whose run name satisfies
+    match.
+
+    The matching jobs queue_index knows about are deleted by id. Only if the
+    tube has queued jobs the index doesn't know about (see
+    find_indexed_jobs()) are those looked for as well: delayed ones with
+    delete_delayed_jobs(), and ready ones by reserving each ready job in the
+    tube with stream_delete_jobs(), which the connection must be watching.
+
+    :param match:     A function that takes a run name and returns True if
+                      its jobs should be deleted
+    :param processor: Optional. A JobProcessor to pass each deleted job to
+    :returns:         A list of the ids of the deleted jobs
+    """
+    job_infos, missing = find_indexed_jobs(connection, tube_name,
+                                           queue_index)
+    deleted = list()
+    matching = [job_info for job_info in job_infos
+                if match(job_info['name'])]
+    if matching:
+        deleted += delete_indexed_jobs(connection, matching, queue_index,
+                                       processor)
+    if missing['delayed']:
+        log.warning("%d deferred jobs in %s are missing from the queue "
+                    "index; looking through the deferred jobs for them",
+                    missing['delayed'], tube_name)
+        deleted += delete_delayed_jobs(
+            connection, tube_name, match, processor,
+            indexed=[job_info['job_id'] for job_info in job_infos],
+            unindexed=missing['delayed'])
+    if missing['ready']:
+        log.warning("%d ready jobs in %s are missing from the queue index; "
+                    "reserving each ready job to find them",
+                    missing['ready'], tube_name)
+        deleted += stream_delete_jobs(connection, match, processor)
+    if processor:
+        processor.complete()
+    return deleted
+
+
+def delete_indexed_jobs(connection, job_infos, queue_index, processor=None):
+    """
+    Delete jobs by id, given their entries in queue_index. Jobs that are no
+    longer ready or delayed, e.g. because a worker has reserved them, are
+    left alone.
+
+    :returns: A list of the ids of the deleted jobs
+    """
+    deleted = list()
+    gone = list()
+    for job_info in job_infos:
+        job_id = job_info['job_id']
+        job = connection.peek(job_id)
+        # beanstalkd reuses job ids after restarting without a binlog, so
+        # make sure this is still the job we indexed
+        if job is None or get_run_name(job.body) != job_info['name']:
+            gone.append(job_id)
+            continue
+        try:
+            if job.stats()['state'] not in QUEUED_STATES:
+                continue
+            job.delete()
+        except beanstalkc.CommandFailed:
+            # A worker got to it first
+            continue
+        deleted.append(job_id)
+        if processor:
+            processor.add_job(job_id, job_info)
+    queue_index.remove(gone + deleted)
+    return deleted
+
+
+def delete_delayed_jobs(connection, tube_name, match, processor=None,
+                        indexed=(), unindexed=None):
+    """
+    Delete the delayed jobs in a tube whose run name satisfies match, without
+    the help of the queue index.
+
+    beanstalkd only shows the delayed job that will be ready soonest, so other
+    runs' jobs in front of the ones we are after have to be kicked, making
+    them ready; workers will defer them again if they still have to. Which
+    runs were disturbed this way is logged.
+
+    :param indexed:   Optional. The ids of the jobs the index knows about
+    :param unindexed: Optional. How many of the delayed jobs the index
+                      doesn't know about; once that many have been seen,
+                      nothing else is kicked
+    :returns:         A list of the ids of the deleted jobs
+    """
+    deleted = list()
+    kicked = list()
+    seen = set()
+    remaining = unindexed
+    connection.use(tube_name)
+    while remaining is None or remaining > 0:
+        job = connection.peek_delayed()
+        if job is None or job.jid in seen:
+            break
+        seen.add(job.jid)
+        if remaining is not None and job.jid not in indexed:
+            remaining -= 1
+        run_name = get_run_name(job.body)
+        try:
+            if match(run_name):
+                job.delete()
+                deleted.append(job.jid)
+                if processor:
+                    processor.add_job(job.jid, dict(name=run_name))
+            elif remaining is None or remaining > 0:
+                job.kick()
+                kicked.append(run_name)
+        except beanstalkc.CommandFailed:
+            # Its delay ran out and a worker got to it first
+            continue
+    if kicked:
+        log.warning("Made %d deferred jobs of other runs ready to get at "
+                    "the ones behind them; workers will defer them again: %s",
+                    len(kicked), ' '.join(sorted(set(kicked))))
+    return deleted
+
+
+def stream_delete_jobs(connection, match, processor=None):
+    """
+    Reserve each ready job in the tubes connection is watching, without
+    waiting, and delete those whose run name satisfies match. Only the run
+    name is parsed out of each job. The other jobs are released once all
+    ready jobs have been seen.
+
+    :returns: A list of the ids of the deleted jobs
+    """
+    deleted = list()
+    skipped = list()
+    try:
+        while True:
+            job = connection.reserve(timeout=0)
+            if job is None:
+                break
+            run_name = get_run_name(job.body)
+            if not match(run_name):
+                skipped.append(job)
+                continue
+            job.delete()
+            deleted.append(job.jid)
+            if processor:
+                processor.add_job(job.jid, dict(name=run_name))
+    finally:
+        for job in skipped:
+            job.release()
+    return deleted
+
+
+class BeanstalkQueue(object):
+    """
+    A beanstalkc.Connection with the extensions described in this module's
+    docstring. Everything else is passed through to the connection.
+    """
+    def __init__(self, connection):
+        self.connection = connection
+        self.index = get_queue_index()
+
+    def __getattr__(self, name):
+        return getattr(self.connection, name)
+
+    def put_many(self, bodies, priority=DEFAULT_PRIORITY, delay=0,
+                 ttr=DEFAULT_TTR):
+        """
+        beanstalkd has no batch command, so this is just a loop.
+
+        :returns: A list of the new jobs' ids
+        """
+        return [self.connection.put(body, priority=priority, delay=delay,
+                                    ttr=ttr) for body in bodies]
+
+    def delete_by_run(self, tube, run_name, processor=None):
+        """
+        See delete_jobs(); the connection must be watching tube.
+
+        :returns: A list of the ids of the deleted jobs
+        """
+        return delete_jobs(self, tube, lambda name: name == run_name,
+                           self.index, processor)
+
+    def close(self):
+        self.connection.close()
+        if self.index:
+            self.index.close()
+
+
+class SQLiteQueue(object):
+    """
+    A job queue kept in a sqlite database, which any number of processes on
+    the same host may share.
+
+    Like beanstalkd, ready jobs are handed out lowest priority value first,
+    then in the order they were put; a reserved job goes back to being ready
+    if it isn't deleted, buried or released within its ttr, or when the
+    connection that reserved it is closed. Since the queue can list its own
+    jobs, it is also its own index.
+    """
+    schema = [
+        """CREATE TABLE IF NOT EXISTS jobs (
+            job_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            tube TEXT NOT NULL,
+            priority INTEGER NOT NULL,
+            state TEXT NOT NULL,
+            body TEXT NOT NULL,
+            name TEXT,
+            description TEXT,
+            owner TEXT,
+            machine_type TEXT,
+            ttr INTEGER NOT NULL,
+            ready_at REAL NOT NULL,
+            reserved_until REAL,
+            reserved_by TEXT,
+            releases INTEGER NOT NULL DEFAULT 0,
+            queued_at REAL NOT NULL
+        )""",
+        """CREATE INDEX IF NOT EXISTS jobs_ready
+            ON jobs (tube, state, priority, job_id)""",
+        "CREATE INDEX IF NOT EXISTS jobs_name ON jobs (name, state)",
+        """CREATE INDEX IF NOT EXISTS jobs_machine_type
+            ON jobs (machine_type, state)""",
+    ]
+    # How often reserve() checks for ready jobs while it waits
+    poll_interval = 0.5
+
+    def __init__(self, path):
+        self.path = path
+        dir_path = os.path.dirname(path)
+        if dir_path and not os.path.isdir(dir_path):
+            os.makedirs(dir_path)
+        # We manage transactions ourselves; see _transaction()
+        self.db = sqlite3.connect(path, timeout=60, isolation_level=None)
+        self.db.row_factory = sqlite3.Row
+        with self._transaction():
+            for statement in self.schema:
+                self.db.execute(statement)
+        self.token = uuid.uuid4().hex
+        self.using = 'default'
+        self.watching = ['default']
+        self.index = self
+
+    def _transaction(self):
+        return Transaction(self.db)
+
+    def _update_states(self):
+        """
+        Make delayed jobs whose delay is up, and reserved jobs whose ttr has
+        run out, ready. Must be called inside a transaction.
+        """
+        now = time.time()
+        self.db.execute(
+            "UPDATE jobs SET state = 'ready' "
+            "WHERE state = 'delayed' AND ready_at <= ?", (now,))
+        self.db.execute(
+            "UPDATE jobs SET state = 'ready', reserved_by = NULL "
+            "WHERE state = 'reserved' AND reserved_until < ?", (now,))
+
+    def use(self, tube):
+        self.using = tube
+
+    def watch(self, tube):
+        if tube not in self.watching:
+            self.watching.append(tube)
+        return len(self.watching)
+
+    def ignore(self, tube):
+        if tube in self.watching and len(self.watching) > 1:
+            self.watching.remove(tube)
+        return len(self.watching)
+
+    def put(self, body, priority=DEFAULT_PRIORITY, delay=0, ttr=DEFAULT_TTR):
+        return self.put_many([body], priority, delay, ttr)[0]
+
+    def put_many(self, bodies, priority=DEFAULT_PRIORITY, delay=0,
+                 ttr=DEFAULT_TTR):
+        """
+        Put all the jobs in a single transaction.
+
+        :returns: A list of the new jobs' ids
+        """
+        now = time.time()
+        state = 'delayed' if delay else 'ready'
+        fields = dict()
+        job_ids = list()
+        with self._transaction():
+            for body in bodies:
+                # teuthology-schedule --num puts the same body many times
+                if body not in fields:
+                    fields[body] = [get_job_value(body, key) for
+                                    key in ('name', 'description', 'owner',
+                                            'machine_type')]
+                cursor = self.db.execute(
+                    "INSERT INTO jobs (tube, priority, state, body, name, "
+                    "description, owner, machine_type, ttr, ready_at, "
+                    "queued_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    [self.using, priority, state, body] + fields[body] +
+                    [ttr, now + delay, now],
+                )
+                job_ids.append(cursor.lastrowid)
+        return job_ids
+
+    def reserve(self, timeout=None):
+        """
+        :param timeout: How many seconds to wait for a job; None means
+                        forever
+        :returns:       A SQLiteJob, or None if the timeout ran out
+        """
+        give_up_at = None if timeout is None else time.time() + timeout
+        where = "state = 'ready' AND tube IN (%s)" % \
+            ', '.join('?' * len(self.watching))
+        while True:
+            with self._transaction():
+                self._update_states()
+                row = self.db.execute(
+                    "SELECT job_id, body, ttr FROM jobs WHERE " + where +
+                    " ORDER BY priority, job_id LIMIT 1",
+                    self.watching,
+                ).fetchone()
+                if row is not None:
+                    self.db.execute(
+                        "UPDATE jobs SET state = 'reserved', "
+                        "reserved_until = ?, reserved_by = ? "
+                        "WHERE job_id = ?",
+                        (time.time() + row['ttr'], self.token,
+                         row['job_id']),
+                    )
+                    return SQLiteJob(self, row['job_id'], row['body'])
+            if give_up_at is not None and time.time() >= give_up_at:
+                return None
+            time.sleep(self.poll_interval)
+
+    def _peek(self, where, params):
+        with self._transaction():
+            self._update_states()
+            row = self.db.execute(
+                "SELECT job_id, body FROM jobs WHERE " + where +
+                " ORDER BY priority, job_id LIMIT 1",
+                params,
+            ).fetchone()
+        if row is not None:
+            return SQLiteJob(self, row['job_id'], row['body'],
+                             reserved=False)
+
+    def peek(self, job_id):
+        return self._peek("job_id = ?", (job_id,))
+
+    def peek_ready(self):
+        return self._peek("tube = ? AND state = 'ready'", (self.using,))
+
+    def peek_delayed(self):
+        return self._peek("tube = ? AND state = 'delayed'", (self.using,))
+
+    def stats_job(self, job_id):
+        """
+        :raises: beanstalkc.CommandFailed if the job doesn't exist, as
+                 beanstalkc would
+        """
+        with self._transaction():
+            self._update_states()
+            row = self.db.execute(
+                "SELECT * FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+        if row is None:
+            raise beanstalkc.CommandFailed('stats-job', 'NOT_FOUND', [])
+        now = time.time()
+        return {
+            'id': row['job_id'],
+            'tube': row['tube'],
+            'state': row['state'],
+            'pri': row['priority'],
+            'age': int(now - row['queued_at']),
+            'ttr': row['ttr'],
+            'time-left': max(int((row['reserved_until'] or now) - now), 0),
+            'releases': row['releases'],
+        }
+
+    def stats_tube(self, tube):
+        with self._transaction():
+            self._update_states()
+            counts = dict(self.db.execute(
+                "SELECT state, COUNT(*) FROM jobs WHERE tube = ? "
+                "GROUP BY state", (tube,)).fetchall())
+        stats = dict(name=tube)
+        for state in ('ready', 'reserved', 'delayed', 'buried'):
+            stats['current-jobs-' + state] = counts.get(state, 0)
+        return stats
+
+    def jobs(self, tube=None, run_name=None, machine_type=None,
+             states=('ready',)):
+        """
+        List jobs, the way QueueIndex.jobs() does.
+
+        :param tube:         Optional. Only return jobs in this tube
+        :param run_name:     Optional. Only return jobs in this run
+        :param machine_type: Optional. Only return jobs for this machine type
+        :param states:       Optional. Only return jobs in one of these
+                             states; by default, ready ones
+        :returns:            A list of dicts, in the order the jobs will be
+                             handed out
+        """
+        where = ["state IN (%s)" % ', '.join('?' * len(states))]
+        params = list(states)
+        for (column, value) in (('tube', tube), ('name', run_name),
+                                ('machine_type', machine_type)):
+            if value is not None:
+                where.append("%s = ?" % column)
+                params.append(value)
+        with self._transaction():
+            self._update_states()
+            rows = self.db.execute(
+                "SELECT job_id, tube, name, description, priority, owner, "
+                "machine_type, queued_at FROM jobs WHERE " +
+                " AND ".join(where) + " ORDER BY priority, job_id",
+                params,
+            ).fetchall()
+        return [dict(zip(row.keys(), row)) for row in rows]
+
+    def add(self, job_id, tube, job_config):
+        """
+        Part of the QueueIndex interface; jobs are listed straight from the
+        queue, so there is nothing to do.
+        """
+        pass
+
+    def remove(self, job_ids):
+        """
+        Part of the QueueIndex interface; the queue has no index entries that
+        can go stale, so there is nothing to do.
+        """
+        pass
+
+    def delete_by_run(self, tube, run_name, processor=None):
+        """
+        Delete a run's ready and delayed jobs with a single query.
+
+        :param processor: Optional. A JobProcessor to pass each deleted job
+                          to
+        :returns:         A list of the ids of the deleted jobs
+        """
+        with self._transaction():
+            self._update_states()
+            rows = self.db.execute(
+                "SELECT job_id, tube, name, description, priority, owner "
+                "FROM jobs WHERE tube = ? AND name = ? AND "
+                "state IN ('ready', 'delayed') ORDER BY job_id",
+                (tube, run_name),
+            ).fetchall()
+            self.db.executemany("DELETE FROM jobs WHERE job_id = ?",
+                                [(row['job_id'],) for row in rows])
+        if processor:
+            for row in rows:
+                processor.add_job(row['job_id'], dict(zip(row.keys(), row)))
+            processor.complete()
+        return [row['job_id'] for row in rows]
+
+    def close(self):
+        """
+        Make the jobs this connection has reserved ready again, like
+        beanstalkd does when a client disconnects.
+        """
+        with self._transaction():
+            self.db.execute(
+                "UPDATE jobs SET state = 'ready', reserved_by = NULL "
+                "WHERE state = 'reserved' AND reserved_by = ?",
+                (self.token,))
+        self.db.close()
+
+
+class SQLiteJob(object):
+    """
+    The SQLiteQueue counterpart of a beanstalkc.Job
+    """
+    def __init__(self, queue, jid, body, reserved=True):
+        self.queue = queue
+        self.jid = jid
+        self.body = body
+        self.reserved = reserved
+
+    def _update(self, assignments, params, states=('reserved',)):
+        """
+        Update the job if it is in one of states and, if reserved, reserved
+        by this connection.
+
+        :raises: beanstalkc.CommandFailed if it isn't
+        """
+        with self.queue._transaction():
+            self.queue._update_states()
+            cursor = self.queue.db.execute(
+                "UPDATE jobs SET " + assignments + " WHERE job_id = ? AND "
+                "state IN (%s) AND (state != 'reserved' OR reserved_by = ?)" %
+                ', '.join('?' * len(states)),
+                list(params) + [self.jid] + list(states) +
+                [self.queue.token],
+            )
+            if cursor.rowcount == 0:
+                raise beanstalkc.CommandFailed('update', 'NOT_FOUND', [])
+
+    def delete(self):
+        with self.queue._transaction():
+            cursor = self.queue.db.execute(
+                "DELETE FROM jobs WHERE job_id = ? AND "
+                "(state != 'reserved' OR reserved_by = ?)",
+                (self.jid, self.queue.token),
+            )
+            if cursor.rowcount == 0:
+                raise beanstalkc.CommandFailed('delete', 'NOT_FOUND', [])
+        self.reserved = False
+
+    def release(self, priority=None, delay=0):
+        if not self.reserved:
+            return
+        state = 'delayed' if delay else 'ready'
+        self._update(
+            "state = ?, ready_at = ?, priority = COALESCE(?, priority), "
+            "reserved_by = NULL, releases = releases + 1",
+            (state, time.time() + delay, priority),
+        )
+        self.reserved = False
+
+    def bury(self, priority=None):
+        if not self.reserved:
+            return
+        self._update(
+            "state = 'buried', priority = COALESCE(?, priority), "
+            "reserved_by = NULL",
+            (priority,),
+        )
+        self.reserved = False
+
+    def kick(self):
+        self._update("state = 'ready'", (), states=('buried', 'delayed'))
+
+    def touch(self):
+        if self.reserved:
+            self._update("reserved_until = ? + ttr", (time.time(),))
+
+    def stats(self):
+        return self.queue.stats_job(self.jid)
+
+
+class Transaction(object):
+    """
+    Run statements as one write transaction, taking sqlite's write lock
+    up-front so that concurrent reserve() calls can't hand out the same job.
+    """
+    def __init__(self, db):
+        self.db = db
+
+    def __enter__(self):
+        self.db.execute("BEGIN IMMEDIATE")
+        return self.db
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.db.execute("COMMIT")
+        else:
+            self.db.execute("ROLLBACK")
@@ -9,6 +9,7 @@ import logging
 import getpass
 
 from . import beanstalk
+from . import job_queue
 from . import report
 from .config import config
 
@@ -113,31 +114,24 @@ def remove_beanstalk_jobs(run_name, tube_name):
             'Beanstalk queue information not found in {conf_path}'.format(
                 conf_path=config.yaml_path))
     log.info("Checking Beanstalk Queue...")
-    beanstalk_conn = beanstalk.connect()
-    real_tube_name = beanstalk.watch_tube(beanstalk_conn, tube_name)
-
-    curjobs = beanstalk_conn.stats_tube(real_tube_name)['current-jobs-ready']
-    if curjobs != 0:
-        x = 1
-        while x != curjobs:
-            x += 1
-            job = beanstalk_conn.reserve(timeout=20)
-            if job is None:
-                continue
-            job_config = yaml.safe_load(job.body)
-            if run_name == job_config['name']:
-                job_id = job.stats()['id']
-                msg = "Deleting job from queue. ID: " + \
-                    "{id} Name: {name} Desc: {desc}".format(
-                        id=str(job_id),
-                        name=job_config['name'],
-                        desc=job_config['description'],
-                    )
-                log.info(msg)
-                job.delete()
-    else:
-        print "No jobs in Beanstalk Queue"
-    beanstalk_conn.close()
+    queue = job_queue.connect()
+    # With fair_share, jobs may also be waiting in a pending tube
+    watched = None
+    for tube in job_queue.get_tubes(tube_name):
+        real_tube_name = beanstalk.watch_tube(queue, tube)
+        # beanstalkd won't let us ignore the only tube we're watching
+        if watched:
+            queue.ignore(watched)
+        watched = real_tube_name
+        # This also finds the run's deferred jobs, which a check of the
+        # tube's ready jobs would miss
+        deleted = queue.delete_by_run(tube, run_name)
+        if deleted:
+            log.info("Deleted %d jobs from %s: %s", len(deleted), tube,
+                     ' '.join(map(str, deleted)))
+        else:
+            print "No jobs in Beanstalk Queue"
+    queue.close()
 
 
 def kill_processes(run_name, pids=None):
@@ -14,45 +14,88 @@ import teuthology
 from .config import config
 from . import lockstatus as ls
 from . import misc
+from .contextutil import safe_while
 from teuthology.misc import get_distro
 from teuthology.misc import get_distro_version
 
 log = logging.getLogger(__name__)
 
+# Per-process cache of the lock server's machine type metadata; see
+# get_machine_types()
+_machine_types = None
+# What a lock server that predates bulk requests answers them with: web.py's
+# 405 Method Not Allowed, or 501 Not Implemented from a proxy
+BULK_UNSUPPORTED = (405, 501)
 
-def lock_many(ctx, num, machinetype, user=None, description=None):
+
+def lock_many(ctx, num, machinetype, user=None, description=None,
+              min_free=0, wait=0, priority=None, reservation=None):
+    """
+    Lock num machines of machinetype, which may list several types, e.g.
+    'plana,mira'; the lock server tries them in order and locks all num
+    machines from the first type with enough free.
+
+    :param min_free:    Optional. Only lock machines of a type if at least
+                        this many of them are free
+    :param wait:        Optional. How many seconds the lock server should
+                        wait for enough machines to be free, if they aren't
+                        yet
+    :param priority:    Optional. Where to queue up while waiting; lower is
+                        sooner, as with teuthology-schedule
+    :param reservation: Optional. A dict to keep the request's place in the
+                        lock server's queue in between calls. If the wait
+                        times out, its 'reservation' is set, for the next
+                        call to pass on, along with its 'position' in the
+                        queue.
+    :returns:           A dict mapping the names of the locked machines to
+                        their ssh public keys, or an empty list on failure
+    """
     machinetypes = misc.get_multi_machine_types(machinetype)
     if user is None:
         user = misc.get_user()
-    for machinetype in machinetypes:
-        success, content, status = ls.send_request(
-            'POST',
-            config.lock_server,
-            urllib.urlencode(
-                dict(
-                    user=user,
-                    num=num,
-                    machinetype=machinetype,
-                    desc=description,
-                )))
-        if success:
-            machines = json.loads(content)
-            log.debug('locked {machines}'.format(
-                machines=', '.join(machines.keys())))
-            if machinetype == 'vps':
-                ok_machs = {}
-                for machine in machines:
-                    if create_if_vm(ctx, machine):
-                        ok_machs[machine] = machines[machine]
-                    else:
-                        log.error('Unable to create virtual machine: %s' % machine)
-                        unlock_one(ctx, machine)
-                return ok_machs
-            return machines
-        if status == 503:
-            log.error('Insufficient nodes available to lock %d %s nodes.', num,machinetype)
-        else:
-            log.error('Could not lock %d %s nodes, reason: unknown.', num, machinetype)
+    params = dict(
+        user=user,
+        num=num,
+        machinetype=','.join(machinetypes),
+        desc=description,
+    )
+    if min_free:
+        params['min_free'] = min_free
+    if wait:
+        params['wait'] = wait
+    if priority is not None:
+        params['priority'] = priority
+    if reservation and reservation.get('reservation') is not None:
+        params['reservation'] = reservation['reservation']
+    success, content, status = ls.send_request(
+        'POST',
+        config.lock_server,
+        urllib.urlencode(params),
+        timeout=config.lock_server_timeout + wait)
+    if success:
+        machines = json.loads(content)
+        log.debug('locked {machines}'.format(
+            machines=', '.join(machines.keys())))
+        if 'vps' in machinetypes:
+            ok_machs = {}
+            failed = []
+            for machine in machines:
+                if not misc.is_vm(machine) or create_if_vm(ctx, machine):
+                    ok_machs[machine] = machines[machine]
+                else:
+                    log.error('Unable to create virtual machine: %s' % machine)
+                    failed.append(machine)
+            unlock_many(ctx, failed)
+            return ok_machs
+        return machines
+    if status == 503:
+        log.error('Insufficient nodes available to lock %d %s nodes.', num,
+                  machinetype)
+        if content and reservation is not None:
+            reservation.update(json.loads(content))
+    else:
+        log.error('Could not lock %d %s nodes, reason: unknown.', num,
+                  machinetype)
     return []
 
 
@@ -91,13 +134,182 @@ def unlock_one(ctx, name, user=None):
     return success
 
 
-def list_locks():
-    success, content, _ = ls.send_request('GET', config.lock_server)
+def list_locks(machine_type=None, up=None, locked=None, locked_by=None,
+               description=None, description_like=None, fields=None):
+    """
+    List the machines the lock server knows about, or just those matching
+    the given filters. Lock servers that predate a filter ignore it, so
+    callers that need exact results should check what they get back.
+
+    :param machine_type:     Optional. A machine type, e.g. 'plana'
+    :param up:               Optional. True or False
+    :param locked:           Optional. True or False
+    :param locked_by:        Optional. The owner of the locks
+    :param description:      Optional. The exact lock description
+    :param description_like: Optional. A substring of the lock description
+    :param fields:           Optional. A list of the fields to return for
+                             each machine; by default, all of them
+    :returns:                A list of dicts, or None if the lock server
+                             could not be queried
+    """
+    params = dict(machinetype=machine_type, locked_by=locked_by,
+                  description=description, description_like=description_like)
+    for name, value in (('up', up), ('locked', locked)):
+        if value is not None:
+            params[name] = 'true' if value else 'false'
+    if fields:
+        params['fields'] = ','.join(fields)
+    params = sorted([(name, value) for (name, value) in params.items()
+                     if value is not None])
+    uri = config.lock_server
+    if params:
+        uri += '?' + urllib.urlencode(params)
+    success, content, _ = ls.send_conditional_get(uri)
     if success:
         return json.loads(content)
     return None
 
 
+def get_machine_types(refresh=False):
+    """
+    Query the lock server for per-type machine metadata. The result is cached
+    for the lifetime of the process; pass refresh=True when current counts are
+    needed.
+
+    :param refresh: Ignore the cached result and query the lock server
+    :returns:       A dict like:
+                    {'plana': {'arch': 'x86_64', 'count': 80, 'up': 78,
+                               'locked': 60, 'free': 18,
+                               'owners': {'user@host': {'count': 2,
+                                                        'up': 2}}}}
+                    or None if the lock server could not be queried
+    """
+    global _machine_types
+    if _machine_types is None or refresh:
+        success, content, _ = ls.send_request(
+            'GET', config.lock_server + '/types/')
+        if not success:
+            return None
+        _machine_types = json.loads(content)
+    return _machine_types
+
+
+def get_machine_type_info(machine_type, refresh=False):
+    """
+    :param machine_type: A single machine type, e.g. 'plana'
+    :param refresh:      See get_machine_types()
+    :returns:            The metadata dict for machine_type, or None
+    """
+    machine_types = get_machine_types(refresh=refresh)
+    if machine_types is None:
+        return None
+    return machine_types.get(machine_type)
+
+
+def unlock_many(ctx, names, user=None):
+    """
+    Unlock several machines with one request, falling back to one request per
+    machine if the lock server doesn't know about bulk requests. If it
+    refuses, e.g. because some of the machines aren't ours, none are
+    unlocked.
+
+    :param names: A list of machine names
+    :param user:  Optional. Who has them locked; defaults to misc.get_user()
+    :returns:     A list of the machines that are no longer locked
+    """
+    names = list(names)
+    if not names:
+        return []
+    if user is None:
+        user = misc.get_user()
+    success, _, status = ls.send_request(
+        'DELETE',
+        config.lock_server,
+        body=json.dumps(dict(user=user, names=names)),
+        headers={'Content-type': 'application/json'})
+    if not success:
+        if status in BULK_UNSUPPORTED:
+            return [name for name in names if unlock_one(ctx, name, user)]
+        log.error('Could not unlock %s (status %d)', ', '.join(names),
+                  status)
+        return []
+    log.debug('unlocked %s', ', '.join(names))
+    for name in names:
+        if misc.is_vm(name) and not destroy_if_vm(ctx, name):
+            log.error('downburst destroy failed for %s', name)
+    return names
+
+
+def update_locks(ctx, updates, user=None):
+    """
+    Update several machines' locks with one request, falling back to one
+    request per machine if the lock server doesn't know about bulk requests.
+
+    :param updates: A dict mapping machine names to dicts of what to update,
+                    with any of the keys 'description', 'status' and
+                    'sshpubkey'; as with update_lock(), None means no change
+    :param user:    Optional. If given, the update only happens if all the
+                    machines are locked by this user
+    :returns:       True if all the machines were updated
+    """
+    params = {}
+    for name, update in updates.items():
+        param = dict(desc=update.get('description'),
+                     status=update.get('status'),
+                     sshpubkey=update.get('sshpubkey'))
+        param = dict([(key, value) for (key, value) in param.items()
+                      if value is not None])
+        if param:
+            params[name] = param
+    if not params:
+        return True
+    # Virtual machines get their new keys once they have booted
+    vms = [name for name in params if misc.is_vm(name)]
+    missing = wait_for_vms(ctx, vms) if vms else []
+    if missing:
+        log.error('Not updating VMs that never answered: %s',
+                  ', '.join(missing))
+        for name in missing:
+            del params[name]
+        if not params:
+            return False
+    success, _, status = ls.send_request(
+        'PUT',
+        config.lock_server,
+        body=json.dumps(dict(user=user, updates=params)),
+        headers={'Content-type': 'application/json'})
+    if success or status not in BULK_UNSUPPORTED:
+        return success and not missing
+    return all([update_lock(ctx, name, **update)
+                for (name, update) in updates.items()
+                if name in params]) and not missing
+
+
+def wait_for_vms(ctx, vms, sleep=10, tries=60):
+    """
+    Wait for virtual machines to boot, i.e. to answer ssh-keyscan.
+
+    :param vms:   A list of machine names
+    :param sleep: How long to wait between scans, in seconds
+    :param tries: How many times to scan before giving up
+    :returns:     A list of the machines that never answered
+    """
+    missing = list(vms)
+    with safe_while(sleep=sleep, tries=tries, action='wait for VMs to boot',
+                    _raise=False) as proceed:
+        while proceed():
+            # keyscan_check() strips the user from the names it is given
+            keyscan_out, _ = keyscan_check(ctx, list(missing))
+            answered = set([line.split()[0] for line in
+                            keyscan_out.splitlines()
+                            if line and not line.startswith('#')])
+            missing = [name for name in missing
+                       if name.split('@')[-1] not in answered]
+            if not missing:
+                break
+    return missing
+
+
 def update_lock(ctx, name, description=None, status=None, sshpubkey=None):
     status_info = ls.get_status(ctx, name)
     phys_host = status_info['vpshost']
@@ -177,17 +389,31 @@ def main(ctx):
     if ctx.brief or ctx.list or ctx.list_targets:
         assert ctx.desc is None, '--desc does nothing with --list/--brief'
 
+        if not machines and ctx.owner is None and not ctx.all:
+            ctx.owner = misc.get_user()
+        # Let the lock server do most of the filtering
+        filters = dict(
+            machine_type=ctx.machine_type,
+            locked_by=ctx.owner,
+            description_like=ctx.desc_pattern,
+        )
+        if ctx.status is not None:
+            filters['up'] = (ctx.status == 'up')
+        if ctx.locked is not None:
+            filters['locked'] = (ctx.locked == 'true')
+
         if machines:
             statuses = []
+            machine_statuses = ls.get_statuses(ctx, machines)
             for machine in machines:
-                status = ls.get_status(ctx, machine)
+                status = machine_statuses[machine]
                 if status:
                     statuses.append(status)
                 else:
                     log.error("Lockserver doesn't know about machine: %s" %
                               machine)
         else:
-            statuses = list_locks()
+            statuses = list_locks(**filters)
         vmachines = []
 
         for vmachine in statuses:
@@ -199,16 +425,15 @@ def main(ctx):
             # Listing specific machines will update the keys.
             if machines:
                 scan_for_locks(ctx, vmachines)
-                statuses = [ls.get_status(ctx, machine)
+                machine_statuses = ls.get_statuses(ctx, machines)
+                statuses = [machine_statuses[machine]
                             for machine in machines]
             else:
-                statuses = list_locks()
+                statuses = list_locks(**filters)
         if statuses:
             if ctx.machine_type:
                 statuses = [_status for _status in statuses
                             if _status['type'] == ctx.machine_type]
-            if not machines and ctx.owner is None and not ctx.all:
-                ctx.owner = misc.get_user()
             if ctx.owner is not None:
                 statuses = [_status for _status in statuses
                             if _status['locked_by'] == ctx.owner]
@@ -260,13 +485,11 @@ def main(ctx):
                 machines_to_update.append(machine)
                 create_if_vm(ctx, machine)
     elif ctx.unlock:
-        for machine in machines:
-            if not unlock_one(ctx, machine, user):
-                ret = 1
-                if not ctx.f:
-                    return ret
-            else:
-                machines_to_update.append(machine)
+        machines_to_update = unlock_many(ctx, machines, user)
+        if len(machines_to_update) < len(machines):
+            ret = 1
+            if not ctx.f:
+                return ret
     elif ctx.num_to_lock:
         result = lock_many(ctx, ctx.num_to_lock, ctx.machine_type, user)
         if not result:
@@ -280,8 +503,7 @@ def main(ctx):
                 )
                 if len(result) < ctx.num_to_lock:
                     log.error("Locking failed.")
-                    for machn in result:
-                        unlock_one(ctx, machn)
+                    unlock_many(ctx, result.keys())
                     ret = 1
                 else:
                     log.info("Successfully Locked:\n%s\n" % shortnames)
@@ -303,8 +525,9 @@ def main(ctx):
         machines_to_update = machines
 
     if ctx.desc is not None or ctx.status is not None:
-        for machine in machines_to_update:
-            update_lock(ctx, machine, ctx.desc, ctx.status)
+        update_locks(ctx, dict([
+            (machine, dict(description=ctx.desc, status=ctx.status))
+            for machine in machines_to_update]))
 
     return ret
 
@@ -337,7 +560,7 @@ def updatekeys(ctx):
 
 
 def keyscan_check(ctx, machines):
-    locks = list_locks()
+    locks = list_locks(fields=['name', 'sshpubkey'])
     current_locks = {}
     for lock in locks:
         current_locks[lock['name']] = lock
@@ -361,6 +584,7 @@ def keyscan_check(ctx, machines):
 
 def update_keys(ctx, out, current_locks):
     ret = 0
+    new_keys = {}
     for key_entry in out.splitlines():
         hostname, pubkey = key_entry.split(' ', 1)
         # TODO: separate out user
@@ -369,9 +593,10 @@ def update_keys(ctx, out, current_locks):
         assert full_name in current_locks, 'host is not in the database!'
         if current_locks[full_name]['sshpubkey'] != pubkey:
             log.info('New key found. Updating...')
-            if not update_lock(ctx, full_name, sshpubkey=pubkey):
-                log.error('failed to update %s!', full_name)
-                ret = 1
+            new_keys[full_name] = dict(sshpubkey=pubkey)
+    if not update_locks(ctx, new_keys):
+        log.error('failed to update %s!', ', '.join(new_keys))
+        ret = 1
     return ret
 
 
@@ -381,14 +606,21 @@ def scan_for_locks(ctx, machines):
 
 
 def do_summary(ctx):
+    machine_types = get_machine_types(refresh=True)
+    if machine_types is None:
+        log.error('error retrieving machine types')
+        return
     lockd = collections.defaultdict(lambda: [0, 0, 'unknown'])
-    for l in list_locks():
-        if ctx.machine_type and l['type'] != ctx.machine_type:
+    for machine_type, info in machine_types.iteritems():
+        if ctx.machine_type and machine_type != ctx.machine_type:
             continue
-        who = l['locked_by'] if l['locked'] == 1 else '(free)', l['type']
-        lockd[who][0] += 1
-        lockd[who][1] += l['up']         # up is 1 or 0
-        lockd[who][2] = l['type']
+        for owner, counts in info['owners'].iteritems():
+            who = owner, machine_type
+            lockd[who] = [counts['count'], counts['up'], machine_type]
+        unlocked = info['count'] - info['locked']
+        if unlocked:
+            lockd['(free)', machine_type] = [unlocked, info['free'],
+                                             machine_type]
 
     locks = sorted([p for p in lockd.iteritems()
                     ], key=lambda sort: (sort[1][2], sort[1][0]))
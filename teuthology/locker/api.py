@@ -1,8 +1,13 @@
+import hashlib
 import json
+import re
 import web
 import subprocess
+import threading
+import time
+import uuid
 
-from config import DB
+from config import DB, KEYSCAN
 
 import logging
 log = logging.getLogger(__name__)
@@ -15,33 +20,115 @@ def load_machine(name):
         raise web.NotFound()
     return results[0]
 
-def get_sshkey(name):
-    if '@' in name:
-        _, name = name.rsplit('@')
-    args = ['ssh-keyscan']
-    args.append(name)
+def load_machines(names):
+    """
+    Like load_machine(), for several machines at once; raises NotFound
+    unless all of them exist.
+    """
+    names = list(set(names))
+    if not names:
+        return []
+    results = list(DB.select('machine', what='*',
+                             where=web.db.sqlors('name = ', names)))
+    if len(results) != len(names):
+        raise web.NotFound()
+    return results
+
+
+def load_json_body():
+    try:
+        request = json.loads(web.data())
+    except ValueError:
+        raise web.BadRequest()
+    if not isinstance(request, dict):
+        raise web.BadRequest()
+    return request
+
+
+def get_machine_updates(params):
+    """
+    :param params: A dict with any of 'desc', 'status' and 'sshpubkey'
+    :returns:      A dict of the columns to update
+    """
+    updated = {}
+    if params.get('desc') is not None:
+        updated['description'] = params['desc']
+    if params.get('status') is not None:
+        updated['up'] = (params['status'] == 'up')
+    if params.get('sshpubkey') is not None:
+        updated['sshpubkey'] = params['sshpubkey']
+    if not updated:
+        raise web.BadRequest()
+    return updated
+
+
+# How long ssh-keyscan waits for each host, in seconds
+KEYSCAN_TIMEOUT = 5
+
+# The longest Lock.POST will wait for machines to be free, and how often a
+# waiting request checks for machines unlocked by other server processes
+MAX_WAIT = 300
+WAIT_POLL_INTERVAL = 5
+# How many requests may wait at once in this process. Each one keeps one of
+# the server's threads (web.py's own server has 10) busy while it waits, so
+# the rest are left for everything else; requests beyond this join the queue
+# but are answered right away.
+MAX_WAITERS = 4
+
+# Waiting requests renew their reservations at least this often; a
+# reservation that isn't renewed for RESERVATION_TIMEOUT has been abandoned
+RESERVATION_TIMEOUT = 2 * MAX_WAIT
+# The priority of requests that don't give one: teuthology-schedule's default
+DEFAULT_PRIORITY = 1000
+
+# Notified whenever this process unlocks machines or marks them up
+machines_freed = threading.Condition()
+waiters = threading.Semaphore(MAX_WAITERS)
+
+
+def notify_machines_freed():
+    with machines_freed:
+        machines_freed.notify_all()
+
+
+def wait_for_machines_freed(timeout):
+    with machines_freed:
+        machines_freed.wait(timeout)
+
+
+def get_sshkeys(names):
+    """
+    Scan the ssh host keys of several machines at once. A single ssh-keyscan
+    talks to all of them in parallel, so this takes about as long as the
+    slowest host rather than the sum of them all.
+
+    :param names: A list of machine names, optionally prefixed with 'user@'
+    :returns:     A dict mapping each name that answered to its public key
+    """
+    hosts = dict()
+    for name in names:
+        host = name
+        if '@' in host:
+            _, host = host.rsplit('@', 1)
+        hosts[host] = name
+    if not hosts or not KEYSCAN:
+        return {}
+    args = ['ssh-keyscan', '-T', str(KEYSCAN_TIMEOUT)]
+    args.extend(hosts.keys())
     p = subprocess.Popen(
         args=args,
         stdout=subprocess.PIPE,
         )
     out, _ = p.communicate()
-    pubkey = None
+    keys = {}
     for key_entry in out.splitlines():
+        if not key_entry or key_entry.startswith('#'):
+            continue
         hostname, pubkey = key_entry.split(' ', 1)
-    if not pubkey:
-        status = 1
-    else:
-        status = 0
-    return (pubkey), status
-
-def update_sshkey(name, key, type):
-    if type == 'vps':
-        return
-    res = DB.update('machine', where='name = $name AND locked = false',
-                    vars=dict(name=name),
-                    sshpubkey=key,)
-    assert res == 1, 'Failed to update key of machine {name}'.format(name=name)
-    print 'Updated key on ', name
+        if hostname in hosts:
+            # As before, the last key listed for a host wins
+            keys[hosts[hostname]] = pubkey
+    return keys
 
 class MachineLock:
     def GET(self, name):
@@ -64,6 +151,7 @@ class MachineLock:
                         locked=False, locked_by=None, description=None)
         assert res == 1, 'Failed to unlock machine {name}'.format(name=name)
         print user, 'unlocked', name
+        notify_machines_freed()
 
     def POST(self, name):
         user = web.input('user')['user']
@@ -73,128 +161,549 @@ class MachineLock:
             raise web.Forbidden()
 
         if machine.type == 'vps':
-            curkey = machine.sshpubkey
-        else:
-            curkey, getstatus = get_sshkey(name)
-            if getstatus != 0:
-                curkey = machine.sshpubkey
-        if machine.sshpubkey != curkey:
-            newkey = curkey
-        else:
             newkey = machine.sshpubkey
+        else:
+            newkey = get_sshkeys([name]).get(name) or machine.sshpubkey
         res = DB.update('machine', where='name = $name AND locked = false',
                         vars=dict(name=name),
                         locked=True,
                         description=desc,
                         sshpubkey=newkey,
                         locked_by=user,
-                        locked_since=web.db.SQLLiteral('NOW()'))
+                        locked_since=web.db.SQLLiteral('CURRENT_TIMESTAMP'))
         assert res == 1, 'Failed to lock machine {name}'.format(name=name)
         print user, 'locked single machine', name, 'desc', desc
 
     def PUT(self, name):
-        desc = web.input(desc=None)['desc']
-        status = web.input(status=None)['status']
-        sshpubkey = web.input(sshpubkey=None)['sshpubkey']
-
-        updated = {}
-        if desc is not None:
-            updated['description'] = desc
-        if status is not None:
-            updated['up'] = (status == 'up')
-        if sshpubkey is not None:
-            updated['sshpubkey'] = sshpubkey
-
-        if not updated:
-            raise web.BadRequest()
+        params = web.input(desc=None, status=None, sshpubkey=None)
+        desc = params.desc
+        updated = get_machine_updates(params)
         DB.update('machine', where='name = $name',
                   vars=dict(name=name), **updated)
         print 'updated', name, 'with', updated, 'desc', desc
+        if updated.get('up'):
+            notify_machines_freed()
+
+class MachineTypes:
+    def GET(self):
+        """
+        Return per-type metadata without shipping every machine row: the
+        architecture of each type, counts of machines that are up, locked
+        and free, and a per-owner breakdown of the locked machines. Both
+        queries are answered from indexes (see schema.py) without reading
+        the table.
+        """
+        types = {}
+        rows = DB.query(
+            'SELECT type, MIN(arch) AS arch, COUNT(*) AS count, '
+            'SUM(CASE WHEN up THEN 1 ELSE 0 END) AS up, '
+            'SUM(CASE WHEN locked THEN 1 ELSE 0 END) AS locked, '
+            'SUM(CASE WHEN up AND NOT locked THEN 1 ELSE 0 END) AS free '
+            'FROM machine GROUP BY type')
+        for row in rows:
+            types[row.type] = dict(
+                arch=row.arch,
+                count=int(row.count),
+                up=int(row.up or 0),
+                locked=int(row.locked or 0),
+                free=int(row.free or 0),
+                owners={},
+            )
+        rows = DB.query(
+            'SELECT type, locked_by, COUNT(*) AS count, '
+            'SUM(CASE WHEN up THEN 1 ELSE 0 END) AS up '
+            'FROM machine WHERE locked = true GROUP BY type, locked_by')
+        for row in rows:
+            types[row.type]['owners'][row.locked_by] = dict(
+                count=int(row.count),
+                up=int(row.up or 0),
+            )
+        web.header('Content-type', 'text/json')
+        return json.dumps(types)
+
+# The columns Lock.GET may be asked to return with fields=
+MACHINE_FIELDS = ('name', 'type', 'arch', 'up', 'locked', 'locked_since',
+                  'locked_by', 'description', 'sshpubkey', 'vpshost')
+
+
+def parse_bool(value):
+    if value.lower() in ('true', '1', 'yes'):
+        return True
+    if value.lower() in ('false', '0', 'no'):
+        return False
+    raise web.BadRequest()
+
+
+def escape_like(value):
+    for char in ('\\', '%', '_'):
+        value = value.replace(char, '\\' + char)
+    return value
+
+
+def build_machine_filters(params):
+    """
+    Turn Lock.GET's query parameters into a WHERE clause.
+
+    :param params: The web.input() of the request
+    :returns:      A tuple: (where, vars), where is None if there are no
+                   filters
+    """
+    where = []
+    sql_vars = {}
+    for param, column in (('machinetype', 'type'), ('locked_by', 'locked_by'),
+                          ('description', 'description')):
+        if params.get(param) is not None:
+            where.append('{column} = ${param}'.format(column=column,
+                                                       param=param))
+            sql_vars[param] = params[param]
+    for param in ('up', 'locked'):
+        if params.get(param) is not None:
+            where.append('{param} = ${param}'.format(param=param))
+            sql_vars[param] = parse_bool(params[param])
+    if params.get('names') is not None:
+        names = [name for name in params['names'].split(',') if name]
+        if not names:
+            raise web.BadRequest()
+        placeholders = []
+        for i, name in enumerate(names):
+            sql_vars['name%d' % i] = name
+            placeholders.append('$name%d' % i)
+        where.append('name IN ({names})'.format(names=', '.join(placeholders)))
+    if params.get('description_like') is not None:
+        where.append('description LIKE $description_like')
+        sql_vars['description_like'] = \
+            '%' + escape_like(params['description_like']) + '%'
+    if not where:
+        return None, sql_vars
+    return ' AND '.join(where), sql_vars
+
+
+def split_machine_types(machinetype):
+    """
+    :param machinetype: One or more machine types, separated by commas or
+                        whitespace, e.g. 'plana,mira'
+    :returns:           A list of the machine types
+    """
+    return [t for t in re.split(r'[,\s]+', machinetype) if t]
+
+
+def claim_machines(machinetype, num, user, desc, min_free=0, held=0):
+    """
+    Lock num free machines of one type, atomically.
+
+    A single UPDATE both picks the machines and locks them, so concurrent
+    requests can't pick the same ones and have to start over: the database
+    makes each wait for the rows the other is locking, then move on to
+    different ones. So that we can tell which rows our UPDATE changed, it
+    marks them with a unique token in place of their description, which is
+    set before the transaction commits.
+
+    :param min_free: Optional. Only lock the machines if at least this many
+                     are free
+    :param held:     Optional. How many of the free machines are held back
+                     for requests ahead of this one; they don't count as
+                     free
+    :returns:        A list of the locked machines' rows, with their name,
+                     sshpubkey and type, or None if fewer than num, or
+                     min_free, of them were free
+    """
+    token = 'claim-' + uuid.uuid4().hex
+    sql_vars = dict(machinetype=machinetype, num=num, user=user, token=token,
+                    desc=desc)
+    free = 'locked = false AND up = true AND type = $machinetype'
+    update = ('UPDATE machine SET locked = true, locked_by = $user, '
+              'description = $token, locked_since = CURRENT_TIMESTAMP WHERE ')
+    if DB.dbname == 'mysql':
+        # MySQL can limit an UPDATE, but not a subquery of one
+        query = update + free + ' ORDER BY name LIMIT $num'
+    else:
+        query = (update + 'name IN (SELECT name FROM machine WHERE ' + free +
+                 ' ORDER BY name LIMIT $num')
+        if DB.dbname == 'postgres':
+            # Rather than wait for rows another request is locking, take
+            # the next free ones
+            query += ' FOR UPDATE SKIP LOCKED'
+        query += ')'
+    needed = max(num, min_free) + held
+    t = DB.transaction()
+    try:
+        if needed > num:
+            rows = DB.select('machine', sql_vars, what='COUNT(*) AS count',
+                             where=free)
+            if rows[0].count < needed:
+                t.rollback()
+                return None
+        num_locked = DB.query(query, vars=sql_vars)
+        if num_locked < num:
+            t.rollback()
+            return None
+        results = list(DB.select('machine', sql_vars,
+                                 what='name, sshpubkey, type',
+                                 where='description = $token'))
+        DB.update('machine', where='description = $token', vars=sql_vars,
+                  description=desc)
+    except Exception:
+        t.rollback()
+        raise
+    else:
+        t.commit()
+    return results
+
+
+def create_reservation(user, machinetypes, num, priority, min_free=0):
+    """
+    Join the queue of requests waiting for machines.
+
+    :returns: The new reservation's id
+    """
+    now = time.time()
+    return DB.insert('reservation', owner=user,
+                     machinetypes=','.join(machinetypes), num=num,
+                     min_free=min_free, priority=priority, created=now,
+                     updated=now)
+
+
+def renew_reservation(reservation_id, user):
+    """
+    Keep a reservation from expiring, and forget about those that have.
+
+    :returns: True if the reservation is still in the queue
+    """
+    now = time.time()
+    DB.delete('reservation', where='updated < $cutoff',
+              vars=dict(cutoff=now - RESERVATION_TIMEOUT))
+    return DB.update('reservation', where='id = $id AND owner = $user',
+                     vars=dict(id=reservation_id, user=user),
+                     updated=now) == 1
+
+
+def get_reservations_ahead(priority, reservation_id=None):
+    """
+    Find the reservations that get machines before a request: those with a
+    higher priority, i.e. a lower number, and those with the same priority
+    that joined the queue earlier.
+
+    :param priority:       The request's priority
+    :param reservation_id: Optional. The request's reservation, if it has one;
+                           otherwise it is behind every reservation of its
+                           priority
+    :returns:              A list of the reservations ahead, first in line
+                           first, each with the list of machinetypes it is
+                           waiting for, the num of machines it wants and its
+                           min_free
+    """
+    sql_vars = dict(priority=priority, id=reservation_id,
+                    cutoff=time.time() - RESERVATION_TIMEOUT)
+    if reservation_id is None:
+        ahead = 'priority <= $priority'
+    else:
+        ahead = 'priority < $priority OR (priority = $priority AND id < $id)'
+    rows = list(DB.select('reservation', sql_vars,
+                          what='machinetypes, num, min_free',
+                          where='updated >= $cutoff AND (' + ahead + ')',
+                          order='priority, id'))
+    for row in rows:
+        row.machinetypes = split_machine_types(row.machinetypes)
+    return rows
+
+
+def count_free_machines(machinetypes):
+    """
+    :returns: A dict mapping each of machinetypes to how many machines of
+              that type are up and not locked
+    """
+    free = dict([(machinetype, 0) for machinetype in machinetypes])
+    where = web.db.sqlors('type = ', machinetypes) + \
+        ' AND locked = false AND up = true'
+    rows = DB.select('machine', what='type, COUNT(*) AS count', where=where,
+                     group='type')
+    for row in rows:
+        free[row.type] = int(row.count)
+    return free
+
+
+def get_held_machines(ahead, free):
+    """
+    Work out how many free machines of each type are held back for the
+    reservations ahead of a request. The first of them in line for a type
+    holds back as many machines as it wants; the rest have to wait for it
+    anyway. A reservation that could have the machines it wants, and is only
+    waiting until min_free of them are free, holds none back, since the
+    point of min_free is to leave machines for others.
+
+    :param ahead: The reservations ahead, from get_reservations_ahead()
+    :param free:  A dict mapping machine types to how many are free, from
+                  count_free_machines()
+    :returns:     A dict mapping machine types to how many of their free
+                  machines are held back
+    """
+    held = dict()
+    for reservation in ahead:
+        for machinetype in reservation.machinetypes:
+            if machinetype in held:
+                continue
+            if reservation.num <= free.get(machinetype, 0) < \
+                    reservation.min_free:
+                continue
+            held[machinetype] = reservation.num
+    return held
+
+
+def claim_any_machines(machinetypes, num, user, desc, min_free=0,
+                       held=None):
+    """
+    Call claim_machines() for each machine type in turn, until one succeeds.
+
+    :param held: Optional. A dict from get_held_machines()
+    """
+    held = held or dict()
+    for machinetype in machinetypes:
+        results = claim_machines(machinetype, num, user, desc, min_free,
+                                 held.get(machinetype, 0))
+        if results is not None:
+            return results
+    return None
+
 
 class Lock:
     def GET(self):
-        rows = list(DB.select('machine', what='*'))
-        if not rows:
+        """
+        List machines. Any of these query parameters narrow the list down:
+        names, a comma-separated list of machine names, machinetype, up,
+        locked, locked_by, description, and description_like, which matches a
+        substring of the description.
+        fields, a comma-separated list of columns, limits what is returned
+        for each machine.
+
+        The response carries an ETag; a request whose If-None-Match matches
+        it gets an empty 304 Not Modified instead.
+        """
+        params = web.input(names=None, machinetype=None, up=None, locked=None,
+                           locked_by=None, description=None,
+                           description_like=None, fields=None)
+        what = '*'
+        if params.fields:
+            fields = params.fields.split(',')
+            if not all([field in MACHINE_FIELDS for field in fields]):
+                raise web.BadRequest()
+            what = ', '.join(fields)
+        where, sql_vars = build_machine_filters(params)
+        rows = list(DB.select('machine', what=what, where=where,
+                              vars=sql_vars, order='name'))
+        if not rows and where is None:
             raise web.NotFound()
         for row in rows:
-            row.locked_since = row.locked_since.isoformat()
+            if row.get('locked_since') is not None:
+                row.locked_since = row.locked_since.isoformat()
+        body = json.dumps(rows)
+        etag = '"{0}"'.format(hashlib.sha1(body).hexdigest())
+        web.header('ETag', etag)
+        if web.ctx.env.get('HTTP_IF_NONE_MATCH') == etag:
+            raise web.NotModified()
         web.header('Content-type', 'text/json')
-        return json.dumps(rows)
+        return body
 
     def POST(self):
+        """
+        Lock num machines of machinetype. machinetype may list several types,
+        separated by commas or whitespace; they are tried in order, and all
+        the machines come from the first one with enough free.
+
+        With min_free, only lock machines of a type if at least that many of
+        them are free, leaving some for others. With wait, a number of
+        seconds up to MAX_WAIT, wait that long for enough machines to be
+        free instead of failing right away; they are locked as soon as they
+        are.
+
+        Requests that wait queue up for machines, ordered by priority (lower
+        is sooner, as with teuthology-schedule) and then by when they joined
+        the queue. The first request in line for a type holds back as many
+        of its free machines as it wants, so those behind it may only lock
+        the rest; unless it is only waiting for min_free machines to be
+        free, in which case it holds none back.
+        If the wait times out, the 503 response carries a JSON object with
+        the request's 'reservation' and its 'position' in the queue. Passing
+        reservation back with the next request keeps its place, for up to
+        RESERVATION_TIMEOUT. Once MAX_WAITERS requests are waiting, others
+        get that response right away instead.
+        """
         user = web.input('user')['user']
         desc = web.input(desc=None)['desc']
-        num = int(web.input('num')['num'])
-        machinetype = dict(machinetype=(web.input(machinetype='plana')['machinetype']))
+        params = web.input(min_free=0, wait=0, priority=DEFAULT_PRIORITY,
+                           reservation=None)
+        try:
+            num = int(web.input('num')['num'])
+            min_free = int(params.min_free)
+            wait = min(float(params.wait), MAX_WAIT)
+            priority = int(params.priority)
+            reservation_id = params.reservation
+            if reservation_id is not None:
+                reservation_id = int(reservation_id)
+        except ValueError:
+            raise web.BadRequest()
+        machinetypes = split_machine_types(
+            web.input(machinetype='plana')['machinetype'])
 
-        if num < 1:
+        if num < 1 or not machinetypes:
             raise web.BadRequest()
 
-        tries = 0
-        check_existing = True
-        while True:
-            try:
-                # transaction will be rolled back if an exception is raised
-                with DB.transaction():
-                    if desc is not None and check_existing:
-                        # if a description is provided, treat it as a
-                        # key for locking in case the same run locked
-                        # machines in the db successfully before, but
-                        # the web server reported failure to it
-                        # because the request took too long. Only try
-                        # this once per request.
-                        check_existing = False
-                        results = list(DB.select('machine',
-                                                 machinetype, desc, user,
-                                                 what='name, sshpubkey',
-                                                 where='locked = true AND up = true AND type = $machinetype AND description = $desc AND locked_by = $user',
-                                                 limit=num))
-                        if len(results) == num:
-                            name_keys = {}
-                            for row in results:
-                                name_keys[row.name] = row.sshpubkey
-                            print 'reusing machines', name_keys.keys()
-                            break
-
-                    results = list(DB.select('machine', machinetype,
-                                             what='name, sshpubkey, type',
-                                             where='locked = false AND up = true AND type = $machinetype',
-                                             limit=num))
-                    if len(results) < num:
-                        raise web.HTTPError(status='503 Service Unavailable')
+        if desc is not None:
+            # if a description is provided, treat it as a key for locking in
+            # case the same run locked machines in the db successfully
+            # before, but the web server reported failure to it because the
+            # request took too long.
+            for machinetype in machinetypes:
+                results = list(DB.select('machine',
+                                         dict(machinetype=machinetype,
+                                              desc=desc, user=user),
+                                         what='name, sshpubkey',
+                                         where='locked = true AND up = true AND type = $machinetype AND description = $desc AND locked_by = $user',
+                                         limit=num))
+                if len(results) == num:
                     name_keys = {}
                     for row in results:
-                        if row.type == 'vps':
-                            curkey = row.sshpubkey
-                        else:
-                            curkey, getstatus = get_sshkey(row.name)
-                            if getstatus != 0:
-                                curkey = row.sshpubkey
-                        if row.sshpubkey != curkey:
-                            newkey = curkey
-                            update_sshkey(row.name, curkey, row.type)
-                        else:
-                            newkey = row.sshpubkey
-                        name_keys[row.name] = newkey
-                    where_cond = web.db.sqlors('name = ', name_keys.keys()) \
-                        + ' AND locked = false AND up = true'
-                    num_locked = DB.update('machine',
-                                           where=where_cond,
-                                           locked=True,
-                                           locked_by=user,
-                                           description=desc,
-                                           locked_since=web.db.SQLLiteral('NOW()'))
-                    assert num_locked == num, 'Failed to lock machines'
-            except Exception:
-                log.exception("Saw exception")
-                tries += 1
-                if tries < 10:
-                    continue
-                raise
-            else:
-                break
+                        name_keys[row.name] = row.sshpubkey
+                    print 'reusing machines', name_keys.keys()
+                    web.header('Content-type', 'text/json')
+                    return json.dumps(name_keys)
+
+        if reservation_id is not None and \
+                not renew_reservation(reservation_id, user):
+            # It expired; start over at the back of the queue
+            reservation_id = None
+        deadline = time.time() + wait
+        waiting = False
+        try:
+            while True:
+                ahead = get_reservations_ahead(priority, reservation_id)
+                free = count_free_machines(machinetypes)
+                held = get_held_machines(ahead, free)
+                # Only try to lock machines of the types that have enough
+                # free, rather than run an UPDATE that's bound to fail
+                results = claim_any_machines(
+                    [t for t in machinetypes
+                     if free[t] - held.get(t, 0) >= max(num, min_free)],
+                    num, user, desc, min_free, held)
+                if results is not None or time.time() >= deadline:
+                    break
+                if reservation_id is None:
+                    reservation_id = create_reservation(user, machinetypes,
+                                                        num, priority,
+                                                        min_free)
+                else:
+                    renew_reservation(reservation_id, user)
+                if not waiting:
+                    waiting = waiters.acquire(False)
+                    if not waiting:
+                        # Too many requests are waiting already; keep our
+                        # place in the queue and let the client ask again
+                        break
+                wait_for_machines_freed(min(deadline - time.time(),
+                                            WAIT_POLL_INTERVAL))
+        finally:
+            if waiting:
+                waiters.release()
+        if results is None:
+            if reservation_id is None:
+                raise web.HTTPError(status='503 Service Unavailable')
+            position = 1 + len([
+                reservation for reservation in ahead
+                if set(reservation.machinetypes) & set(machinetypes)])
+            raise web.HTTPError(
+                status='503 Service Unavailable',
+                headers={'Content-type': 'text/json'},
+                data=json.dumps(dict(reservation=reservation_id,
+                                     position=position)))
+        if reservation_id is not None:
+            DB.delete('reservation', where='id = $id',
+                      vars=dict(id=reservation_id))
+
+        # The machines are ours now, so their keys can be scanned without
+        # holding up anyone else
+        scanned = get_sshkeys([row.name for row in results
+                               if row.type != 'vps'])
+        name_keys = {}
+        for row in results:
+            name_keys[row.name] = scanned.get(row.name) or row.sshpubkey
+            if name_keys[row.name] != row.sshpubkey:
+                DB.update('machine', where='name = $name',
+                          vars=dict(name=row.name),
+                          sshpubkey=name_keys[row.name])
 
         print user, 'locked', name_keys.keys(), 'desc', desc
 
         web.header('Content-type', 'text/json')
         return json.dumps(name_keys)
+
+    def DELETE(self):
+        """
+        Unlock several machines at once. The request body is a JSON object
+        with the 'user' who has them locked and a list of their 'names'.
+        Either all of them are unlocked, or, if any doesn't exist (404) or is
+        locked by someone else (403), none are. Machines that aren't locked
+        are left alone.
+
+        Returns a JSON list of the machines that were unlocked.
+        """
+        request = load_json_body()
+        user = request.get('user')
+        names = request.get('names')
+        if not user or not isinstance(names, list):
+            raise web.BadRequest()
+        with DB.transaction():
+            machines = load_machines(names)
+            if any([machine.locked and machine.locked_by != user
+                    for machine in machines]):
+                raise web.Forbidden()
+            names = [machine.name for machine in machines if machine.locked]
+            if names:
+                where = web.db.sqlors('name = ', names) + \
+                    web.db.reparam(' AND locked = true AND locked_by = $user',
+                                   dict(user=user))
+                res = DB.update('machine', where=where,
+                                locked=False, locked_by=None,
+                                description=None)
+                assert res == len(names), 'Failed to unlock machines'
+        print user, 'unlocked', names
+        if names:
+            notify_machines_freed()
+
+        web.header('Content-type', 'text/json')
+        return json.dumps(names)
+
+    def PUT(self):
+        """
+        Update several machines at once. The request body is a JSON object
+        whose 'updates' map machine names to what to change about each, any
+        of 'desc', 'status' ('up' or 'down') and 'sshpubkey', as with
+        MachineLock.PUT. With a 'user', all the machines must be locked by
+        them (or 403); either way all of them must exist (or 404). Nothing is
+        changed unless everything can be.
+
+        Returns a JSON list of the machines that were updated.
+        """
+        request = load_json_body()
+        user = request.get('user')
+        updates = request.get('updates')
+        if not isinstance(updates, dict) or not updates:
+            raise web.BadRequest()
+        columns = {}
+        for name, update in updates.items():
+            if not isinstance(update, dict):
+                raise web.BadRequest()
+            columns[name] = get_machine_updates(update)
+        with DB.transaction():
+            machines = load_machines(columns.keys())
+            if user is not None and any([
+                    not machine.locked or machine.locked_by != user
+                    for machine in machines]):
+                raise web.Forbidden()
+            for name, updated in columns.items():
+                DB.update('machine', where='name = $name',
+                          vars=dict(name=name), **updated)
+        print 'updated', columns
+        if any([updated.get('up') for updated in columns.values()]):
+            notify_machines_freed()
+
+        web.header('Content-type', 'text/json')
+        return json.dumps(sorted(columns.keys()))
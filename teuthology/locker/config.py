@@ -6,6 +6,7 @@ The schema can be created with::
     CREATE TABLE machine (
         name varchar(255),
         type enum('burnupi','plana','vps') NOT NULL DEFAULT 'plana',
+        arch varchar(16),
         up boolean NOT NULL,
         locked boolean NOT NULL,
         locked_since timestamp NOT NULL DEFAULT '0000-00-00T00:00:00',
@@ -13,13 +14,50 @@ The schema can be created with::
         description text,
         sshpubkey text NOT NULL,
         PRIMARY KEY (name),
-        INDEX (locked),
-        INDEX (up));
+        INDEX machine_state (type, locked, up, arch),
+        INDEX machine_locks (locked, type, locked_by, up),
+        INDEX machine_description (description(255)),
+        INDEX machine_locked_by (locked_by));
+
+    CREATE TABLE reservation (
+        id integer NOT NULL AUTO_INCREMENT,
+        owner varchar(64) NOT NULL,
+        machinetypes varchar(255) NOT NULL,
+        num integer NOT NULL,
+        min_free integer NOT NULL DEFAULT 0,
+        priority integer NOT NULL,
+        created double NOT NULL,
+        updated double NOT NULL,
+        PRIMARY KEY (id),
+        INDEX reservation_order (priority, id));
+
+To add any tables and indexes an existing database is missing, e.g. after
+upgrading, run schema.py.
 
 If using MySQL, be sure to use an engine that supports
 transactions, like InnoDB.
+
+With TEUTHOLOGY_LOCKER_SQLITE set, SQLite is used instead, and the tables are
+created automatically; see schema.py.
 """
+import os
 import web
 
-# Change these values to the connection info for your database.
-DB = web.database(dbn='dbms', db='db', user='user', pw='password', host='host')
+import schema
+
+# To run the lock server without a database server, e.g. for testing, set
+# TEUTHOLOGY_LOCKER_SQLITE to the path of a SQLite database. It is created,
+# with no machines in it, if it doesn't exist.
+SQLITE_PATH = os.environ.get('TEUTHOLOGY_LOCKER_SQLITE')
+
+# Set TEUTHOLOGY_LOCKER_KEYSCAN=0 to not scan the ssh host keys of machines
+# being locked, e.g. when they don't really exist.
+KEYSCAN = os.environ.get('TEUTHOLOGY_LOCKER_KEYSCAN', '1') != '0'
+
+if SQLITE_PATH:
+    DB = web.database(dbn='sqlite', db=SQLITE_PATH, timeout=60)
+    schema.create_sqlite(DB)
+else:
+    # Change these values to the connection info for your database.
+    DB = web.database(dbn='dbms', db='db', user='user', pw='password',
+                      host='host')
@@ -8,12 +8,20 @@ abspath = os.path.dirname(__file__)
 if abspath not in sys.path:
     sys.path.append(abspath)
 
-from api import Lock, MachineLock # noqa
+from api import Lock, MachineLock, MachineTypes # noqa
 
 urls = (
     '/lock', 'Lock',
+    '/lock/types/?', 'MachineTypes',
     '/lock/(.*)', 'MachineLock',
     )
 
 app = web.application(urls, globals())
 application = app.wsgifunc()
+
+if __name__ == '__main__':
+    # Serve on the address given as the first argument, e.g. 127.0.0.1:8080,
+    # without reloading changed modules or showing debugging pages
+    web.config.debug = False
+    app = web.application(urls, globals(), autoreload=False)
+    app.run()
@@ -0,0 +1,173 @@
+"""
+The lock server's tables and indexes.
+
+SQLite databases are set up by the lock server itself. A MySQL or PostgreSQL
+database's tables are created by hand (see config.py); to add any tables and
+indexes it is missing, e.g. after upgrading, run::
+
+    python teuthology/locker/schema.py
+
+with the same environment the lock server runs in.
+"""
+import os
+import sys
+
+SQLITE_SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS machine (
+        name TEXT NOT NULL PRIMARY KEY,
+        type TEXT NOT NULL DEFAULT 'plana',
+        arch TEXT,
+        up BOOLEAN NOT NULL,
+        locked BOOLEAN NOT NULL,
+        locked_since TIMESTAMP NOT NULL DEFAULT '1970-01-01 00:00:00',
+        locked_by TEXT,
+        description TEXT,
+        sshpubkey TEXT NOT NULL DEFAULT '',
+        vpshost TEXT,
+        mac TEXT
+    )""",
+]
+
+# (name, {database: statement}) of each table added since the machine table,
+# which migrate() creates if it is missing
+TABLES = [
+    ('reservation', dict(
+        sqlite="""CREATE TABLE reservation (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            owner TEXT NOT NULL,
+            machinetypes TEXT NOT NULL,
+            num INTEGER NOT NULL,
+            min_free INTEGER NOT NULL DEFAULT 0,
+            priority INTEGER NOT NULL,
+            created REAL NOT NULL,
+            updated REAL NOT NULL
+        )""",
+        mysql="""CREATE TABLE reservation (
+            id integer NOT NULL AUTO_INCREMENT,
+            owner varchar(64) NOT NULL,
+            machinetypes varchar(255) NOT NULL,
+            num integer NOT NULL,
+            min_free integer NOT NULL DEFAULT 0,
+            priority integer NOT NULL,
+            created double NOT NULL,
+            updated double NOT NULL,
+            PRIMARY KEY (id)
+        )""",
+        postgres="""CREATE TABLE reservation (
+            id serial PRIMARY KEY,
+            owner varchar(64) NOT NULL,
+            machinetypes varchar(255) NOT NULL,
+            num integer NOT NULL,
+            min_free integer NOT NULL DEFAULT 0,
+            priority integer NOT NULL,
+            created double precision NOT NULL,
+            updated double precision NOT NULL
+        )""",
+    )),
+]
+
+# (name, table, columns) of each index the lock server's queries rely on.
+# Lookups by machine name use the primary key.
+INDEXES = [
+    # Finding free machines of a type to lock, listing machines by type, and
+    # counting each type's machines by state without reading the table
+    ('machine_state', 'machine', ('type', 'locked', 'up', 'arch')),
+    # Summing up the locked machines by type and owner without reading the
+    # table
+    ('machine_locks', 'machine', ('locked', 'type', 'locked_by', 'up')),
+    # Finding the machines a run already locked, the machines a request just
+    # claimed, and listing machines by description
+    ('machine_description', 'machine', ('description',)),
+    # Listing machines by owner
+    ('machine_locked_by', 'machine', ('locked_by',)),
+    # Finding the reservations ahead of a request
+    ('reservation_order', 'reservation', ('priority', 'id')),
+]
+
+# MySQL can only index the start of TEXT columns
+MYSQL_PREFIXES = dict(description=255)
+
+
+def create_sqlite(db):
+    """
+    Create the lock server's tables and indexes in a SQLite database, if
+    they don't exist yet.
+
+    :param db: A web.database(dbn='sqlite', ...)
+    """
+    # Let readers carry on while a request is locking machines
+    db.query("PRAGMA journal_mode = WAL")
+    for statement in SQLITE_SCHEMA:
+        db.query(statement)
+    migrate(db)
+
+
+def get_tables(db):
+    """
+    :returns: A set of the names of a database's tables
+    """
+    if db.dbname == 'mysql':
+        rows = db.query('SHOW TABLES')
+        return set([row.values()[0] for row in rows])
+    if db.dbname == 'postgres':
+        rows = db.query('SELECT tablename FROM pg_tables '
+                        'WHERE schemaname = current_schema()')
+        return set([row.tablename for row in rows])
+    rows = db.query("SELECT name FROM sqlite_master WHERE type = 'table'")
+    return set([row.name for row in rows])
+
+
+def get_indexes(db, table):
+    """
+    :returns: A set of the names of a table's indexes
+    """
+    if db.dbname == 'mysql':
+        rows = db.query('SHOW INDEX FROM ' + table)
+        return set([row.Key_name for row in rows])
+    if db.dbname == 'postgres':
+        rows = db.query('SELECT indexname FROM pg_indexes '
+                        'WHERE tablename = $table', vars=dict(table=table))
+        return set([row.indexname for row in rows])
+    rows = db.query("SELECT name FROM sqlite_master "
+                    "WHERE type = 'index' AND tbl_name = $table",
+                    vars=dict(table=table))
+    return set([row.name for row in rows])
+
+
+def migrate(db):
+    """
+    Add any of TABLES and INDEXES a database is missing. Tables come first,
+    so that their indexes can be added.
+
+    :param db: A web.database
+    :returns:  A list of the names of the tables and indexes that were added
+    """
+    added = []
+    tables = get_tables(db)
+    for table, statements in TABLES:
+        if table not in tables:
+            db.query(statements[db.dbname])
+            added.append(table)
+    existing = dict()
+    for name, table, columns in INDEXES:
+        if table not in existing:
+            existing[table] = get_indexes(db, table)
+        if name in existing[table]:
+            continue
+        if db.dbname == 'mysql':
+            columns = [
+                '{column}({length})'.format(column=column,
+                                            length=MYSQL_PREFIXES[column])
+                if column in MYSQL_PREFIXES else column
+                for column in columns]
+        db.query('CREATE INDEX {name} ON {table} ({columns})'.format(
+            name=name, table=table, columns=', '.join(columns)))
+        added.append(name)
+    return added
+
+
+if __name__ == '__main__':
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    from config import DB
+    added = migrate(DB)
+    print 'added tables and indexes:', ', '.join(added) if added else 'none'
@@ -1,20 +1,105 @@
 import json
-import httplib2
 import logging
 import os
+import requests
+import time
+import urllib
 from .config import config
 
 log = logging.getLogger(__name__)
 
+# The last ETag and body each URL passed to send_conditional_get() returned
+_etag_cache = {}
 
-def send_request(method, url, body=None, headers=None):
-    http = httplib2.Http()
-    resp, content = http.request(url, method=method, body=body, headers=headers)
-    if resp.status == 200:
-        return (True, content, resp.status)
+# How many times to retry requests that couldn't reach the lock server, and
+# how long to wait before the first retry; each retry waits twice as long
+retries = 3
+backoff = 1
+# How many times requests have been retried so far
+retry_count = 0
+
+_session = None
+
+
+def get_session():
+    """
+    :returns: The requests.Session shared by all lock server requests, so
+              that they can reuse its keep-alive connections
+    """
+    global _session
+    if _session is None:
+        _session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=20)
+        _session.mount('http://', adapter)
+        _session.mount('https://', adapter)
+    return _session
+
+
+def _request(method, url, body=None, headers=None, timeout=None):
+    """
+    Send a request on the shared session, retrying with backoff if the lock
+    server can't be reached. POSTs lock machines, so a POST that might have
+    reached the server is not retried.
+
+    :param timeout: Optional. How long to wait for a response, if not
+                    config.lock_server_timeout
+    """
+    global retry_count
+    if timeout is None:
+        timeout = config.lock_server_timeout
+    for attempt in range(retries + 1):
+        try:
+            return get_session().request(
+                method, url, data=body, headers=headers, timeout=timeout)
+        except (requests.exceptions.ConnectionError,
+                requests.exceptions.Timeout) as e:
+            if attempt == retries or (
+                    method == 'POST' and not
+                    isinstance(e, requests.exceptions.ConnectTimeout)):
+                raise
+            delay = backoff * 2 ** attempt
+            log.warn("%s request to '%s' failed (%s); retrying in %ss",
+                     method, url, e, delay)
+            retry_count += 1
+            time.sleep(delay)
+
+
+def send_request(method, url, body=None, headers=None, timeout=None):
+    """
+    :returns: A tuple: (success, content, status). content is None if the
+              request failed, unless the server explained why in JSON.
+    """
+    resp = _request(method, url, body=body, headers=headers, timeout=timeout)
+    if resp.status_code == 200:
+        return (True, resp.content, resp.status_code)
     log.info("%s request to '%s' with body '%s' failed with response code %d",
-             method, url, body, resp.status)
-    return (False, None, resp.status)
+             method, url, body, resp.status_code)
+    content = None
+    if 'json' in resp.headers.get('content-type', ''):
+        content = resp.content
+    return (False, content, resp.status_code)
+
+
+def send_conditional_get(url):
+    """
+    Like send_request('GET', url), but if url was fetched before, ask the
+    server to answer 304 Not Modified if nothing changed since, and reuse the
+    previous response's body if it does.
+    """
+    headers = {}
+    cached = _etag_cache.get(url)
+    if cached:
+        headers['If-None-Match'] = cached[0]
+    resp = _request('GET', url, headers=headers)
+    if resp.status_code == 304 and cached:
+        return (True, cached[1], resp.status_code)
+    if resp.status_code == 200:
+        if 'etag' in resp.headers:
+            _etag_cache[url] = (resp.headers['etag'], resp.content)
+        return (True, resp.content, resp.status_code)
+    log.info("GET request to '%s' failed with response code %d", url,
+             resp.status_code)
+    return (False, None, resp.status_code)
 
 
 def get_status(ctx, name):
@@ -22,3 +107,27 @@ def get_status(ctx, name):
     if success:
         return json.loads(content)
     return None
+
+
+def get_statuses(ctx, names):
+    """
+    Like get_status(), for several machines with a single request.
+
+    :param names: A list of machine names
+    :returns:     A dict mapping each name to its status, or to None if the
+                  lock server doesn't know about it. If the lock server
+                  couldn't be queried at all, all of them map to None.
+    """
+    statuses = dict([(name, None) for name in names])
+    if not names:
+        return statuses
+    success, content, _ = send_request(
+        'GET',
+        config.lock_server + '?' + urllib.urlencode(
+            dict(names=','.join(sorted(set(names))))))
+    if success:
+        # Lock servers that predate the names filter return every machine
+        for status in json.loads(content):
+            if status['name'] in statuses:
+                statuses[status['name']] = status
+    return statuses
@@ -10,7 +10,7 @@ from . import orchestra
 import orchestra.remote
 from .orchestra import run
 from .lock import list_locks
-from .lock import unlock_one
+from .lock import unlock_many
 from .misc import config_file
 from .misc import get_testdir
 from .misc import get_user
@@ -326,7 +326,7 @@ def nuke(ctx, should_unlock, sync_clocks=True, reboot_all=True, noipmi=False):
     targets = dict(ctx.config['targets'])
     if ctx.name:
         log.info('Checking targets against current locks')
-        locks = list_locks()
+        locks = list_locks(fields=['name', 'description'])
         # Remove targets who's description doesn't match archive name.
         for lock in locks:
             for target in targets:
@@ -351,6 +351,9 @@ def nuke(ctx, should_unlock, sync_clocks=True, reboot_all=True, noipmi=False):
         for unnuked in p:
             if unnuked:
                 total_unnuked.update(unnuked)
+    if should_unlock:
+        unlock_many(ctx, [target for target in ctx.config['targets']
+                          if target not in total_unnuked], ctx.owner)
     if total_unnuked:
         log.error('Could not nuke the following targets:\n' +
                   '\n  '.join(['targets:', ] +
@@ -378,10 +381,6 @@ def nuke_one(ctx, targets, should_unlock, synch_clocks, reboot_all,
         log.exception('Could not nuke all targets in %s' % targets)
         # not re-raising the so that parallel calls aren't killed
         ret = targets
-    else:
-        if should_unlock:
-            for target in targets.keys():
-                unlock_one(ctx, target, ctx.owner)
     return ret
 
 
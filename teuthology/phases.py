@@ -0,0 +1,79 @@
+"""
+Timestamps for the steps a job goes through on its way from the queue to its
+first real task: being reserved, fetching branches, starting the teuthology
+process, and the internal.* tasks that lock, provision, connect to and check
+its machines.
+
+Each step is marked with the time it finished, in the job config's
+'phase_times' dict. The worker marks its steps before handing the config to
+teuthology, which marks the rest and writes them all to info.yaml and
+summary.yaml. teuthology-report --phases aggregates them over many jobs.
+"""
+import time
+
+
+def mark(job_config, phase, when=None):
+    """
+    Record that a job has just finished a phase.
+
+    :param job_config: The job's config dict
+    :param phase:      The name of the phase, e.g. 'reserved'
+    :param when:       Optional. The time the phase finished, if not now
+    """
+    if when is None:
+        when = time.time()
+    job_config.setdefault('phase_times', dict())[phase] = round(when, 3)
+
+
+def get_durations(phase_times):
+    """
+    :param phase_times: A job's 'phase_times' dict
+    :returns:           A list of (phase, seconds) tuples, in the order the
+                        phases finished, giving how long each phase took
+                        after the one before it. The first phase, normally
+                        'queued', is the starting point and is left out.
+    """
+    ordered = sorted(phase_times.items(), key=lambda item: item[1])
+    return [(phase, round(when - ordered[i][1], 3))
+            for i, (phase, when) in enumerate(ordered[1:])]
+
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+def summarize(all_phase_times):
+    """
+    Aggregate the phase times of many jobs.
+
+    :param all_phase_times: A list of 'phase_times' dicts
+    :returns:               A list of dicts, one per phase, with the phase's
+                            'name', the number of 'jobs' that reached it and
+                            the 'mean', 'median' and 'max' seconds it took.
+                            Phases are listed in the order they usually
+                            happen in.
+    """
+    durations = dict()
+    positions = dict()
+    for phase_times in all_phase_times:
+        for position, (phase, seconds) in enumerate(
+                get_durations(phase_times)):
+            durations.setdefault(phase, list()).append(seconds)
+            positions.setdefault(phase, list()).append(position)
+    summary = list()
+    for phase, seconds in durations.items():
+        seconds = sorted(seconds)
+        summary.append(dict(
+            name=phase,
+            jobs=len(seconds),
+            mean=sum(seconds) / len(seconds),
+            median=median(seconds),
+            max=seconds[-1],
+        ))
+    summary.sort(key=lambda phase: (
+        sum(positions[phase['name']]) / float(phase['jobs']), phase['name']))
+    return summary
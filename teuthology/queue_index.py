@@ -0,0 +1,125 @@
+"""
+A local index of the jobs teuthology-schedule has put in the queue.
+
+beanstalkd can't list the jobs in a tube without reserving each one, so
+teuthology-schedule records the id, tube, run name, description and priority
+of every job it submits in a small sqlite database at
+config.queue_index_path or, by default, next to the archive.
+teuthology-queue and teuthology-kill look jobs up there and check with
+beanstalkd that each one is still queued; entries for jobs that have left the
+queue are pruned as they are found.
+"""
+import logging
+import os
+import sqlite3
+import time
+
+from .config import config
+
+log = logging.getLogger(__name__)
+
+
+def get_queue_index_path():
+    """
+    :returns: config.queue_index_path, or by default 'queue_index.db' next to
+              config.archive_base
+    """
+    if config.queue_index_path:
+        return config.queue_index_path
+    archive_base = os.path.abspath(config.archive_base)
+    return os.path.join(os.path.dirname(archive_base), 'queue_index.db')
+
+
+def get_queue_index():
+    """
+    :returns: A QueueIndex, or None if the queue backend doesn't need one or
+              its database can't be opened
+    """
+    if config.queue_backend != 'beanstalk':
+        return None
+    path = get_queue_index_path()
+    try:
+        return QueueIndex(path)
+    except (OSError, sqlite3.Error):
+        log.exception("Could not open the queue index at %s", path)
+        return None
+
+
+class QueueIndex(object):
+    schema = [
+        """CREATE TABLE IF NOT EXISTS jobs (
+            job_id INTEGER PRIMARY KEY,
+            tube TEXT NOT NULL,
+            name TEXT NOT NULL,
+            description TEXT,
+            priority INTEGER,
+            owner TEXT,
+            queued_at REAL
+        )""",
+        "CREATE INDEX IF NOT EXISTS jobs_tube_name ON jobs (tube, name)",
+        "CREATE INDEX IF NOT EXISTS jobs_name ON jobs (name)",
+    ]
+    fields = ('job_id', 'tube', 'name', 'description', 'priority', 'owner',
+              'queued_at')
+
+    def __init__(self, path):
+        self.path = path
+        dir_path = os.path.dirname(path)
+        if dir_path and not os.path.isdir(dir_path):
+            os.makedirs(dir_path)
+        # Many teuthology-schedule processes may write at once
+        self.db = sqlite3.connect(path, timeout=60)
+        self.db.row_factory = sqlite3.Row
+        with self.db:
+            for statement in self.schema:
+                self.db.execute(statement)
+
+    def add(self, job_id, tube, job_config):
+        """
+        Record a job that was just put in the queue.
+        """
+        with self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO jobs VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (int(job_id), tube, job_config['name'],
+                 job_config.get('description'), job_config.get('priority'),
+                 job_config.get('owner'), time.time()),
+            )
+
+    def remove(self, job_ids):
+        """
+        Forget about jobs that are no longer queued.
+        """
+        with self.db:
+            self.db.executemany(
+                "DELETE FROM jobs WHERE job_id = ?",
+                [(int(job_id),) for job_id in job_ids],
+            )
+
+    def jobs(self, tube=None, run_name=None, states=None):
+        """
+        :param tube:     Optional. Only return jobs in this tube
+        :param run_name: Optional. Only return jobs in this run
+        :param states:   Ignored: the index doesn't know which state each job
+                         is in, so it returns them all, and callers check
+                         with beanstalkd
+        :returns:        A list of dicts with the keys in self.fields, in the
+                         order beanstalkd will hand the jobs out
+        """
+        where = list()
+        params = list()
+        if tube is not None:
+            where.append("tube = ?")
+            params.append(tube)
+        if run_name is not None:
+            where.append("name = ?")
+            params.append(run_name)
+        query = "SELECT * FROM jobs"
+        if where:
+            query += " WHERE " + " AND ".join(where)
+        query += " ORDER BY priority, job_id"
+        return [dict(zip(row.keys(), row)) for row in
+                self.db.execute(query, params)]
+
+    def close(self):
+        self.db.close()
@@ -1,6 +1,8 @@
 import fcntl
+import hashlib
 import logging
 import os
+import platform
 import shutil
 import subprocess
 import time
@@ -28,14 +30,12 @@ def enforce_repo_state(repo_url, dest_path, branch, remove_on_error=True):
     try:
         if not os.path.isdir(dest_path):
             clone_repo(repo_url, dest_path, branch)
-        elif time.time() - os.stat('/etc/passwd').st_mtime > 60:
-            # only do this at most once per minute
-            fetch(dest_path)
-            out = subprocess.check_output(('touch', dest_path))
-            if out:
-                log.info(out)
         else:
-            log.info("%s was just updated; assuming it is current", branch)
+            set_remote(dest_path, repo_url)
+            if branch_is_current(repo_url, dest_path, branch):
+                log.info("%s is already at the latest %s", dest_path, branch)
+            else:
+                fetch(dest_path)
 
         reset_repo(repo_url, dest_path, branch)
         # remove_pyc_files(dest_path)
@@ -72,6 +72,132 @@ def clone_repo(repo_url, dest_path, branch):
             raise GitError("git clone failed!")
 
 
+def branch_is_current(repo_url, repo_path, branch):
+    """
+    Compare the sha1 of branch in repo_url with that of origin/<branch> in
+    repo_path, using 'git ls-remote' - which is much cheaper than a fetch.
+
+    :param repo_url:  The full URL to the repo (not including the branch)
+    :param repo_path: The full path to the repository
+    :param branch:    The branch.
+    :returns:         True if they match
+    """
+    proc = subprocess.Popen(
+        ('git', 'ls-remote', repo_url, 'refs/heads/%s' % branch),
+        cwd=repo_path,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT)
+    out = proc.communicate()[0]
+    if proc.returncode != 0 or not out.strip():
+        return False
+    remote_sha1 = out.split()[0]
+    proc = subprocess.Popen(
+        ('git', 'rev-parse', '--verify', '-q', 'origin/%s' % branch),
+        cwd=repo_path,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT)
+    local_sha1 = proc.communicate()[0].strip()
+    return proc.returncode == 0 and local_sha1 == remote_sha1
+
+
+def set_remote(repo_path, repo_url):
+    """
+    Point the 'origin' remote of an existing repo at repo_url, if it isn't
+    already - e.g. to switch a checkout that was cloned from upstream over to
+    a mirror.
+
+    :param repo_path: The full path to the repository
+    :param repo_url:  The full URL to the repo
+    :raises:          GitError if the operation fails
+    """
+    proc = subprocess.Popen(
+        ('git', 'config', 'remote.origin.url'),
+        cwd=repo_path,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT)
+    current_url = proc.stdout.read().strip()
+    if proc.wait() == 0 and current_url == repo_url:
+        return
+    log.info("Setting origin of %s to %s", repo_path, repo_url)
+    proc = subprocess.Popen(
+        ('git', 'remote', 'set-url', 'origin', repo_url),
+        cwd=repo_path,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT)
+    if proc.wait() != 0:
+        out = proc.stdout.read()
+        log.error(out)
+        raise GitError("git remote set-url failed!")
+
+
+def update_mirror(repo_url, mirror_path):
+    """
+    Create or update a bare repo holding every branch of repo_url. Checkouts
+    cloned from the mirror hardlink its objects rather than downloading and
+    storing their own copies, and only the mirror ever fetches from upstream.
+
+    :param repo_url:    The full URL to the upstream repo
+    :param mirror_path: The full path to the mirror
+    :raises:            GitError if the operation fails
+    """
+    if os.path.isdir(mirror_path):
+        fetch(mirror_path)
+        return
+    log.info("Mirroring %s into %s", repo_url, mirror_path)
+    proc = subprocess.Popen(
+        ('git', 'clone', '--bare', repo_url, mirror_path),
+        cwd=os.path.dirname(mirror_path),
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT)
+    if proc.wait() != 0:
+        out = proc.stdout.read()
+        log.error(out)
+        shutil.rmtree(mirror_path, ignore_errors=True)
+        raise GitError("git clone failed!")
+    # A bare clone has no fetch refspec; map upstream branches directly onto
+    # the mirror's so 'git fetch -p origin' keeps them current. Unlike
+    # --mirror, this leaves out refs like GitHub's refs/pull/*.
+    subprocess.check_call(
+        ('git', 'config', 'remote.origin.fetch', '+refs/heads/*:refs/heads/*'),
+        cwd=mirror_path,
+    )
+
+
+def fetch_mirror(repo_url, lock=True, max_age=None):
+    """
+    Make sure there is an up-to-date mirror of repo_url under
+    config.src_base_path.
+
+    When several processes want the same mirror updated at once, only the
+    first one to get the lock fetches; the others use its result.
+
+    :param repo_url: The full URL to the upstream repo
+    :param max_age:  Don't update the mirror if it was last updated less than
+                     this many seconds ago. Defaults to config.mirror_max_age
+    :returns:        The path to the mirror
+    """
+    if max_age is None:
+        max_age = config.mirror_max_age
+    requested_at = time.time()
+    mirrors_path = os.path.join(config.src_base_path, 'mirrors')
+    if not os.path.exists(mirrors_path):
+        os.makedirs(mirrors_path)
+    name = repo_url.rstrip('/').split('/')[-1]
+    if not name.endswith('.git'):
+        name += '.git'
+    mirror_path = os.path.join(mirrors_path, name)
+    # only let one worker create/update the mirror at a time
+    lock_path = mirror_path + '.lock'
+    with FileLock(lock_path, noop=not lock):
+        if is_fresh(mirror_path, max_age, since=requested_at):
+            log.info("%s was just updated; assuming it is current",
+                     mirror_path)
+            return mirror_path
+        update_mirror(repo_url, mirror_path)
+        mark_fresh(mirror_path)
+    return mirror_path
+
+
 def fetch(repo_path):
     """
     Call "git fetch -p origin"
@@ -150,12 +276,16 @@ def validate_branch(branch):
         raise ValueError("Illegal branch name: '%s'" % branch)
 
 
-def fetch_qa_suite(branch, lock=True):
+def fetch_qa_suite(branch, lock=True, max_age=0):
     """
     Make sure ceph-qa-suite is checked out.
 
-    :param branch: The branch to fetch
-    :returns:      The destination path
+    :param branch:  The branch to fetch
+    :param max_age: Don't update the checkout if it was last updated less
+                    than this many seconds ago and the branch hasn't moved
+                    upstream since, or if it was updated while we waited for
+                    the lock
+    :returns:       The destination path
     """
     src_base_path = config.src_base_path
     if not os.path.exists(src_base_path):
@@ -164,23 +294,35 @@ def fetch_qa_suite(branch, lock=True):
     qa_suite_url = os.path.join(config.ceph_git_base_url, 'ceph-qa-suite')
     # only let one worker create/update the checkout at a time
     lock_path = dest_path.rstrip('/') + '.lock'
+    requested_at = time.time()
     with FileLock(lock_path, noop=not lock):
+        if is_current(qa_suite_url, dest_path, branch, max_age,
+                      since=requested_at):
+            return dest_path
+        mirror_max_age = get_mirror_max_age(dest_path, max_age)
         with safe_while() as proceed:
             while proceed():
                 try:
-                    enforce_repo_state(qa_suite_url, dest_path, branch)
+                    mirror_path = fetch_mirror(qa_suite_url, lock=lock,
+                                               max_age=mirror_max_age)
+                    enforce_repo_state(mirror_path, dest_path, branch)
                     break
                 except GitError:
                     log.exception("Git error encountered; retrying")
+        mark_fresh(dest_path)
     return dest_path
 
 
-def fetch_teuthology(branch, lock=True):
+def fetch_teuthology(branch, lock=True, max_age=0):
     """
     Make sure we have the correct teuthology branch checked out and up-to-date
 
-    :param branch: The branch we want
-    :returns:      The destination path
+    :param branch:  The branch we want
+    :param max_age: Don't update the checkout if it was last updated less
+                    than this many seconds ago and the branch hasn't moved
+                    upstream since, or if it was updated while we waited for
+                    the lock
+    :returns:       The destination path
     """
     src_base_path = config.src_base_path
     if not os.path.exists(src_base_path):
@@ -188,24 +330,117 @@ def fetch_teuthology(branch, lock=True):
     dest_path = os.path.join(src_base_path, 'teuthology_' + branch)
     # only let one worker create/update the checkout at a time
     lock_path = dest_path.rstrip('/') + '.lock'
+    requested_at = time.time()
     teuthology_git_upstream = config.ceph_git_base_url + \
         'teuthology.git'
     with FileLock(lock_path, noop=not lock):
+        if is_current(teuthology_git_upstream, dest_path, branch, max_age,
+                      since=requested_at):
+            return dest_path
+        mirror_max_age = get_mirror_max_age(dest_path, max_age)
         with safe_while() as proceed:
             while proceed():
                 try:
-                    enforce_repo_state(teuthology_git_upstream, dest_path,
-                                       branch)
+                    mirror_path = fetch_mirror(teuthology_git_upstream,
+                                               lock=lock,
+                                               max_age=mirror_max_age)
+                    enforce_repo_state(mirror_path, dest_path, branch)
                     bootstrap_teuthology(dest_path)
                     break
                 except GitError:
                     log.exception("Git error encountered; retrying")
                 except BootstrapError:
                     log.exception("Bootstrap error encountered; retrying")
+        mark_fresh(dest_path)
     return dest_path
 
 
+def is_fresh(dest_path, max_age, since=None):
+    """
+    :param dest_path: The path to a checkout or mirror
+    :param max_age:   The maximum age, in seconds
+    :param since:     Optional. A timestamp; e.g. when we started waiting for
+                      the lock on dest_path
+    :returns:         True if the checkout exists and was brought up-to-date
+                      less than max_age seconds ago, or after since
+    """
+    if not os.path.isdir(dest_path):
+        return False
+    stamp_path = dest_path.rstrip('/') + '.fetched'
+    try:
+        fetched_at = os.path.getmtime(stamp_path)
+    except OSError:
+        return False
+    if since is not None and fetched_at >= since:
+        return True
+    return bool(max_age) and time.time() - fetched_at < max_age
+
+
+def is_current(repo_url, dest_path, branch, max_age, since=None):
+    """
+    Decide whether the checkout at dest_path can be used without updating it.
+
+    It can if it was updated after since, e.g. by whoever held the lock while
+    we waited for it. If it was updated less than max_age seconds ago, one
+    'git ls-remote' against repo_url checks that branch hasn't moved upstream
+    since: the checkout's origin is a mirror that may be just as stale, so
+    a branch pushed moments ago would otherwise run old code.
+
+    :param repo_url:  The full URL to the upstream repo
+    :param dest_path: The path to the checkout
+    :param branch:    The branch
+    :param max_age:   The maximum age, in seconds
+    :param since:     Optional. A timestamp; see is_fresh()
+    :returns:         True if the checkout can be used as it is
+    """
+    if is_fresh(dest_path, 0, since=since):
+        return True
+    if not is_fresh(dest_path, max_age):
+        return False
+    if branch_is_current(repo_url, dest_path, branch):
+        return True
+    log.info("%s has moved upstream; updating %s", branch, dest_path)
+    return False
+
+
+def get_mirror_max_age(dest_path, max_age):
+    """
+    :returns: The max_age to pass fetch_mirror() when is_current() said the
+              checkout at dest_path needs updating: 0 if that is because
+              branch moved upstream, since the mirror can't have that commit
+              unless it is fetched again; otherwise None, for the default
+    """
+    if is_fresh(dest_path, max_age):
+        return 0
+    return None
+
+
+def mark_fresh(dest_path):
+    """
+    Record that the checkout at dest_path was just brought up-to-date.
+    """
+    touch(dest_path.rstrip('/') + '.fetched')
+
+
 def bootstrap_teuthology(dest_path):
+    """
+    Make sure the teuthology checkout at dest_path has a working virtualenv.
+
+    Unless config.venv_cache_max_age is 0, the virtualenv is linked to a
+    shared one built from the same requirements.txt; see link_cached_venv().
+    Otherwise, or if that fails, the checkout's ./bootstrap is run.
+    """
+    if config.venv_cache_max_age:
+        try:
+            link_cached_venv(dest_path)
+            return
+        except BootstrapError:
+            log.exception("Could not use a cached virtualenv for %s",
+                          dest_path)
+    run_bootstrap(dest_path)
+
+
+def run_bootstrap(dest_path):
         log.info("Bootstrapping %s", dest_path)
         # This magic makes the bootstrap script not attempt to clobber an
         # existing virtualenv. But the branch's bootstrap needs to actually
@@ -227,6 +462,157 @@ def bootstrap_teuthology(dest_path):
             raise BootstrapError("Bootstrap failed!")
 
 
+def link_cached_venv(dest_path):
+    """
+    Give the teuthology checkout at dest_path a virtualenv whose dependencies
+    come from a cached one built from an identical requirements.txt.
+
+    The checkout's own virtualenv is nearly empty: a .pth file adds the cached
+    virtualenv's site-packages to it, and 'setup.py develop' installs the
+    checkout itself. It is only recreated if it points at the wrong cached
+    virtualenv.
+
+    :param dest_path: The full path to a teuthology checkout
+    :raises:          BootstrapError if any step fails
+    """
+    requirements_path = os.path.join(dest_path, 'requirements.txt')
+    if not os.path.exists(requirements_path):
+        raise BootstrapError("%s not found" % requirements_path)
+    cached_site_path = get_site_packages(get_cached_venv(requirements_path))
+
+    venv_path = os.path.join(dest_path, 'virtualenv')
+    pth_path = None
+    if os.path.exists(os.path.join(venv_path, 'bin', 'python')):
+        pth_path = os.path.join(get_site_packages(venv_path),
+                                'teuthology-venv-cache.pth')
+        if not os.path.exists(pth_path) or \
+                file(pth_path).read().strip() != cached_site_path:
+            pth_path = None
+    if pth_path is None:
+        log.info("Creating %s using %s", venv_path, cached_site_path)
+        shutil.rmtree(venv_path, ignore_errors=True)
+        run_venv_cmd(('virtualenv', '--system-site-packages', venv_path),
+                     dest_path)
+        pth_path = os.path.join(get_site_packages(venv_path),
+                                'teuthology-venv-cache.pth')
+        with file(pth_path, 'w') as pth_file:
+            pth_file.write(cached_site_path + '\n')
+    # forbid setuptools from using the network; everything setup.py needs
+    # should already be in the cached virtualenv
+    run_venv_cmd((os.path.join(venv_path, 'bin', 'python'), 'setup.py',
+                  'develop', '--allow-hosts', 'None'), dest_path)
+
+
+def get_venv_cache_key(requirements_path):
+    """
+    :returns: A key identifying the virtualenv that requirements_path would
+              produce with the local Python version
+    """
+    sha1 = hashlib.sha1(platform.python_version())
+    with file(requirements_path) as requirements_file:
+        sha1.update(requirements_file.read())
+    return sha1.hexdigest()
+
+
+def get_cached_venv(requirements_path):
+    """
+    Find or build the cached virtualenv for requirements_path under
+    config.src_base_path, and evict any that haven't been used in
+    config.venv_cache_max_age seconds.
+
+    :returns: The path to the cached virtualenv
+    """
+    cache_path = os.path.join(config.src_base_path, 'virtualenvs')
+    if not os.path.exists(cache_path):
+        os.makedirs(cache_path)
+    venv_path = os.path.join(cache_path,
+                             get_venv_cache_key(requirements_path))
+    # only let one worker build a given virtualenv at a time
+    with FileLock(venv_path + '.lock'):
+        if not os.path.exists(venv_path + '.complete'):
+            log.info("Building cached virtualenv %s", venv_path)
+            shutil.rmtree(venv_path, ignore_errors=True)
+            try:
+                run_venv_cmd(('virtualenv', '--system-site-packages',
+                              venv_path), cache_path)
+                run_venv_cmd((os.path.join(venv_path, 'bin', 'pip'),
+                              'install', '-r', requirements_path),
+                             cache_path)
+            except BootstrapError:
+                shutil.rmtree(venv_path, ignore_errors=True)
+                raise
+            touch(venv_path + '.complete')
+        touch(venv_path + '.used')
+    evict_cached_venvs(cache_path, config.venv_cache_max_age)
+    return venv_path
+
+
+def evict_cached_venvs(cache_path, max_age):
+    """
+    Remove cached virtualenvs that haven't been used in max_age seconds.
+    """
+    for name in os.listdir(cache_path):
+        if not name.endswith('.used'):
+            continue
+        venv_path = os.path.join(cache_path, name[:-len('.used')])
+        if not is_unused(venv_path, max_age):
+            continue
+        with FileLock(venv_path + '.lock'):
+            # check again now that nobody else can be using it
+            if not is_unused(venv_path, max_age):
+                continue
+            log.info("Removing cached virtualenv %s", venv_path)
+            os.remove(venv_path + '.used')
+            if os.path.exists(venv_path + '.complete'):
+                os.remove(venv_path + '.complete')
+            shutil.rmtree(venv_path, ignore_errors=True)
+
+
+def is_unused(venv_path, max_age):
+    try:
+        age = time.time() - os.path.getmtime(venv_path + '.used')
+    except OSError:
+        return False
+    return age >= max_age
+
+
+def get_site_packages(venv_path):
+    """
+    :returns: The path to the site-packages directory of the virtualenv at
+              venv_path
+    """
+    python_path = os.path.join(venv_path, 'bin', 'python')
+    return run_venv_cmd(
+        (python_path, '-c',
+         'from distutils.sysconfig import get_python_lib; '
+         'print get_python_lib()'),
+        venv_path,
+    ).strip()
+
+
+def run_venv_cmd(args, cwd):
+    """
+    Run a command, logging its output if it fails.
+
+    :returns: The command's output
+    :raises:  BootstrapError if the command fails
+    """
+    proc = subprocess.Popen(args, cwd=cwd, stdout=subprocess.PIPE,
+                            stderr=subprocess.STDOUT)
+    out = proc.communicate()[0]
+    if proc.returncode != 0:
+        for line in out.splitlines():
+            log.warn(line.strip())
+        raise BootstrapError("%s failed!" % ' '.join(args))
+    return out
+
+
+def touch(path):
+    with file(path, 'w'):
+        pass
+    os.utime(path, None)
+
+
 class FileLock(object):
     def __init__(self, filename, noop=False):
         self.filename = filename
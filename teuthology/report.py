@@ -8,6 +8,7 @@ import socket
 from datetime import datetime
 
 import teuthology
+from . import phases
 from .config import config
 
 report_exceptions = (requests.exceptions.RequestException, socket.error)
@@ -43,6 +44,9 @@ def main(args):
     save = not args['--no-save']
 
     log = init_logging()
+    if args['--phases']:
+        print_phases(archive_base, run, all_runs=args['--all-runs'])
+        return
     reporter = ResultsReporter(archive_base, save=save, refresh=refresh,
                                log=log)
     if dead and not job:
@@ -172,6 +176,53 @@ class ResultsSerializer(object):
         return runs
 
 
+def get_phase_times(serializer, run_names):
+    """
+    :param serializer: A ResultsSerializer
+    :param run_names:  The runs to look at
+    :returns:          A list of the 'phase_times' dicts of the runs' jobs;
+                       see teuthology.phases
+    """
+    all_phase_times = list()
+    for run_name in run_names:
+        for job_dir in serializer.jobs_for_run(run_name).values():
+            # summary.yaml has the complete list; jobs that are still running
+            # only have info.yaml
+            for yaml_name in ('summary.yaml', 'info.yaml'):
+                yaml_path = os.path.join(job_dir, yaml_name)
+                if not os.path.exists(yaml_path):
+                    continue
+                with file(yaml_path) as yaml_file:
+                    job_info = yaml.safe_load(yaml_file) or dict()
+                if job_info.get('phase_times'):
+                    all_phase_times.append(job_info['phase_times'])
+                    break
+    return all_phase_times
+
+
+def print_phases(archive_base, run_names, all_runs=False):
+    """
+    Print how long jobs took to get through each phase of starting up, from
+    being queued to running their tasks.
+
+    :param archive_base: The base archive directory
+    :param run_names:    The runs to look at
+    :param all_runs:     Look at every run in the archive instead
+    """
+    serializer = ResultsSerializer(archive_base)
+    if all_runs:
+        run_names = serializer.all_runs
+    summary = phases.summarize(get_phase_times(serializer, run_names))
+    if not summary:
+        print "No phase times found"
+        return
+    print '{name:<40} {jobs:>6} {mean:>9} {median:>9} {max:>9}'.format(
+        name='Phase', jobs='Jobs', mean='Mean', median='Median', max='Max')
+    for phase in summary:
+        print '{name:<40} {jobs:>6} {mean:>9.1f} {median:>9.1f} ' \
+            '{max:>9.1f}'.format(**phase)
+
+
 class ResultsReporter(object):
     last_run_file = 'last_successful_run'
 
@@ -314,6 +365,26 @@ class ResultsReporter(object):
 
         return job_id
 
+    def update_job(self, run_name, job_id, job_info):
+        """
+        Update a job the results server already knows about, with a single
+        PUT. If the server doesn't know the job after all, fall back to
+        report_job().
+
+        :param run_name: The name of the run.
+        :param job_id:   The job's id
+        :param job_info: A dict of the job's fields to update
+        """
+        job_uri = "{base}/runs/{name}/jobs/{job_id}/".format(
+            base=self.base_uri, name=run_name, job_id=job_id)
+        response = self.session.put(
+            job_uri, data=json.dumps(job_info),
+            headers={'content-type': 'application/json'})
+        if response.status_code == 404:
+            return self.report_job(run_name, job_id, job_info)
+        response.raise_for_status()
+        return job_id
+
     @property
     def last_run(self):
         """
@@ -441,6 +512,40 @@ def try_push_job_info(job_config, extra_info=None):
                       config.results_server)
 
 
+def try_push_heartbeats(job_infos):
+    """
+    Tell the results server that several jobs are still running. Failures are
+    logged and otherwise ignored, as with try_push_job_info().
+
+    paddles only updates one job per request - there is no endpoint taking
+    several jobs, or jobs from several runs - so this can't be a single
+    request. Instead the requests share one connection, each is a single PUT
+    rather than a POST that fails followed by a PUT, and if the server can't
+    be reached the rest aren't attempted.
+
+    :param job_infos: A list of dicts, each with a job's 'name' and 'job_id'
+    """
+    log = init_logging()
+    if not job_infos:
+        return
+    reporter = ResultsReporter()
+    if not reporter.base_uri:
+        return
+    log.debug("Pushing %d heartbeats to %s", len(job_infos),
+              config.results_server)
+    for job_info in job_infos:
+        try:
+            reporter.update_job(job_info['name'], str(job_info['job_id']),
+                                dict(job_info, status='running'))
+        except requests.exceptions.ConnectionError:
+            # The rest would fail the same way
+            log.exception("Could not connect to %s", config.results_server)
+            return
+        except report_exceptions:
+            log.exception("Could not report results to %s",
+                          config.results_server)
+
+
 def try_delete_jobs(run_name, job_ids, delete_empty_run=True):
     """
     Using the same error checking and retry mechanism as try_push_job_info(),
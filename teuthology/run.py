@@ -7,6 +7,7 @@ import logging
 from traceback import format_tb
 
 import teuthology
+from . import phases
 from . import report
 from .misc import get_user
 from .misc import read_config
@@ -61,6 +62,8 @@ def write_initial_metadata(ctx):
         }
         if 'job_id' in ctx.config:
             info['job_id'] = ctx.config['job_id']
+        if 'phase_times' in ctx.config:
+            info['phase_times'] = ctx.config['phase_times']
 
         with file(os.path.join(ctx.archive, 'info.yaml'), 'w') as f:
             yaml.safe_dump(info, f, default_flow_style=False)
@@ -95,6 +98,9 @@ def fetch_tasks_if_needed(job_config):
 
 
 def main(ctx):
+    # The time since the worker 'spawned' us is mostly spent importing
+    # teuthology, gevent and their dependencies
+    phases.mark(ctx.config, 'started')
     set_up_logging(ctx)
 
     if ctx.owner is None:
@@ -134,6 +140,8 @@ def main(ctx):
     ctx.summary = dict(success=True)
 
     ctx.summary['owner'] = ctx.owner
+    # Tasks keep adding to this as they start
+    ctx.summary['phase_times'] = ctx.config['phase_times']
 
     if ctx.description is not None:
         ctx.summary['description'] = ctx.description
@@ -3,6 +3,7 @@ import logging
 from .sentry import get_client as get_sentry_client
 from .misc import get_http_log_path
 from .config import config as teuth_config
+from . import phases
 from copy import deepcopy
 
 log = logging.getLogger(__name__)
@@ -52,6 +53,7 @@ def run_tasks(tasks, ctx):
             if hasattr(manager, '__enter__'):
                 manager.__enter__()
                 stack.append((taskname, manager))
+            phases.mark(ctx.config, 'task:' + taskname)
     except Exception as e:
         ctx.summary['success'] = False
         if 'failure_reason' not in ctx.summary:
@@ -1,10 +1,15 @@
+import logging
 import pprint
 import yaml
 
-import teuthology.beanstalk
+from teuthology import job_queue
+from teuthology import phases
+from teuthology.config import config
 from teuthology.misc import deep_merge, get_user
 from teuthology import report
 
+log = logging.getLogger(__name__)
+
 
 def main(args):
     if not args['--last-in-suite']:
@@ -65,26 +70,42 @@ def build_config(args):
     return job_config
 
 
-def schedule_job(job_config, num=1):
+def schedule_job(job_config, num=1, connection=None):
     """
     Schedule a job.
 
     :param job_config: The complete job dict
     :param num:      The number of times to schedule the job
+    :param connection: Optional. A queue connection to use instead of
+                       calling job_queue.connect(). The jobs are added to
+                       its index, if it has one.
+    :returns:          A list of the new jobs' ids
     """
     num = int(num)
+    phases.mark(job_config, 'queued')
     job = yaml.safe_dump(job_config)
     tube = job_config.pop('tube')
-    beanstalk = teuthology.beanstalk.connect()
-    beanstalk.use(tube)
-    while num > 0:
-        jid = beanstalk.put(
-            job,
-            ttr=60 * 60 * 24,
-            priority=job_config['priority'],
-        )
+    if config.fair_share:
+        # teuthology-dispatcher will move it to tube when its turn comes
+        tube = job_queue.pending_tube(tube)
+    queue = connection or job_queue.connect()
+    queue.use(tube)
+    queue_index = queue.index
+    jids = queue.put_many(
+        [job] * num,
+        ttr=60 * 60 * 24,
+        priority=job_config['priority'],
+    )
+    for jid in jids:
         print 'Job scheduled with name {name} and ID {jid}'.format(
             name=job_config['name'], jid=jid)
         job_config['job_id'] = str(jid)
+        if queue_index:
+            try:
+                queue_index.add(jid, tube, job_config)
+            except Exception:
+                log.exception("Could not add job %s to the queue index", jid)
         report.try_push_job_info(job_config, dict(status='queued'))
-        num -= 1
+    if connection is None:
+        queue.close()
+    return jids
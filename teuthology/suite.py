@@ -17,6 +17,7 @@ from email.mime.text import MIMEText
 from tempfile import NamedTemporaryFile
 
 import teuthology
+from . import durations
 from . import lock
 from .config import config, JobConfig
 from .exceptions import BranchNotFoundError
@@ -52,6 +53,10 @@ def main(args):
     timeout = args['--timeout']
     filter_in = args['--filter']
     filter_out = args['--filter-out']
+    order = args['--order']
+    if order and order not in durations.orders:
+        raise ValueError("--order must be one of: " +
+                         ', '.join(durations.orders))
 
     name = make_run_name(suite, ceph_branch, kernel_branch, kernel_flavor,
                          machine_type)
@@ -87,6 +92,7 @@ def main(args):
                          verbose=verbose,
                          filter_in=filter_in,
                          filter_out=filter_out,
+                         order=order,
                          )
     os.remove(base_yaml_path)
 
@@ -229,7 +235,7 @@ def create_initial_config(suite, suite_branch, ceph_branch, teuthology_branch,
 
 def prepare_and_schedule(job_config, suite_repo_path, base_yaml_paths, limit,
                          num, timeout, dry_run, verbose,
-                         filter_in, filter_out):
+                         filter_in, filter_out, order=None):
     """
     Puts together some "base arguments" with which to execute
     teuthology-schedule for each job, then passes them and other parameters to
@@ -270,6 +276,7 @@ def prepare_and_schedule(job_config, suite_repo_path, base_yaml_paths, limit,
         dry_run=dry_run,
         filter_in=filter_in,
         filter_out=filter_out,
+        order=order,
         )
 
     if job_config.email and num_jobs:
@@ -443,6 +450,7 @@ def schedule_suite(job_config,
                    dry_run=True,
                    filter_in=None,
                    filter_out=None,
+                   order=None,
                    ):
     """
     schedule one suite.
@@ -451,6 +459,7 @@ def schedule_suite(job_config,
     machine_type = job_config.machine_type
     suite_name = job_config.suite
     count = 0
+    jobs = []
     log.debug('Suite %s in %s' % (suite_name, path))
     configs = [(combine_path(suite_name, item[0]), item[1]) for item in
                build_matrix(path)]
@@ -463,18 +472,11 @@ def schedule_suite(job_config,
                 'Stopped after {limit} jobs due to --limit={limit}'.format(
                     limit=limit))
             break
-        if filter_in:
-            if not filter_in in description:
-                if all([x.find(filter_in) < 0 for x in fragment_paths]):
-                    continue
-        if filter_out:
-            if filter_out in description or any([filter_out in z
-                    for z in fragment_paths]):
-                continue
-
-        raw_yaml = '\n'.join([file(a, 'r').read() for a in fragment_paths])
-
-        parsed_yaml = yaml.load(raw_yaml)
+        if not match_filters(description, fragment_paths, filter_in,
+                             filter_out):
+            continue
+
+        parsed_yaml = parse_fragments(fragment_paths)
         os_type = parsed_yaml.get('os_type')
         exclude_arch = parsed_yaml.get('exclude_arch')
         exclude_os_type = parsed_yaml.get('exclude_os_type')
@@ -496,11 +498,26 @@ def schedule_suite(job_config,
                 description)
             continue
 
+        jobs.append((description, fragment_paths))
+        count += 1
+
+    if order and jobs:
+        jobs = order_suite_jobs(jobs, order, job_config.priority)
+    else:
+        jobs = [(description, fragment_paths, None) for
+                (description, fragment_paths) in jobs]
+
+    for description, fragment_paths, priority in jobs:
         log.info(
             'Scheduling %s', description
         )
 
         arg = copy.deepcopy(base_args)
+        if priority is not None:
+            if '--priority' in arg:
+                arg[arg.index('--priority') + 1] = str(priority)
+            else:
+                arg.extend(['--priority', str(priority)])
         arg.extend([
             '--description', description,
             '--',
@@ -522,13 +539,74 @@ def schedule_suite(job_config,
             subprocess.check_call(
                 args=arg,
             )
-        count += 1
     log.info('Suite %s in %s scheduled %d jobs.' % (suite_name, path, count))
     log.info('Suite %s in %s -- %d jobs were filtered out.' % (suite_name,
               path, len(configs) - count))
     return count
 
 
+def order_suite_jobs(jobs, order, priority):
+    """
+    Reorder a suite's jobs, and give each its own priority, using what the
+    archive says about how long they took and how often they failed before.
+    See durations.prioritize_jobs().
+
+    :param jobs:     A list of (description, fragment_paths) tuples
+    :param order:    'longest-first' or 'fail-first'
+    :param priority: The run's priority
+    :returns:        The reordered list, as (description, fragment_paths,
+                     priority) tuples; the priority is None if the jobs
+                     couldn't be reordered
+    """
+    store = durations.get_duration_store()
+    if store is None:
+        log.warn("Not reordering jobs")
+        return [(description, fragment_paths, None) for
+                (description, fragment_paths) in jobs]
+    try:
+        if os.path.isdir(config.archive_base):
+            recorded = store.update_from_archive(
+                config.archive_base, max_age=config.max_job_time)
+            log.debug("Recorded %d new job results", recorded)
+        priorities = durations.prioritize_jobs(
+            [description for (description, fragment_paths) in jobs], order,
+            store, priority)
+    finally:
+        store.close()
+    log.info("Queueing jobs %s", order)
+    return [jobs[index] + (job_priority,)
+            for (index, job_priority) in priorities]
+
+
+def match_filters(description, fragment_paths, filter_in=None,
+                  filter_out=None):
+    """
+    Decide whether a job passes the --filter and --filter-out options. Both
+    are matched against the job's description and its fragment paths.
+
+    :returns: True if the job should be scheduled
+    """
+    if filter_in:
+        if not filter_in in description:
+            if all([x.find(filter_in) < 0 for x in fragment_paths]):
+                return False
+    if filter_out:
+        if filter_out in description or any([filter_out in z
+                for z in fragment_paths]):
+            return False
+    return True
+
+
+def parse_fragments(fragment_paths):
+    """
+    Concatenate a job's yaml fragments and parse the result.
+
+    :returns: A dict
+    """
+    raw_yaml = '\n'.join([file(a, 'r').read() for a in fragment_paths])
+    return yaml.load(raw_yaml)
+
+
 def combine_path(left, right):
     """
     os.path.join(a, b) doesn't like it when b is None
@@ -611,16 +689,15 @@ def build_matrix(path):
 def get_arch(machine_type):
     """
     Based on a given machine_type, return its architecture by querying the lock
-    server. Sound expensive? It is!
+    server's machine type metadata, which is cached for the life of the
+    process.
 
     :returns: A string or None
     """
-    locks = lock.list_locks()
-    for machine in locks:
-        if machine['type'] == machine_type:
-            arch = machine['arch']
-            return arch
-    return None
+    info = lock.get_machine_type_info(machine_type)
+    if info is None:
+        return None
+    return info['arch']
 
 
 class Placeholder(object):
@@ -55,6 +55,13 @@ def base(ctx, config):
             )
 
 
+# How many machines of a type must be free before scheduled jobs may lock
+# any, so that there are some left for people to use
+MIN_FREE_FOR_SCHEDULED = 6
+# How long to ask the lock server to wait for machines to be free
+LOCK_WAIT = 120
+
+
 @contextlib.contextmanager
 def lock_machines(ctx, config):
     """
@@ -67,11 +74,13 @@ def lock_machines(ctx, config):
     machine_type = config[1]
     machine_types = teuthology.get_multi_machine_types(machine_type)
     how_many = config[0]
+    # Our place in the lock server's queue
+    reservation = dict()
 
     while True:
         # make sure there are enough machines up
-        machines = lock.list_locks()
-        if machines is None:
+        type_info = lock.get_machine_types(refresh=True)
+        if type_info is None:
             if ctx.block:
                 log.warn('error listing machines, trying again')
                 time.sleep(20)
@@ -79,28 +88,23 @@ def lock_machines(ctx, config):
             else:
                 assert 0, 'error listing machines'
 
-        is_up = lambda machine: machine['up'] and machine['type'] in machine_types  # noqa
-        num_up = len(filter(is_up, machines))
+        type_info = [type_info[t] for t in machine_types if t in type_info]
+        num_up = sum([info['up'] for info in type_info])
         assert num_up >= how_many, 'not enough machines are up'
 
         # make sure there are machines for non-automated jobs to run
-        is_up_and_free = lambda machine: machine['up'] and machine['locked'] == 0 and machine['type'] in machine_types  # noqa
-        up_and_free = filter(is_up_and_free, machines)
-        num_free = len(up_and_free)
-        if num_free < 6 and ctx.owner.startswith('scheduled'):
-            if ctx.block:
-                log.info(
-                    'waiting for more machines to be free (need %s see %s)...',
-                    how_many,
-                    num_free,
-                )
-                time.sleep(10)
-                continue
-            else:
-                assert 0, 'not enough machines free'
+        min_free = 0
+        if ctx.owner.startswith('scheduled'):
+            min_free = MIN_FREE_FOR_SCHEDULED
 
+        # Rather than poll, let the lock server hold on to the request until
+        # enough machines are free
+        started = time.time()
         newly_locked = lock.lock_many(ctx, how_many, machine_type, ctx.owner,
-                                      ctx.archive)
+                                      ctx.archive, min_free=min_free,
+                                      wait=LOCK_WAIT if ctx.block else 0,
+                                      priority=ctx.config.get('priority'),
+                                      reservation=reservation)
         if len(newly_locked) == how_many:
             vmlist = []
             for lmach in newly_locked:
@@ -128,8 +132,8 @@ def lock_machines(ctx, config):
                 if lock.update_keys(ctx, keyscan_out, current_locks):
                     log.info("Error in virtual machine keys")
                 newscandict = {}
-                for dkey in newly_locked.iterkeys():
-                    stats = lockstatus.get_status(ctx, dkey)
+                statuses = lockstatus.get_statuses(ctx, newly_locked.keys())
+                for dkey, stats in statuses.iteritems():
                     newscandict[dkey] = stats['sshpubkey']
                 ctx.config['targets'] = newscandict
             else:
@@ -140,16 +144,20 @@ def lock_machines(ctx, config):
         elif not ctx.block:
             assert 0, 'not enough machines are available'
 
-        log.warn('Could not lock enough machines, waiting...')
-        time.sleep(10)
+        if reservation.get('position'):
+            log.warn('Could not lock enough machines, waiting; %d ahead of '
+                     'us in the queue...', reservation['position'] - 1)
+        else:
+            log.warn('Could not lock enough machines, waiting...')
+        # Lock servers that don't know how to wait answer right away
+        time.sleep(max(0, 10 - (time.time() - started)))
     try:
         yield
     finally:
         if ctx.config.get('unlock_on_failure', False) or \
            ctx.summary.get('success', False):
             log.info('Unlocking machines...')
-            for machine in ctx.config['targets'].iterkeys():
-                lock.unlock_one(ctx, machine, ctx.owner)
+            lock.unlock_many(ctx, ctx.config['targets'].keys(), ctx.owner)
 
 def save_config(ctx, config):
     """
@@ -168,8 +176,8 @@ def check_lock(ctx, config):
         log.info('Lock checking disabled.')
         return
     log.info('Checking locks...')
-    for machine in ctx.config['targets'].iterkeys():
-        status = lockstatus.get_status(ctx, machine)
+    statuses = lockstatus.get_statuses(ctx, ctx.config['targets'].keys())
+    for machine, status in statuses.iteritems():
         log.debug('machine status is %s', repr(status))
         assert status is not None, \
             'could not read lock status for {name}'.format(name=machine)
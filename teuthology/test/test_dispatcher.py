@@ -0,0 +1,149 @@
+import fudge
+import fudge.inspector
+import os
+import shutil
+import tempfile
+import yaml
+
+from .. import dispatcher
+from .. import job_queue
+from .. import schedule
+from ..config import config
+
+
+def job(job_id, owner, name, priority=100):
+    return dict(job_id=job_id, owner=owner, name=name, priority=priority)
+
+
+class TestFairShare(object):
+    def test_least_active_owner(self):
+        pending = [job(1, 'nightly', 'big'), job(2, 'dev', 'small')]
+        active = [('nightly', 'big')]
+        choice = dispatcher.FairShare().choose(pending, active)
+        assert choice['job_id'] == 2
+
+    def test_weights(self):
+        pending = [job(1, 'nightly', 'big'), job(2, 'dev', 'small')]
+        active = [('nightly', 'big')] * 3 + [('dev', 'small')]
+        fair_share = dispatcher.FairShare(weights=dict(nightly=4))
+        assert fair_share.choose(pending, active)['job_id'] == 1
+
+    def test_runs_within_owner(self):
+        pending = [job(1, 'dev', 'run1'), job(2, 'dev', 'run2')]
+        active = [('dev', 'run1')]
+        choice = dispatcher.FairShare().choose(pending, active)
+        assert choice['job_id'] == 2
+
+    def test_priority_tiebreak(self):
+        pending = [job(1, 'dev', 'run1', priority=100),
+                   job(2, 'other', 'run2', priority=10),
+                   job(3, 'other', 'run2', priority=10)]
+        choice = dispatcher.FairShare().choose(pending, [])
+        assert choice['job_id'] == 2
+
+    def test_limits(self):
+        pending = [job(1, 'dev', 'run1')]
+        active = [('dev', 'run1')] * 2
+        fair_share = dispatcher.FairShare(limits=dict(dev=2))
+        assert fair_share.choose(pending, active) is None
+
+
+class TestDispatcher(object):
+    def setup(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.saved = (config.fair_share, config.results_server)
+        config.fair_share = True
+        config.results_server = None
+        self.queue = job_queue.SQLiteQueue(
+            os.path.join(self.tmp_dir, 'queue.db'))
+        self.state_file_path = os.path.join(self.tmp_dir, 'stats')
+
+    def teardown(self):
+        config.fair_share, config.results_server = self.saved
+        self.queue.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def schedule(self, owner, name, num=1):
+        schedule.schedule_job(
+            dict(owner=owner, name=name, priority=100, tube='plana'),
+            num=num, connection=self.queue)
+
+    def make_dispatcher(self, backlog=2):
+        return dispatcher.Dispatcher(self.queue, 'plana',
+                                     dispatcher.FairShare(), backlog=backlog,
+                                     state_file_path=self.state_file_path)
+
+    def test_scheduled_to_pending(self):
+        self.schedule('dev', 'run1')
+        assert self.queue.stats_tube('plana-pending')['current-jobs-ready'] \
+            == 1
+        assert self.queue.stats_tube('plana')['current-jobs-ready'] == 0
+
+    def test_dispatch(self):
+        self.schedule('nightly', 'big', num=5)
+        self.schedule('dev', 'small', num=2)
+        the_dispatcher = self.make_dispatcher(backlog=2)
+        assert len(the_dispatcher.dispatch()) == 2
+        # The backlog is full
+        assert the_dispatcher.dispatch() == []
+        owners = [yaml.safe_load(info['body'])['owner'] for info in
+                  self.queue.db.execute(
+                      "SELECT body FROM jobs WHERE tube = 'plana' "
+                      "ORDER BY job_id")]
+        assert sorted(owners) == ['dev', 'nightly']
+
+        # A worker takes both jobs and finishes the first one
+        self.queue.watch('plana')
+        self.queue.ignore('default')
+        first = self.queue.reserve(timeout=0)
+        second = self.queue.reserve(timeout=0)
+        second.bury()
+        first.delete()
+        the_dispatcher.dispatch()
+        with file(self.state_file_path) as state_file:
+            stats = yaml.safe_load(state_file)
+        # The buried job is still in flight; two more were dispatched
+        assert sum([s['active'] for s in stats.values()]) == 3
+        assert sum([s['pending'] for s in stats.values()]) == 3
+        assert stats['dev']['max_wait'] is not None
+
+    def test_restart(self):
+        self.schedule('dev', 'run1', num=4)
+        self.make_dispatcher(backlog=3).dispatch()
+        # A worker runs one job and defers another
+        self.queue.watch('plana')
+        self.queue.ignore('default')
+        self.queue.reserve(timeout=0).bury()
+        self.queue.reserve(timeout=0).release(delay=60)
+        # A new dispatcher knows about the jobs the old one dispatched
+        assert len(self.make_dispatcher().active) == 3
+
+    def test_promote_killed(self):
+        job_id = self.queue.put(
+            yaml.safe_dump(dict(owner='dev', name='run1', priority=100)))
+        job = self.queue.peek(job_id)
+        the_dispatcher = self.make_dispatcher()
+        # teuthology-kill deletes the job while it is being promoted
+        self.queue.peek = lambda job_id: job
+        job.delete()
+        assert the_dispatcher.promote(
+            dict(job_id=job_id, owner='dev', name='run1', priority=100,
+                 queued_at=0)) is None
+        assert self.queue.stats_tube('plana')['current-jobs-ready'] == 0
+
+    @fudge.patch('teuthology.report.try_push_job_info',
+                 'teuthology.report.try_delete_jobs')
+    def test_promote_reports(self, m_try_push_job_info, m_try_delete_jobs):
+        job_id = self.queue.put(
+            yaml.safe_dump(dict(owner='dev', name='run1', priority=100)))
+        m_try_push_job_info.expects_call().with_args(
+            fudge.inspector.arg.passes_test(
+                lambda job_config: job_config['name'] == 'run1' and
+                job_config['job_id'] != str(job_id)),
+            dict(status='queued'))
+        m_try_delete_jobs.expects_call().with_args(
+            'run1', str(job_id), delete_empty_run=False)
+        new_id = self.make_dispatcher().promote(
+            dict(job_id=job_id, owner='dev', name='run1', priority=100,
+                 queued_at=0))
+        assert new_id != job_id
@@ -0,0 +1,200 @@
+import fudge
+import os
+import shutil
+import sqlite3
+import tempfile
+import yaml
+
+from pytest import raises
+
+import fake_archive
+from .. import beanstalk
+from .. import durations
+from ..config import config
+
+
+def make_job(job_id, description, duration, success=True):
+    return dict(
+        job_id=job_id,
+        info=dict(description=description, job_id=job_id),
+        summary=dict(description=description, duration=duration,
+                     success=success),
+    )
+
+
+class TestDurationStore(object):
+    def setup(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.archive = fake_archive.FakeArchive(
+            os.path.join(self.tmp_dir, 'archive'))
+        self.archive.setup()
+        self.store = durations.DurationStore(
+            os.path.join(self.tmp_dir, 'durations.db'))
+
+    def teardown(self):
+        self.store.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def test_normalize_description(self):
+        description = 'rados:thrash/{a.yaml  b.yaml}\n'
+        assert durations.normalize_description(description) == \
+            'rados/thrash/{a.yaml b.yaml}'
+
+    def test_update_from_archive(self):
+        self.archive.populate_archive('run1', [
+            make_job(1, 'rados:basic/{a.yaml}', 100),
+            make_job(2, 'rados:basic/{b.yaml}', 500, success=False),
+        ])
+        config_path = os.path.join(self.archive.archive_base, 'run1', '1',
+                                   'orig.config.yaml')
+        with file(config_path, 'w') as config_file:
+            yaml.safe_dump(dict(roles=[['mon.a'], ['osd.0']]), config_file)
+        assert self.store.update_from_archive(self.archive.archive_base) == 2
+        assert self.store.predict_many(['rados:basic/{a.yaml}']) == \
+            {'rados/basic/{a.yaml}': (100, 0, 2)}
+        # Nothing new to record
+        assert self.store.update_from_archive(self.archive.archive_base) == 0
+        assert self.store.predict('rados/basic/{a.yaml}') == (100, 0)
+        assert self.store.predict('rados:basic/{b.yaml}') == (500, 1)
+        assert self.store.predict('rados:basic/{c.yaml}') is None
+
+    def test_unfinished_run(self):
+        job = make_job(2, 'rados:basic/{b.yaml}', 500)
+        del job['summary']
+        self.archive.populate_archive('run1', [
+            make_job(1, 'rados:basic/{a.yaml}', 100), job])
+        assert self.store.update_from_archive(self.archive.archive_base) == 1
+        # The job finishes
+        self.archive.teardown()
+        self.archive.setup()
+        self.archive.populate_archive('run1', [
+            make_job(1, 'rados:basic/{a.yaml}', 100),
+            make_job(2, 'rados:basic/{b.yaml}', 500)])
+        assert self.store.update_from_archive(self.archive.archive_base) == 1
+
+    def test_dead_job(self):
+        job = make_job(2, 'rados:basic/{b.yaml}', 500)
+        del job['summary']
+        self.archive.populate_archive('run1', [
+            make_job(1, 'rados:basic/{a.yaml}', 100), job])
+        run_dir = os.path.join(self.archive.archive_base, 'run1')
+        # Too long ago for job 2 to be running still
+        os.utime(run_dir, (0, 0))
+        assert self.store.update_from_archive(self.archive.archive_base,
+                                              max_age=3600) == 1
+        with fudge.patched_context(self.store, 'update_run',
+                                   fudge.Fake('update_run')):
+            # Calling the fake would raise, since no calls are expected
+            assert self.store.update_from_archive(
+                self.archive.archive_base, max_age=3600) == 0
+
+    def test_default_db_path(self):
+        saved = (config.duration_db_path, config.archive_base)
+        try:
+            config.duration_db_path = None
+            config.archive_base = '/var/lib/teuthworker/archive/'
+            assert durations.get_duration_db_path() == \
+                '/var/lib/teuthworker/job_durations.db'
+            config.duration_db_path = '/tmp/durations.db'
+            assert durations.get_duration_db_path() == '/tmp/durations.db'
+        finally:
+            config.duration_db_path, config.archive_base = saved
+
+    def test_predict(self):
+        for i, duration in enumerate([10, 30, 20, 1000]):
+            self.store.record('run%d' % i, 1, 'desc', duration, i % 2,
+                              finished_at=i)
+        assert self.store.predict('desc') == (25, 0.5)
+
+    def test_order(self):
+        self.store.record('run1', 1, 'short', 10, True)
+        self.store.record('run1', 2, 'long', 1000, True)
+        self.store.record('run1', 3, 'flaky', 50, False)
+        descriptions = ['short', 'new', 'flaky', 'long']
+        priorities = durations.prioritize_jobs(descriptions, 'longest-first',
+                                               self.store, 1000)
+        assert [index for (index, _) in priorities] == [3, 1, 2, 0]
+        priorities = durations.prioritize_jobs(descriptions, 'fail-first',
+                                               self.store, 1000)
+        assert [index for (index, _) in priorities] == [2, 1, 3, 0]
+        with raises(ValueError):
+            durations.prioritize_jobs(descriptions, 'shortest-first',
+                                      self.store, 1000)
+
+    def test_prioritize_jobs(self):
+        self.store.record('run1', 1, 'short', 10, True)
+        self.store.record('run1', 2, 'long', 4 * 3600, True)
+        self.store.record('run1', 3, 'longer', 20 * 3600, False)
+        descriptions = ['short', 'long', 'longer']
+        assert durations.prioritize_jobs(
+            descriptions, 'longest-first', self.store, 1000) == \
+            [(2, 1000 - durations.PRIORITY_LEVELS + 1), (1, 996), (0, 1000)]
+        assert durations.prioritize_jobs(
+            descriptions, 'fail-first', self.store, 1000) == \
+            [(2, 991), (1, 1000), (0, 1000)]
+        # Priorities don't go below zero
+        assert durations.prioritize_jobs(
+            descriptions, 'longest-first', self.store, 2) == \
+            [(2, 0), (1, 0), (0, 2)]
+
+    def test_add_columns(self):
+        path = os.path.join(self.tmp_dir, 'old.db')
+        db = sqlite3.connect(path)
+        db.execute("""CREATE TABLE jobs (run_name TEXT, job_id TEXT,
+            key TEXT, duration REAL, success INTEGER, finished_at REAL,
+            PRIMARY KEY (run_name, job_id))""")
+        db.close()
+        store = durations.DurationStore(path)
+        store.record('run1', 1, 'desc', 10, True, machines=3)
+        assert store.predict_many(['desc']) == {'desc': (10, 0, 3)}
+        store.close()
+
+
+class TestForecast(object):
+    def setup(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.store = durations.DurationStore(
+            os.path.join(self.tmp_dir, 'durations.db'))
+        self.store.record('old', 1, 'short', 3600, True, machines=1)
+        self.store.record('old', 2, 'long', 7200, True, machines=2)
+
+    def teardown(self):
+        self.store.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def test_forecast(self):
+        jobs = [dict(name='run1', description='long'),
+                dict(name='run1', description='short'),
+                dict(name='run2', description='short'),
+                dict(name='run2', description='new')]
+        total, runs = durations.forecast(jobs, self.store, capacity=2, now=0)
+        # 'new' gets the average duration, 5400s, and 2 machines
+        assert total == dict(jobs=4, machine_hours=4 + 1 + 1 + 3)
+        assert runs.keys() == ['run1', 'run2']
+        # The long job needs both machines, so the short one waits for it
+        assert runs['run1'] == dict(jobs=2, machine_hours=5, start=0,
+                                    finish=7200 + 3600)
+        assert runs['run2']['start'] == 5 * 3600 / 2
+        assert runs['run2']['finish'] == 6 * 3600 / 2 + 5400
+
+    def test_busy(self):
+        jobs = [dict(name='run1', description='short')]
+        total, runs = durations.forecast(jobs, self.store, capacity=2,
+                                         busy=2, now=0)
+        # The busy machines are half way through average-length jobs
+        assert runs['run1']['start'] == 2 * 3600 / 2 / 2
+
+    def test_no_capacity(self):
+        jobs = [dict(name='run1', description='short')]
+        total, runs = durations.forecast(jobs, self.store, capacity=0)
+        assert runs['run1']['start'] is None
+        assert runs['run1']['finish'] is None
+
+    @fudge.patch('teuthology.lock.get_machine_types')
+    def test_eta_printer(self, m_get_machine_types):
+        m_get_machine_types.expects_call().returns(dict(
+            plana=dict(up=4, locked=1), mira=dict(up=2, locked=3)))
+        processor = beanstalk.ETAPrinter('plana,mira', self.store)
+        assert processor.get_capacity() == (6, 3)
+        processor.add_job(1, dict(name='run1', description='short'))
+        processor.report(now=0)
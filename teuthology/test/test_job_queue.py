@@ -0,0 +1,170 @@
+import beanstalkc
+import os
+import shutil
+import tempfile
+import yaml
+
+from pytest import raises
+
+from .. import beanstalk
+from .. import job_queue
+from .. import schedule
+from ..config import config
+
+
+def make_body(name, machine_type='plana', description='desc'):
+    return yaml.safe_dump(dict(name=name, machine_type=machine_type,
+                               description=description, owner='owner'))
+
+
+class TestSQLiteQueue(object):
+    def setup(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'queue.db')
+        self.queue = job_queue.SQLiteQueue(self.path)
+        self.queue.use('plana')
+        beanstalk.watch_tube(self.queue, 'plana')
+
+    def teardown(self):
+        self.queue.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def test_priority_order(self):
+        low = self.queue.put(make_body('run1'), priority=100)
+        high = self.queue.put(make_body('run2'), priority=10)
+        later = self.queue.put(make_body('run3'), priority=10)
+        assert [self.queue.reserve(timeout=0).jid for i in range(3)] == \
+            [high, later, low]
+        assert self.queue.reserve(timeout=0) is None
+
+    def test_watch(self):
+        self.queue.use('mira')
+        self.queue.put(make_body('run1'))
+        assert self.queue.reserve(timeout=0) is None
+        self.queue.watch('mira')
+        assert self.queue.reserve(timeout=0) is not None
+
+    def test_put_many(self):
+        job_ids = self.queue.put_many([make_body('run1')] * 3, priority=5)
+        assert len(job_ids) == 3
+        stats = self.queue.stats_tube('plana')
+        assert stats['current-jobs-ready'] == 3
+        assert self.queue.stats_job(job_ids[0])['pri'] == 5
+
+    def test_bury_release_delete(self):
+        self.queue.put(make_body('run1'))
+        job = self.queue.reserve(timeout=0)
+        assert job.stats()['state'] == 'reserved'
+        job.release(delay=0)
+        assert job.stats()['state'] == 'ready'
+        assert job.stats()['releases'] == 1
+        job = self.queue.reserve(timeout=0)
+        job.bury()
+        assert job.stats()['state'] == 'buried'
+        job.delete()
+        with raises(beanstalkc.CommandFailed):
+            self.queue.stats_job(job.jid)
+
+    def test_release_delay(self):
+        self.queue.put(make_body('run1'))
+        job = self.queue.reserve(timeout=0)
+        job.release(delay=3600)
+        assert job.stats()['state'] == 'delayed'
+        assert self.queue.reserve(timeout=0) is None
+
+    def test_ttr(self):
+        self.queue.put(make_body('run1'), ttr=-1)
+        job = self.queue.reserve(timeout=0)
+        # The ttr has already run out, so another client can reserve it
+        other = job_queue.SQLiteQueue(self.path)
+        other.watch('plana')
+        assert other.reserve(timeout=0).jid == job.jid
+        other.close()
+
+    def test_reserved_elsewhere(self):
+        self.queue.put(make_body('run1'))
+        other = job_queue.SQLiteQueue(self.path)
+        other.watch('plana')
+        job = other.reserve(timeout=0)
+        assert self.queue.reserve(timeout=0) is None
+        with raises(beanstalkc.CommandFailed):
+            self.queue.peek(job.jid).delete()
+        # Closing a connection frees the jobs it reserved
+        other.close()
+        assert self.queue.reserve(timeout=0).jid == job.jid
+
+    def test_peek(self):
+        second = self.queue.put(make_body('run1'), priority=10)
+        first = self.queue.put(make_body('run2'), priority=1)
+        assert self.queue.peek_ready().jid == first
+        assert yaml.safe_load(self.queue.peek(first).body)['name'] == 'run2'
+        assert self.queue.peek(second) is not None
+        assert self.queue.peek(first + 100) is None
+
+    def test_jobs(self):
+        self.queue.put(make_body('run1'))
+        self.queue.put(make_body('run1', machine_type='plana,mira'))
+        self.queue.put(make_body('run2'))
+        self.queue.reserve(timeout=0)
+        jobs = self.queue.jobs(tube='plana')
+        assert [(j['job_id'], j['name']) for j in jobs] == \
+            [(2, 'run1'), (3, 'run2')]
+        assert jobs[0]['machine_type'] == 'plana,mira'
+        assert jobs[0]['description'] == 'desc'
+        assert [j['job_id'] for j in self.queue.jobs(run_name='run2')] == [3]
+        assert [j['job_id'] for j in
+                self.queue.jobs(machine_type='plana')] == [3]
+
+    def test_delete_by_run(self):
+        self.queue.put(make_body('run1'))
+        self.queue.put(make_body('run2'))
+        self.queue.put(make_body('run1'))
+        # Deferred by a worker
+        self.queue.put(make_body('run1'), delay=60)
+        processor = beanstalk.JobProcessor()
+        assert self.queue.delete_by_run('plana', 'run1', processor) == \
+            [1, 3, 4]
+        assert processor.jobs.keys() == ['1', '3', '4']
+        assert [j['name'] for j in self.queue.jobs()] == ['run2']
+
+    def test_delete_delayed(self):
+        self.queue.put(make_body('run1'), delay=60)
+        self.queue.put(make_body('run2'), delay=60)
+        self.queue.put(make_body('run1'), delay=60)
+        assert job_queue.delete_delayed_jobs(
+            self.queue, 'plana', lambda name: name == 'run1') == [1, 3]
+        # The other run's job was kicked to get at the one behind it
+        assert [j['job_id'] for j in self.queue.jobs()] == [2]
+
+    def test_walk_index(self):
+        self.queue.put(make_body('run1'))
+        self.queue.put(make_body('run2'))
+        processor = beanstalk.JobProcessor()
+        beanstalk.walk_index(self.queue, 'plana', processor,
+                             self.queue.index, pattern='run2')
+        assert processor.jobs.keys() == ['2']
+
+    def test_schedule_job(self):
+        saved = config.results_server
+        config.results_server = None
+        try:
+            job_ids = schedule.schedule_job(
+                dict(name='run1', priority=50, tube='plana'), num=2,
+                connection=self.queue)
+        finally:
+            config.results_server = saved
+        assert job_ids == [1, 2]
+        assert self.queue.stats_job(2)['pri'] == 50
+
+
+class TestConnect(object):
+    def setup(self):
+        self.saved = config.queue_backend
+
+    def teardown(self):
+        config.queue_backend = self.saved
+
+    def test_unknown_backend(self):
+        config.queue_backend = 'carrier_pigeon'
+        with raises(ValueError):
+            job_queue.connect()
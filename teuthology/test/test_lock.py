@@ -0,0 +1,218 @@
+import fudge
+import fudge.inspector
+import json
+
+from .. import lock
+from .. import suite
+from ..config import config
+
+
+machine_types = {
+    'plana': {
+        'arch': 'x86_64',
+        'count': 3,
+        'up': 2,
+        'locked': 1,
+        'free': 1,
+        'owners': {'user@host': {'count': 1, 'up': 1}},
+    },
+    'saya': {
+        'arch': 'armv7l',
+        'count': 1,
+        'up': 1,
+        'locked': 0,
+        'free': 1,
+        'owners': {},
+    },
+}
+
+
+class TestMachineTypes(object):
+    def setup(self):
+        lock._machine_types = None
+        config.lock_server = 'http://lockserver/lock'
+
+    def teardown(self):
+        lock._machine_types = None
+
+    @fudge.patch('teuthology.lockstatus.send_request')
+    def test_cached(self, fake_send):
+        fake_send.expects_call().with_args(
+            'GET', 'http://lockserver/lock/types/').returns(
+                (True, json.dumps(machine_types), 200)).times_called(1)
+        assert lock.get_machine_type_info('plana')['free'] == 1
+        assert lock.get_machine_type_info('saya')['arch'] == 'armv7l'
+        assert lock.get_machine_type_info('mira') is None
+
+    @fudge.patch('teuthology.lockstatus.send_request')
+    def test_refresh(self, fake_send):
+        fake_send.expects_call().returns(
+            (True, json.dumps(machine_types), 200)).times_called(2)
+        lock.get_machine_types()
+        lock.get_machine_types(refresh=True)
+
+    @fudge.patch('teuthology.lockstatus.send_request')
+    def test_failure_not_cached(self, fake_send):
+        fake_send.expects_call().returns((False, None, 500)).next_call()\
+            .returns((True, json.dumps(machine_types), 200))
+        assert lock.get_machine_types() is None
+        assert lock.get_machine_types() == machine_types
+
+    @fudge.patch('teuthology.lockstatus.send_request')
+    def test_get_arch(self, fake_send):
+        fake_send.expects_call().returns(
+            (True, json.dumps(machine_types), 200)).times_called(1)
+        assert suite.get_arch('saya') == 'armv7l'
+        assert suite.get_arch('plana') == 'x86_64'
+        assert suite.get_arch('mira') is None
+
+
+class TestListLocks(object):
+    def setup(self):
+        config.lock_server = 'http://lockserver/lock'
+        lock.ls._etag_cache.clear()
+
+    def teardown(self):
+        lock.ls._etag_cache.clear()
+
+    @fudge.patch('teuthology.lockstatus.send_conditional_get')
+    def test_unfiltered(self, fake_get):
+        fake_get.expects_call().with_args('http://lockserver/lock').returns(
+            (True, '[]', 200))
+        assert lock.list_locks() == []
+
+    @fudge.patch('teuthology.lockstatus.send_conditional_get')
+    def test_filters(self, fake_get):
+        fake_get.expects_call().with_args(
+            'http://lockserver/lock?fields=name%2Cdescription&locked=true&'
+            'locked_by=user%40host&machinetype=plana&up=false').returns(
+                (True, '[]', 200))
+        lock.list_locks(machine_type='plana', up=False, locked=True,
+                        locked_by='user@host',
+                        fields=['name', 'description'])
+
+    @fudge.patch('teuthology.lockstatus.send_conditional_get')
+    def test_failure(self, fake_get):
+        fake_get.expects_call().returns((False, None, 500))
+        assert lock.list_locks() is None
+
+
+class TestBulkRequests(object):
+    def setup(self):
+        config.lock_server = 'http://lockserver/lock'
+
+    @fudge.patch('teuthology.lockstatus.send_request')
+    def test_unlock_many(self, fake_send):
+        names = ['ubuntu@plana01', 'ubuntu@plana02']
+        fake_send.expects_call().with_args(
+            'DELETE', 'http://lockserver/lock',
+            body=json.dumps(dict(user='user@host', names=names)),
+            headers={'Content-type': 'application/json'}).returns(
+                (True, json.dumps(names), 200)).times_called(1)
+        assert lock.unlock_many(None, names, 'user@host') == names
+
+    @fudge.patch('teuthology.lockstatus.send_request',
+                 'teuthology.lock.unlock_one')
+    def test_unlock_many_fallback(self, fake_send, fake_unlock_one):
+        fake_send.expects_call().returns((False, None, 405))
+        fake_unlock_one.expects_call().with_args(
+            None, 'ubuntu@plana01', 'user@host').returns(True)
+        fake_unlock_one.next_call().with_args(
+            None, 'ubuntu@plana02', 'user@host').returns(False)
+        assert lock.unlock_many(None, ['ubuntu@plana01', 'ubuntu@plana02'],
+                                'user@host') == ['ubuntu@plana01']
+
+    @fudge.patch('teuthology.lockstatus.send_request',
+                 'teuthology.lock.unlock_one')
+    def test_unlock_many_refused(self, fake_send, fake_unlock_one):
+        # Not ours; asking about each machine wouldn't help
+        fake_send.expects_call().returns((False, None, 403))
+        assert lock.unlock_many(None, ['ubuntu@plana01', 'ubuntu@plana02'],
+                                'user@host') == []
+
+    def test_unlock_none(self):
+        assert lock.unlock_many(None, []) == []
+
+    @fudge.patch('teuthology.lockstatus.send_request')
+    def test_update_locks(self, fake_send):
+        def check_body(body):
+            assert json.loads(body) == dict(user=None, updates={
+                'ubuntu@plana01': dict(desc='new'),
+                'ubuntu@plana02': dict(status='down', sshpubkey='key'),
+            })
+            return True
+        fake_send.expects_call().with_args(
+            'PUT', 'http://lockserver/lock',
+            body=fudge.inspector.arg.passes_test(check_body),
+            headers={'Content-type': 'application/json'}).returns(
+                (True, '[]', 200)).times_called(1)
+        assert lock.update_locks(None, {
+            'ubuntu@plana01': dict(description='new', status=None),
+            'ubuntu@plana02': dict(status='down', sshpubkey='key'),
+            'ubuntu@plana03': dict(description=None),
+        })
+
+    @fudge.patch('teuthology.lock.keyscan_check', 'time.sleep')
+    def test_wait_for_vms(self, fake_keyscan, fake_sleep):
+        fake_sleep.is_callable()
+        fake_keyscan.expects_call().with_args(
+            None, ['ubuntu@vpm001', 'ubuntu@vpm002']).returns(
+                ('vpm001 ssh-rsa key1\n', dict()))
+        fake_keyscan.next_call().with_args(None, ['ubuntu@vpm002']).returns(
+            ('', dict()))
+        assert lock.wait_for_vms(None, ['ubuntu@vpm001', 'ubuntu@vpm002'],
+                                 tries=2) == ['ubuntu@vpm002']
+
+    @fudge.patch('teuthology.lockstatus.send_request',
+                 'teuthology.lock.wait_for_vms')
+    def test_update_locks_vm_timeout(self, fake_send, fake_wait):
+        fake_wait.expects_call().with_args(
+            None, ['ubuntu@vpm002']).returns(['ubuntu@vpm002'])
+        fake_send.expects_call().with_args(
+            'PUT', 'http://lockserver/lock',
+            body=fudge.inspector.arg.passes_test(
+                lambda body: json.loads(body)['updates'].keys() ==
+                ['ubuntu@plana01']),
+            headers={'Content-type': 'application/json'}).returns(
+                (True, '[]', 200))
+        assert not lock.update_locks(None, {
+            'ubuntu@plana01': dict(description='new'),
+            'ubuntu@vpm002': dict(sshpubkey='key'),
+        })
+
+    @fudge.patch('teuthology.lockstatus.send_request')
+    def test_lock_many_wait(self, fake_send):
+        body = ('desc=desc&machinetype=plana%2Cmira&min_free=6&num=2&'
+                'user=user%40host&wait=120')
+
+        def check_body(sent):
+            return sorted(sent.split('&')) == body.split('&')
+        fake_send.expects_call().with_args(
+            'POST', 'http://lockserver/lock',
+            fudge.inspector.arg.passes_test(check_body),
+            timeout=config.lock_server_timeout + 120).returns(
+                (True, json.dumps({'ubuntu@mira01': 'key'}), 200))
+        assert lock.lock_many(None, 2, 'plana,mira', 'user@host', 'desc',
+                              min_free=6, wait=120) == \
+            {'ubuntu@mira01': 'key'}
+
+    @fudge.patch('teuthology.lockstatus.send_request')
+    def test_lock_many_reservation(self, fake_send):
+        fake_send.expects_call().with_args(
+            'POST', 'http://lockserver/lock',
+            fudge.inspector.arg.passes_test(
+                lambda body: 'reservation' not in body),
+            timeout=fudge.inspector.arg.any()).returns(
+                (False, json.dumps(dict(reservation=7, position=3)), 503))
+        fake_send.next_call().with_args(
+            'POST', 'http://lockserver/lock',
+            fudge.inspector.arg.contains('reservation=7'),
+            timeout=fudge.inspector.arg.any()).returns(
+                (True, json.dumps({'ubuntu@plana01': 'key'}), 200))
+        reservation = dict()
+        assert lock.lock_many(None, 1, 'plana', 'user@host', wait=60,
+                              reservation=reservation) == []
+        assert reservation == dict(reservation=7, position=3)
+        assert lock.lock_many(None, 1, 'plana', 'user@host', wait=60,
+                              reservation=reservation) == \
+            {'ubuntu@plana01': 'key'}
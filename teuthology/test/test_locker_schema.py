@@ -0,0 +1,71 @@
+import web
+
+from ..locker import schema
+
+
+def explain(db, query):
+    return ' / '.join([row.detail for row in
+                       db.query('EXPLAIN QUERY PLAN ' + query)])
+
+
+class TestSchema(object):
+    def setup(self):
+        self.db = web.database(dbn='sqlite', db=':memory:')
+        self.db.printing = False
+        schema.create_sqlite(self.db)
+
+    def test_migrate(self):
+        assert schema.migrate(self.db) == []
+        self.db.query('DROP INDEX machine_locks')
+        assert schema.migrate(self.db) == ['machine_locks']
+        assert 'machine_locks' in schema.get_indexes(self.db, 'machine')
+
+    def test_migrate_tables(self):
+        self.db.query('DROP TABLE reservation')
+        assert 'reservation' not in schema.get_tables(self.db)
+        assert schema.migrate(self.db) == ['reservation', 'reservation_order']
+        assert 'reservation' in schema.get_tables(self.db)
+
+    def test_claim_plan(self):
+        plan = explain(
+            self.db,
+            "UPDATE machine SET locked = true, locked_by = 'user', "
+            "description = 'token', locked_since = CURRENT_TIMESTAMP "
+            "WHERE name IN (SELECT name FROM machine WHERE locked = false "
+            "AND up = true AND type = 'plana' ORDER BY name LIMIT 3)")
+        assert 'USING INDEX machine_state (type=? AND locked=? AND up=?)' \
+            in plan
+        assert 'SCAN machine' not in plan
+
+    def test_reuse_plan(self):
+        plan = explain(
+            self.db,
+            "SELECT name, sshpubkey FROM machine WHERE locked = true AND "
+            "up = true AND type = 'plana' AND description = 'desc' AND "
+            "locked_by = 'user' LIMIT 3")
+        assert plan.startswith('SEARCH machine USING INDEX')
+
+    def test_claimed_plan(self):
+        plan = explain(
+            self.db,
+            "SELECT name, sshpubkey, type FROM machine "
+            "WHERE description = 'token'")
+        assert plan == \
+            'SEARCH machine USING INDEX machine_description (description=?)'
+
+    def test_summary_plans(self):
+        plan = explain(
+            self.db,
+            "SELECT type, MIN(arch) AS arch, COUNT(*) AS count, "
+            "SUM(CASE WHEN up THEN 1 ELSE 0 END) AS up, "
+            "SUM(CASE WHEN locked THEN 1 ELSE 0 END) AS locked, "
+            "SUM(CASE WHEN up AND NOT locked THEN 1 ELSE 0 END) AS free "
+            "FROM machine GROUP BY type")
+        assert plan == 'SCAN machine USING COVERING INDEX machine_state'
+        plan = explain(
+            self.db,
+            "SELECT type, locked_by, COUNT(*) AS count, "
+            "SUM(CASE WHEN up THEN 1 ELSE 0 END) AS up "
+            "FROM machine WHERE locked = true GROUP BY type, locked_by")
+        assert plan == \
+            'SEARCH machine USING COVERING INDEX machine_locks (locked=?)'
@@ -0,0 +1,82 @@
+import fudge
+import json
+import requests
+
+from .. import lockstatus
+from ..config import config
+
+
+class FakeResponse(object):
+    def __init__(self, status_code, content='', etag=None):
+        self.status_code = status_code
+        self.content = content
+        self.headers = dict()
+        if etag:
+            self.headers['etag'] = etag
+
+
+class TestLockStatus(object):
+    def setup(self):
+        config.lock_server = 'http://lockserver/lock'
+        lockstatus._etag_cache.clear()
+        self.saved_backoff = lockstatus.backoff
+        lockstatus.backoff = 0
+
+    def teardown(self):
+        lockstatus._etag_cache.clear()
+        lockstatus.backoff = self.saved_backoff
+
+    def test_session_shared(self):
+        assert lockstatus.get_session() is lockstatus.get_session()
+
+    @fudge.patch('teuthology.lockstatus.get_session')
+    def test_not_modified(self, fake_get_session):
+        url = 'http://lockserver/lock'
+        body = json.dumps([dict(name='plana01')])
+        session = fake_get_session.expects_call().returns_fake()
+        session.expects('request').with_args(
+            'GET', url, data=None, headers={},
+            timeout=config.lock_server_timeout).returns(
+                FakeResponse(200, body, etag='"abc"'))
+        session.next_call().with_args(
+            'GET', url, data=None, headers={'If-None-Match': '"abc"'},
+            timeout=config.lock_server_timeout).returns(FakeResponse(304))
+        assert lockstatus.send_conditional_get(url) == (True, body, 200)
+        assert lockstatus.send_conditional_get(url) == (True, body, 304)
+
+    @fudge.patch('teuthology.lockstatus.get_session')
+    def test_retry(self, fake_get_session):
+        session = fake_get_session.expects_call().returns_fake()
+        session.expects('request').raises(
+            requests.exceptions.ConnectionError()).next_call().returns(
+                FakeResponse(200, '{}'))
+        assert lockstatus.send_request('GET', 'http://lockserver/lock/x') \
+            == (True, '{}', 200)
+
+    @fudge.patch('teuthology.lockstatus.get_session')
+    def test_no_post_retry(self, fake_get_session):
+        session = fake_get_session.expects_call().returns_fake()
+        session.expects('request').raises(
+            requests.exceptions.ReadTimeout()).times_called(1)
+        try:
+            lockstatus.send_request('POST', 'http://lockserver/lock')
+        except requests.exceptions.ReadTimeout:
+            pass
+        else:
+            assert False, 'ReadTimeout not raised'
+
+    @fudge.patch('teuthology.lockstatus.send_request')
+    def test_get_statuses(self, fake_send):
+        statuses = [dict(name='plana01', up=True),
+                    dict(name='plana03', up=False)]
+        fake_send.expects_call().with_args(
+            'GET', 'http://lockserver/lock?names=plana01%2Cplana02').returns(
+                (True, json.dumps(statuses), 200)).times_called(1)
+        assert lockstatus.get_statuses(None, ['plana02', 'plana01']) == dict(
+            plana01=dict(name='plana01', up=True), plana02=None)
+
+    @fudge.patch('teuthology.lockstatus.send_request')
+    def test_get_statuses_failure(self, fake_send):
+        fake_send.expects_call().returns((False, None, 500))
+        assert lockstatus.get_statuses(None, ['plana01']) == dict(
+            plana01=None)
@@ -0,0 +1,56 @@
+import fake_archive
+from .. import phases
+from .. import report
+
+
+class TestPhases(object):
+    def test_mark(self):
+        job_config = dict()
+        phases.mark(job_config, 'queued', 100.12345)
+        phases.mark(job_config, 'reserved')
+        assert job_config['phase_times']['queued'] == 100.123
+        assert job_config['phase_times']['reserved'] > 100
+
+    def test_get_durations(self):
+        phase_times = dict(queued=100, spawned=160, reserved=130,
+                           started=161.5)
+        assert phases.get_durations(phase_times) == [
+            ('reserved', 30), ('spawned', 30), ('started', 1.5)]
+
+    def test_summarize(self):
+        summary = phases.summarize([
+            dict(queued=0, reserved=10, started=12),
+            dict(queued=0, reserved=30, started=31),
+            dict(queued=0, reserved=20, started=24),
+            dict(queued=0, started=5),
+        ])
+        assert [p['name'] for p in summary] == ['reserved', 'started']
+        assert summary[0] == dict(name='reserved', jobs=3, mean=20,
+                                  median=20, max=30)
+        assert summary[1]['jobs'] == 4
+        assert summary[1]['max'] == 5
+        # The median of an even number of jobs is between the middle two
+        assert summary[1]['median'] == 3
+
+
+class TestReportPhases(object):
+    def setup(self):
+        self.archive = fake_archive.FakeArchive()
+        self.archive.setup()
+
+    def teardown(self):
+        self.archive.teardown()
+
+    def test_get_phase_times(self):
+        finished = self.archive.get_random_metadata('run1', job_id='1')
+        finished['summary']['phase_times'] = dict(queued=0, started=10)
+        running = self.archive.get_random_metadata('run1', job_id='2',
+                                                   hung=True)
+        running['info']['phase_times'] = dict(queued=0)
+        old = self.archive.get_random_metadata('run1', job_id='3')
+        self.archive.populate_archive('run1', [finished, running, old])
+        serializer = report.ResultsSerializer(self.archive.archive_base)
+        all_phase_times = report.get_phase_times(serializer, ['run1'])
+        assert sorted(all_phase_times) == [dict(queued=0),
+                                           dict(queued=0, started=10)]
+        report.print_phases(self.archive.archive_base, [], all_runs=True)
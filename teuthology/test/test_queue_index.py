@@ -0,0 +1,246 @@
+import beanstalkc
+import os
+import shutil
+import tempfile
+import yaml
+
+from .. import beanstalk
+from .. import job_queue
+from .. import schedule
+from ..bench.scheduling import InMemoryQueue
+from ..config import config
+from ..queue_index import QueueIndex, get_queue_index_path
+
+
+class FakeJob(object):
+    def __init__(self, connection, jid, body):
+        self.connection = connection
+        self.jid = jid
+        self.body = body
+
+    def stats(self):
+        return self.connection.stats_job(self.jid)
+
+    def delete(self):
+        self.connection.deleted.append(self.jid)
+
+    def release(self):
+        self.connection.states[self.jid] = 'ready'
+
+    def kick(self):
+        self.connection.states[self.jid] = 'ready'
+
+
+class FakeConnection(object):
+    """
+    Acts on the jobs put in an InMemoryQueue, using their job ids.
+    """
+    def __init__(self, queue, states=None, allow_reserve=False):
+        self.queue = queue
+        self.states = states or dict()
+        self.allow_reserve = allow_reserve
+        self.deleted = list()
+
+    def exists(self, job_id):
+        return job_id <= len(self.queue.jobs) and job_id not in self.deleted
+
+    def stats_job(self, job_id):
+        if not self.exists(job_id):
+            raise beanstalkc.CommandFailed('stats-job', 'NOT_FOUND', [])
+        return dict(id=job_id, state=self.states.get(job_id, 'ready'))
+
+    def stats_tube(self, tube):
+        stats = dict(name=tube)
+        for job_id in range(1, len(self.queue.jobs) + 1):
+            if self.exists(job_id) and self.queue.jobs[job_id - 1][0] == tube:
+                key = 'current-jobs-' + self.states.get(job_id, 'ready')
+                stats[key] = stats.get(key, 0) + 1
+        return stats
+
+    def peek(self, job_id):
+        if self.exists(job_id):
+            return FakeJob(self, job_id, self.queue.jobs[job_id - 1][2])
+
+    def reserve(self, timeout=None):
+        assert self.allow_reserve, "Listing the queue must not reserve jobs"
+        for job_id in range(1, len(self.queue.jobs) + 1):
+            if self.exists(job_id) and self.states.get(job_id) is None:
+                self.states[job_id] = 'reserved'
+                return self.peek(job_id)
+
+    def use(self, tube):
+        pass
+
+    def peek_delayed(self):
+        for job_id in range(1, len(self.queue.jobs) + 1):
+            if self.exists(job_id) and self.states.get(job_id) == 'delayed':
+                return self.peek(job_id)
+
+
+class TestQueueIndex(object):
+    def setup(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.index_path = os.path.join(self.tmp_dir, 'queue.db')
+        self.saved = config.results_server
+        config.results_server = None
+        self.queue = InMemoryQueue()
+        self.queue.index = QueueIndex(self.index_path)
+
+    def teardown(self):
+        config.results_server = self.saved
+        self.queue.index.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def schedule(self, name, priority=100, tube='plana'):
+        job_config = dict(name=name, description='desc', priority=priority,
+                          owner='owner', tube=tube)
+        schedule.schedule_job(job_config, connection=self.queue)
+
+    def test_schedule_adds(self):
+        self.schedule('run1')
+        self.schedule('run2', priority=10)
+        self.schedule('run1', tube='mira')
+        index = QueueIndex(self.index_path)
+        jobs = index.jobs(tube='plana')
+        assert [(j['job_id'], j['name']) for j in jobs] == \
+            [(2, 'run2'), (1, 'run1')]
+        assert jobs[0]['priority'] == 10
+        assert [j['job_id'] for j in index.jobs(run_name='run1')] == [1, 3]
+
+    def test_remove(self):
+        self.schedule('run1')
+        self.schedule('run1')
+        index = QueueIndex(self.index_path)
+        index.remove([1])
+        assert [j['job_id'] for j in index.jobs()] == [2]
+
+    def test_walk_index(self):
+        for name in ('run1', 'run2', 'run1', 'run1'):
+            self.schedule(name)
+        index = QueueIndex(self.index_path)
+        # A job that beanstalkd no longer knows about
+        index.add(5, 'plana', dict(name='run1'))
+        connection = FakeConnection(self.queue,
+                                    states={3: 'reserved', 4: 'delayed'})
+        processor = beanstalk.JobProcessor()
+        beanstalk.walk_index(connection, 'plana', processor, index,
+                             pattern='run1')
+        assert processor.jobs.keys() == ['1', '4']
+        assert processor.jobs['1']['job_config']['description'] == 'desc'
+        assert [j['job_id'] for j in index.jobs()] == [1, 2, 3, 4]
+
+    def test_walk_unindexed(self):
+        self.schedule('run1')
+        # Scheduled before the index existed
+        self.queue.use('plana')
+        self.queue.put(yaml.safe_dump(dict(name='run2', description='desc',
+                                           priority=100)))
+        connection = FakeConnection(self.queue, allow_reserve=True)
+        processor = beanstalk.JobProcessor()
+        beanstalk.walk_index(connection, 'plana', processor,
+                             self.queue.index)
+        assert processor.jobs.keys() == ['1', '2']
+        # The next listing doesn't need to reserve anything
+        assert [j['job_id'] for j in self.queue.index.jobs()] == [1, 2]
+        connection = FakeConnection(self.queue)
+        processor = beanstalk.JobProcessor()
+        beanstalk.walk_index(connection, 'plana', processor,
+                             self.queue.index)
+        assert processor.jobs.keys() == ['1', '2']
+
+    def test_default_path(self):
+        saved = (config.queue_index_path, config.archive_base)
+        try:
+            config.queue_index_path = None
+            config.archive_base = '/var/lib/teuthworker/archive/'
+            assert get_queue_index_path() == \
+                '/var/lib/teuthworker/queue_index.db'
+            config.queue_index_path = '/tmp/queue.db'
+            assert get_queue_index_path() == '/tmp/queue.db'
+        finally:
+            config.queue_index_path, config.archive_base = saved
+
+    def test_walk_index_full(self):
+        self.schedule('run1')
+        index = QueueIndex(self.index_path)
+        processor = beanstalk.JobProcessor()
+        beanstalk.walk_index(FakeConnection(self.queue), 'plana', processor,
+                             index, full=True)
+        job_config = processor.jobs['1']['job_config']
+        assert job_config == yaml.safe_load(self.queue.jobs[0][2])
+
+    def test_delete_indexed(self):
+        for name in ('run1', 'run2', 'run1', 'run1'):
+            self.schedule(name)
+        index = QueueIndex(self.index_path)
+        connection = FakeConnection(self.queue,
+                                    states={3: 'buried', 4: 'delayed'})
+        processor = beanstalk.JobProcessor()
+        deleted = job_queue.delete_jobs(connection, 'plana',
+                                        lambda name: name == 'run1', index,
+                                        processor)
+        assert deleted == [1, 4]
+        assert connection.deleted == [1, 4]
+        assert processor.jobs.keys() == ['1', '4']
+        assert [j['job_id'] for j in index.jobs()] == [2, 3]
+
+    def test_delete_reused_id(self):
+        self.schedule('run2')
+        index = QueueIndex(self.index_path)
+        # An entry left over from before beanstalkd restarted
+        index.add(1, 'plana', dict(name='run1'))
+        connection = FakeConnection(self.queue)
+        assert job_queue.delete_jobs(connection, 'plana',
+                                     lambda name: name == 'run1',
+                                     index) == []
+        assert connection.deleted == []
+        assert index.jobs() == []
+
+    def test_stream_delete(self):
+        for name in ('run1', 'run2', 'run1', 'run2', 'run1'):
+            self.schedule(name)
+        connection = FakeConnection(self.queue, allow_reserve=True,
+                                    states={4: 'delayed', 5: 'delayed'})
+        deleted = job_queue.delete_jobs(connection, 'plana',
+                                        lambda name: name == 'run1')
+        assert sorted(deleted) == [1, 3, 5]
+        assert connection.states[2] == 'ready'
+        assert connection.states[4] == 'ready'
+
+    def test_delete_unindexed(self):
+        self.schedule('run1')
+        # Scheduled before the index existed
+        self.queue.use('plana')
+        self.queue.put(yaml.safe_dump(dict(name='run1')))
+        self.schedule('run2')
+        connection = FakeConnection(self.queue, allow_reserve=True,
+                                    states={3: 'delayed'})
+        deleted = job_queue.delete_jobs(connection, 'plana',
+                                        lambda name: name == 'run1',
+                                        self.queue.index)
+        assert deleted == [1, 2]
+        # The other run's deferred job was left alone
+        assert connection.states[3] == 'delayed'
+
+    def test_delete_unindexed_delayed(self):
+        self.schedule('run2')
+        self.queue.use('plana')
+        self.queue.put(yaml.safe_dump(dict(name='run1')))
+        self.queue.put(yaml.safe_dump(dict(name='run3')))
+        connection = FakeConnection(
+            self.queue, states={1: 'delayed', 2: 'delayed', 3: 'delayed'})
+        deleted = job_queue.delete_jobs(connection, 'plana',
+                                        lambda name: name == 'run1',
+                                        self.queue.index)
+        assert deleted == [2]
+        # run2's job was in the way; run3's was the last one to look at
+        assert connection.states[1] == 'ready'
+        assert connection.states[3] == 'delayed'
+
+    def test_get_run_name(self):
+        job_config = dict(name='run1', tasks=[dict(name='other')],
+                          description='x ' * 100)
+        assert job_queue.get_run_name(yaml.safe_dump(job_config)) == 'run1'
+        long_name = 'long name ' * 20
+        body = yaml.safe_dump(dict(name=long_name, zzz=1))
+        assert job_queue.get_run_name(body) == long_name
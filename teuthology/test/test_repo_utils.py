@@ -1,10 +1,13 @@
+import fudge
 import logging
 import os
 import os.path
 from pytest import raises
 import shutil
 import subprocess
+import tempfile
 
+from ..config import config
 from ..exceptions import BranchNotFoundError
 from .. import repo_utils
 from .. import parallel
@@ -167,3 +170,138 @@ class TestRepoUtils(object):
                     )
             for result in p:
                 pass
+
+    def test_mirror(self):
+        mirror_path = self.dest_path + '_mirror.git'
+        try:
+            repo_utils.update_mirror(self.repo_url, mirror_path)
+            # Updating an existing mirror fetches into it
+            repo_utils.update_mirror(self.repo_url, mirror_path)
+            repo_utils.enforce_repo_state(mirror_path, self.dest_path,
+                                          'master')
+            assert os.path.exists(os.path.join(self.dest_path, '.git'))
+            origin = subprocess.check_output(
+                ('git', 'config', 'remote.origin.url'),
+                cwd=self.dest_path,
+            ).strip()
+            assert origin == mirror_path
+        finally:
+            shutil.rmtree(mirror_path, ignore_errors=True)
+
+    def test_branch_is_current(self):
+        repo_utils.enforce_repo_state(self.repo_url, self.dest_path, 'master')
+        assert repo_utils.branch_is_current(self.repo_url, self.dest_path,
+                                            'master')
+        assert not repo_utils.branch_is_current(self.repo_url,
+                                                self.dest_path, 'nobranch')
+        subprocess.check_call(
+            ('git', 'commit', '--allow-empty', '-m', 'new'),
+            cwd=self.src_path,
+            stdout=subprocess.PIPE,
+        )
+        assert not repo_utils.branch_is_current(self.repo_url,
+                                                self.dest_path, 'master')
+        repo_utils.enforce_repo_state(self.repo_url, self.dest_path, 'master')
+        assert repo_utils.branch_is_current(self.repo_url, self.dest_path,
+                                            'master')
+
+    def test_set_remote(self):
+        repo_utils.enforce_repo_state(self.repo_url, self.dest_path, 'master')
+        repo_utils.set_remote(self.dest_path, self.src_path)
+        origin = subprocess.check_output(
+            ('git', 'config', 'remote.origin.url'),
+            cwd=self.dest_path,
+        ).strip()
+        assert origin == self.src_path
+
+    def test_fresh(self):
+        stamp_path = self.dest_path + '.fetched'
+        os.mkdir(self.dest_path)
+        try:
+            assert not repo_utils.is_fresh(self.dest_path, 60)
+            repo_utils.mark_fresh(self.dest_path)
+            assert repo_utils.is_fresh(self.dest_path, 60)
+            assert not repo_utils.is_fresh(self.dest_path, 0)
+            os.utime(stamp_path, (0, 0))
+            assert not repo_utils.is_fresh(self.dest_path, 60)
+            # Someone else updated it while we waited for the lock
+            assert repo_utils.is_fresh(self.dest_path, 0, since=0)
+            assert not repo_utils.is_fresh(self.dest_path, 0, since=1)
+        finally:
+            os.remove(stamp_path)
+
+    def test_is_current(self):
+        mirror_path = self.dest_path + '_mirror.git'
+        stamp_path = self.dest_path + '.fetched'
+        try:
+            repo_utils.update_mirror(self.repo_url, mirror_path)
+            repo_utils.enforce_repo_state(mirror_path, self.dest_path,
+                                          'master')
+            repo_utils.mark_fresh(self.dest_path)
+            assert repo_utils.is_current(self.repo_url, self.dest_path,
+                                         'master', 60)
+            # A new commit upstream, which the mirror doesn't have yet
+            subprocess.check_call(
+                ('git', 'commit', '--allow-empty', '-m', 'new'),
+                cwd=self.src_path,
+                stdout=subprocess.PIPE,
+            )
+            assert not repo_utils.is_current(self.repo_url, self.dest_path,
+                                             'master', 60)
+            assert repo_utils.get_mirror_max_age(self.dest_path, 60) == 0
+            # Someone else updated it while we waited for the lock
+            assert repo_utils.is_current(self.repo_url, self.dest_path,
+                                         'master', 60, since=0)
+            os.utime(stamp_path, (0, 0))
+            assert repo_utils.get_mirror_max_age(self.dest_path, 60) is None
+        finally:
+            shutil.rmtree(mirror_path, ignore_errors=True)
+            os.remove(stamp_path)
+
+
+class TestVenvCache(object):
+    def setup(self):
+        self.cache_path = tempfile.mkdtemp()
+
+    def teardown(self):
+        shutil.rmtree(self.cache_path)
+
+    def write(self, name, contents):
+        path = os.path.join(self.cache_path, name)
+        with file(path, 'w') as f:
+            f.write(contents)
+        return path
+
+    def test_cache_key(self):
+        first = self.write('first.txt', 'PyYAML\nrequests >= 1.0\n')
+        same = self.write('same.txt', 'PyYAML\nrequests >= 1.0\n')
+        other = self.write('other.txt', 'PyYAML\nrequests >= 2.0\n')
+        key = repo_utils.get_venv_cache_key(first)
+        assert key == repo_utils.get_venv_cache_key(same)
+        assert key != repo_utils.get_venv_cache_key(other)
+
+    def test_evict(self):
+        for name in ('old', 'new'):
+            os.mkdir(os.path.join(self.cache_path, name))
+            self.write(name + '.complete', '')
+            self.write(name + '.used', '')
+        os.utime(os.path.join(self.cache_path, 'old.used'), (0, 0))
+        repo_utils.evict_cached_venvs(self.cache_path, 3600)
+        remaining = sorted(os.listdir(self.cache_path))
+        assert remaining == ['new', 'new.complete', 'new.used', 'old.lock']
+
+    def test_bootstrap_falls_back(self):
+        def fake_link(dest_path):
+            raise repo_utils.BootstrapError("oops")
+        calls = list()
+        max_age = config.venv_cache_max_age
+        config.venv_cache_max_age = 3600
+        try:
+            with fudge.patched_context(repo_utils, 'link_cached_venv',
+                                       fake_link):
+                with fudge.patched_context(repo_utils, 'run_bootstrap',
+                                           calls.append):
+                    repo_utils.bootstrap_teuthology('/checkout')
+        finally:
+            config.venv_cache_max_age = max_age
+        assert calls == ['/checkout']
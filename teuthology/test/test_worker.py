@@ -0,0 +1,305 @@
+import fudge
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+import yaml
+
+from .. import worker
+from ..config import config
+
+
+class FakeJob(object):
+    def __init__(self, jid, job_config):
+        self.jid = jid
+        self.body = yaml.safe_dump(job_config)
+        self.buried = False
+        self.deleted = False
+        self.releases = 0
+
+    def bury(self):
+        self.buried = True
+
+    def stats(self):
+        return dict(releases=self.releases, pri=100)
+
+    def release(self, priority=None, delay=0):
+        self.releases += 1
+        self.release_delay = delay
+
+    def delete(self):
+        self.deleted = True
+
+
+class FakeProcess(object):
+    def __init__(self, pid):
+        self.pid = pid
+        self.returncode = None
+
+    def poll(self):
+        return self.returncode
+
+
+class FakeFile(object):
+    closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class FakeConnection(object):
+    def __init__(self, jobs=None):
+        self.jobs = jobs or list()
+
+    def peek_ready(self):
+        if self.jobs:
+            return self.jobs[0]
+
+
+class TestRepoCache(object):
+    @fudge.patch('teuthology.worker.fetch_teuthology',
+                 'teuthology.worker.fetch_qa_suite')
+    def test_max_age(self, fake_fetch_teuth, fake_fetch_suite):
+        fake_fetch_teuth.expects_call().with_args('master', max_age=60)\
+            .returns('/teuth')
+        fake_fetch_suite.expects_call().with_args('master', max_age=60)\
+            .returns('/suite')
+        cache = worker.RepoCache(max_age=60)
+        assert cache.teuthology('master') == '/teuth'
+        assert cache.qa_suite('master') == '/suite'
+
+
+class TestPrepJob(object):
+    def setup(self):
+        self.archive_dir = tempfile.mkdtemp()
+        self.teuth_dir = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.teuth_dir, 'virtualenv', 'bin'))
+
+    def teardown(self):
+        shutil.rmtree(self.archive_dir)
+        shutil.rmtree(self.teuth_dir)
+
+    @fudge.patch('teuthology.worker.fetch_teuthology',
+                 'teuthology.worker.fetch_qa_suite')
+    def test_creates_run_dir(self, fake_fetch_teuth, fake_fetch_suite):
+        fake_fetch_teuth.expects_call().returns(self.teuth_dir)
+        fake_fetch_suite.expects_call().returns('/suite')
+        job_config, teuth_bin_path = worker.prep_job(
+            dict(name='the-run'), 12, self.archive_dir, '/worker.log')
+        run_dir = os.path.join(self.archive_dir, 'the-run')
+        assert os.path.isdir(run_dir)
+        assert job_config['archive_path'] == os.path.join(run_dir, '12')
+        assert teuth_bin_path == os.path.join(self.teuth_dir, 'virtualenv',
+                                              'bin')
+
+
+class TestPrefetch(object):
+    @fudge.patch('teuthology.worker.fetch_teuthology',
+                 'teuthology.worker.fetch_qa_suite')
+    def test_next_job(self, fake_fetch_teuth, fake_fetch_suite):
+        fake_fetch_teuth.expects_call().with_args('wip-teuth', max_age=30)
+        fake_fetch_suite.expects_call().with_args('wip-ceph', max_age=30)
+        job_config = dict(teuthology_branch='wip-teuth', branch='wip-ceph')
+        connection = FakeConnection([FakeJob(1, job_config)])
+        worker.prefetch_next(connection, worker.RepoCache(max_age=30))
+
+    @fudge.patch('teuthology.worker.fetch_teuthology',
+                 'teuthology.worker.fetch_qa_suite')
+    def test_no_job(self, fake_fetch_teuth, fake_fetch_suite):
+        # Calling either fake would raise, since no calls are expected
+        worker.prefetch_next(FakeConnection(), worker.RepoCache())
+
+    def test_get_job_branches(self):
+        assert worker.get_job_branches(dict()) == ('master', 'master')
+        assert worker.get_job_branches(
+            dict(branch='firefly', suite_branch='wip-suite')) == \
+            ('master', 'wip-suite')
+
+
+class TestDeferJob(object):
+    machine_types = dict(
+        plana=dict(free=2),
+        burnupi=dict(free=3),
+    )
+
+    def setup(self):
+        self.saved = (config.job_defer_delay, config.max_job_defers)
+        config.job_defer_delay = 60
+        config.max_job_defers = 2
+
+    def teardown(self):
+        config.job_defer_delay, config.max_job_defers = self.saved
+
+    def make_job(self, num_roles, machine_type='plana', owner='user'):
+        job_config = dict(
+            name='run',
+            machine_type=machine_type,
+            owner=owner,
+            roles=[['osd.%d' % i] for i in range(num_roles)],
+        )
+        return FakeJob(1, job_config), job_config
+
+    @fudge.patch('teuthology.worker.get_machine_types')
+    def test_enough_free(self, fake_get):
+        fake_get.expects_call().with_args(refresh=True)\
+            .returns(self.machine_types)
+        job, job_config = self.make_job(2)
+        assert not worker.defer_job(job, job_config)
+        assert job.releases == 0
+
+    @fudge.patch('teuthology.worker.get_machine_types')
+    def test_not_enough_free(self, fake_get):
+        fake_get.expects_call().returns(self.machine_types)
+        job, job_config = self.make_job(3)
+        assert worker.defer_job(job, job_config)
+        assert job.releases == 1
+        assert job.release_delay == 60
+
+    @fudge.patch('teuthology.worker.get_machine_types')
+    def test_multi_machine_type(self, fake_get):
+        fake_get.expects_call().returns(self.machine_types)
+        job, job_config = self.make_job(3, machine_type='plana,burnupi')
+        assert not worker.defer_job(job, job_config)
+
+    @fudge.patch('teuthology.worker.get_machine_types')
+    def test_multi_machine_type_split(self, fake_get):
+        fake_get.expects_call().returns(self.machine_types)
+        # 5 are free in all, but all the machines must be of one type
+        job, job_config = self.make_job(4, machine_type='plana,burnupi')
+        assert worker.defer_job(job, job_config)
+
+    @fudge.patch('teuthology.worker.get_machine_types')
+    def test_scheduled_per_type(self, fake_get):
+        fake_get.expects_call().returns(dict(
+            plana=dict(free=3),
+            burnupi=dict(free=6),
+        ))
+        job, job_config = self.make_job(1, machine_type='plana,burnupi',
+                                        owner='scheduled_user')
+        assert not worker.defer_job(job, job_config)
+        job, job_config = self.make_job(1, machine_type='plana',
+                                        owner='scheduled_user')
+        assert worker.defer_job(job, job_config)
+
+    @fudge.patch('teuthology.worker.get_machine_types')
+    def test_scheduled_owner(self, fake_get):
+        fake_get.expects_call().returns(self.machine_types)
+        job, job_config = self.make_job(1, owner='scheduled_user')
+        assert worker.defer_job(job, job_config)
+
+    @fudge.patch('teuthology.worker.get_machine_types')
+    def test_max_defers(self, fake_get):
+        fake_get.expects_call().returns(self.machine_types)
+        job, job_config = self.make_job(3)
+        job.releases = 2
+        assert not worker.defer_job(job, job_config)
+
+    @fudge.patch('teuthology.worker.get_machine_types')
+    def test_lock_server_down(self, fake_get):
+        fake_get.expects_call().returns(None)
+        job, job_config = self.make_job(3)
+        assert not worker.defer_job(job, job_config)
+
+    def test_no_roles(self):
+        job = FakeJob(1, dict(name='run', last_in_suite=True))
+        assert not worker.defer_job(job, dict(name='run', last_in_suite=True))
+
+
+class TestWorkerSupervisor(object):
+    def setup(self):
+        self.log_dir = tempfile.mkdtemp()
+        self.log_file_path = os.path.join(self.log_dir, 'worker.plana.1')
+        self.results_server = config.results_server
+        config.results_server = None
+        self.processes = list()
+
+    def teardown(self):
+        shutil.rmtree(self.log_dir)
+        config.results_server = self.results_server
+
+    def fake_prep_job(self, job_config, job_id, archive_dir, log_file_path,
+                      repo_cache=None):
+        job_config['job_id'] = str(job_id)
+        job_config['archive_path'] = os.path.join(archive_dir, str(job_id))
+        return job_config, '/bin'
+
+    def fake_start_job(self, job_config, teuth_bin_path):
+        process = FakeProcess(1000 + len(self.processes))
+        self.processes.append(process)
+        return process, FakeFile()
+
+    def make_supervisor(self, num_slots):
+        supervisor = worker.WorkerSupervisor(None, num_slots, self.log_dir,
+                                             self.log_file_path)
+        return supervisor
+
+    def test_slots(self):
+        with fudge.patched_context(worker, 'prep_job', self.fake_prep_job):
+            with fudge.patched_context(worker, 'start_job',
+                                       self.fake_start_job):
+                supervisor = self.make_supervisor(2)
+                jobs = [FakeJob(i, dict(name='run')) for i in (1, 2)]
+                for job in jobs:
+                    supervisor.start_job(job)
+                assert supervisor.idle_slots == []
+                assert all([job.buried for job in jobs])
+                assert all(['reserve_to_start' in slot.job_config
+                            for slot in supervisor.slots])
+                assert all(['reserved' in slot.job_config['phase_times']
+                            for slot in supervisor.slots])
+
+                with file(supervisor.state_file_path) as state_file:
+                    states = yaml.safe_load(state_file)
+                assert [s['state'] for s in states] == ['running'] * 2
+                assert [s['job_id'] for s in states] == ['1', '2']
+
+                self.processes[1].returncode = 0
+                supervisor.check_slots()
+                assert jobs[1].deleted
+                assert not jobs[0].deleted
+                assert supervisor.idle_slots == [supervisor.slots[1]]
+
+                with file(supervisor.state_file_path) as state_file:
+                    states = yaml.safe_load(state_file)
+                assert [s['state'] for s in states] == ['running', 'idle']
+
+    @fudge.patch('teuthology.report.try_push_heartbeats')
+    def test_watchdog(self, m_try_push_heartbeats):
+        config.results_server = 'http://example.com/'
+        m_try_push_heartbeats.expects_call().with_args(
+            [dict(name='run', job_id='1'), dict(name='run', job_id='2')])
+        with fudge.patched_context(worker, 'prep_job', self.fake_prep_job):
+            with fudge.patched_context(worker, 'start_job',
+                                       self.fake_start_job):
+                supervisor = self.make_supervisor(3)
+                for i in (1, 2):
+                    supervisor.start_job(FakeJob(i, dict(name='run')))
+                # Not due yet
+                supervisor.check_slots()
+                supervisor.last_heartbeat -= config.watchdog_interval
+                supervisor.check_slots()
+                assert supervisor.time_to_watchdog() > 0
+
+
+class TestChildWatcher(object):
+    def test_wait(self):
+        with worker.ChildWatcher() as watcher:
+            assert not watcher.wait(0)
+            process = subprocess.Popen(['true'])
+            start = time.time()
+            assert watcher.wait(60)
+            assert time.time() - start < 10
+            process.wait()
+
+    @fudge.patch('teuthology.worker.report_job_done')
+    def test_run_with_watchdog(self, m_report_job_done):
+        job_config = dict(name='run', job_id='1', worker_log='/dev/null',
+                          archive_path='/nonexistent')
+        m_report_job_done.expects_call().with_args(job_config)
+        process = subprocess.Popen(['sleep', '0.5'])
+        start = time.time()
+        worker.run_with_watchdog(process, job_config)
+        # Before the next check for the archive dir, let alone the next
+        # heartbeat
+        assert time.time() - start < worker.WorkerSupervisor.poll_interval
@@ -1,5 +1,10 @@
+import errno
+import fcntl
 import logging
+import multiprocessing
 import os
+import select
+import signal
 import subprocess
 import sys
 import tempfile
@@ -10,13 +15,17 @@ from datetime import datetime
 
 from teuthology import setup_log_file
 from . import beanstalk
+from . import job_queue
+from . import phases
 from . import report
 from . import safepath
 from .config import config as teuth_config
 from .exceptions import BranchNotFoundError
 from .kill import kill_job
-from .misc import read_config
+from .lock import get_machine_types
+from .misc import get_multi_machine_types, read_config
 from .repo_utils import fetch_qa_suite, fetch_teuthology
+from .task.internal import MIN_FREE_FOR_SCHEDULED
 
 log = logging.getLogger(__name__)
 start_time = datetime.utcnow()
@@ -75,13 +84,24 @@ def main(ctx):
 
     read_config(ctx)
 
-    connection = beanstalk.connect()
-    beanstalk.watch_tube(connection, ctx.tube)
+    connection = job_queue.connect()
+    tube = beanstalk.watch_tube(connection, ctx.tube)
     result_proc = None
 
     fetch_teuthology('master')
     fetch_qa_suite('master')
 
+    prefetcher = Prefetcher(tube)
+    prefetcher.start()
+
+    if ctx.slots > 1:
+        supervisor = WorkerSupervisor(connection, ctx.slots, ctx.archive_dir,
+                                      log_file_path, prefetcher=prefetcher)
+        supervisor.run()
+        return
+
+    repo_cache = RepoCache(max_age=teuth_config.fetch_max_age)
+
     while True:
         # Check to see if we have a teuthology-results process hanging around
         # and if so, read its return code so that it can exit.
@@ -91,79 +111,561 @@ def main(ctx):
             result_proc = None
 
         if need_restart():
+            prefetcher.stop()
             restart()
 
         job = connection.reserve(timeout=60)
         if job is None:
             continue
+        reserved_at = time.time()
+        job_config = yaml.safe_load(job.body)
+        if defer_job(job, job_config):
+            continue
 
         # bury the job so it won't be re-run if it fails
         job.bury()
         log.info('Reserved job %d', job.jid)
         log.info('Config is: %s', job.body)
-        job_config = yaml.safe_load(job.body)
+        job_config, teuth_bin_path = prep_job(
+            job_config,
+            job.jid,
+            ctx.archive_dir,
+            log_file_path,
+            repo_cache=repo_cache,
+        )
+        if job_config is None:
+            continue
+
+        if job_config.get('last_in_suite'):
+            result_proc = run_results(job_config, teuth_bin_path,
+                                      ctx.archive_dir)
+        else:
+            record_reserve_to_start(job_config, reserved_at)
+            log.info('Running job %d', job.jid)
+            run_job(job_config, teuth_bin_path)
+        job.delete()
+
+
+class RepoCache(object):
+    """
+    Fetch teuthology and ceph-qa-suite branches, skipping any checkout that
+    was brought up-to-date less than max_age seconds ago - by this process or
+    any other, like a Prefetcher.
+    """
+    def __init__(self, max_age=0):
+        self.max_age = max_age
+
+    def teuthology(self, branch):
+        return fetch_teuthology(branch, max_age=self.max_age)
 
-        job_config['job_id'] = str(job.jid)
-        safe_archive = safepath.munge(job_config['name'])
-        job_config['worker_log'] = log_file_path
-        archive_path_full = os.path.join(
-            ctx.archive_dir, safe_archive, str(job.jid))
-        job_config['archive_path'] = archive_path_full
+    def qa_suite(self, branch):
+        return fetch_qa_suite(branch, max_age=self.max_age)
 
-        # If the teuthology branch was not specified, default to master and
-        # store that value.
-        teuthology_branch = job_config.get('teuthology_branch', 'master')
-        job_config['teuthology_branch'] = teuthology_branch
 
+class Prefetcher(object):
+    """
+    Keep the branches needed by the next ready job in a tube up-to-date, from
+    a child process, so that they're ready by the time a worker reserves the
+    job.
+
+    The child refreshes checkouts older than half of config.fetch_max_age
+    every config.prefetch_interval seconds, which means that workers using a
+    RepoCache with a max_age of config.fetch_max_age will usually find what
+    they need already fetched.
+    """
+    def __init__(self, tube, interval=None, max_age=None):
+        self.tube = tube
+        self.interval = interval or teuth_config.prefetch_interval
+        self.max_age = (max_age or teuth_config.fetch_max_age) / 2
+        self.process = None
+
+    def start(self):
+        if not self.interval:
+            return
+        self.process = multiprocessing.Process(
+            target=prefetch_loop,
+            args=(self.tube, self.interval, self.max_age),
+        )
+        self.process.daemon = True
+        self.process.start()
+        log.info("Prefetcher PID: %s", self.process.pid)
+
+    def stop(self):
+        if self.process is not None and self.process.is_alive():
+            self.process.terminate()
+            self.process.join()
+        self.process = None
+
+
+def prefetch_loop(tube, interval, max_age):
+    parent_pid = os.getppid()
+    connection = job_queue.connect()
+    connection.use(tube)
+    repo_cache = RepoCache(max_age=max_age)
+    # Exit if our parent goes away
+    while os.getppid() == parent_pid:
         try:
-            teuth_path = fetch_teuthology(branch=teuthology_branch)
-            # For the teuthology tasks, we look for suite_branch, and if we
-            # don't get that, we look for branch, and fall back to 'master'.
-            # last-in-suite jobs don't have suite_branch or branch set.
-            ceph_branch = job_config.get('branch', 'master')
-            suite_branch = job_config.get('suite_branch', ceph_branch)
-            job_config['suite_path'] = fetch_qa_suite(suite_branch)
-        except BranchNotFoundError:
-            log.exception(
-                "Branch not found; throwing job away")
-            # Optionally, we could mark the job as dead, but we don't have a
-            # great way to express why it is dead.
-            report.try_delete_jobs(job_config['name'],
-                                   job_config['job_id'])
-            continue
+            prefetch_next(connection, repo_cache)
+        except Exception:
+            log.exception("Prefetch failed")
+        time.sleep(interval)
+
+
+def prefetch_next(connection, repo_cache):
+    """
+    Fetch the branches needed by the next ready job in the tube connection is
+    using, if there is one.
+    """
+    job = connection.peek_ready()
+    if job is None:
+        return
+    job_config = yaml.safe_load(job.body)
+    teuthology_branch, suite_branch = get_job_branches(job_config)
+    log.debug("Prefetching teuthology %s and ceph-qa-suite %s for job %s",
+              teuthology_branch, suite_branch, job.jid)
+    repo_cache.teuthology(teuthology_branch)
+    repo_cache.qa_suite(suite_branch)
+
+
+def get_job_branches(job_config):
+    """
+    :returns: A tuple: (teuthology_branch, suite_branch)
+    """
+    teuthology_branch = job_config.get('teuthology_branch', 'master')
+    # For the teuthology tasks, we look for suite_branch, and if we
+    # don't get that, we look for branch, and fall back to 'master'.
+    # last-in-suite jobs don't have suite_branch or branch set.
+    ceph_branch = job_config.get('branch', 'master')
+    suite_branch = job_config.get('suite_branch', ceph_branch)
+    return teuthology_branch, suite_branch
+
+
+def defer_job(job, job_config):
+    """
+    If there aren't enough free machines to run a job right away, release it
+    back into the queue with a delay of config.job_defer_delay seconds, so
+    that the worker can pick up a job that can run instead of waiting inside
+    internal.lock_machines.
+
+    A job that has already been released config.max_job_defers times isn't
+    deferred again, so that jobs needing many machines still get to run.
+
+    :returns: True if the job was released
+    """
+    delay = teuth_config.job_defer_delay
+    if not delay or has_capacity(job_config):
+        return False
+    stats = job.stats()
+    if stats['releases'] >= teuth_config.max_job_defers:
+        log.info("Job %d has been deferred %d times; running it anyway",
+                 job.jid, stats['releases'])
+        return False
+    log.info("Not enough free %s machines for job %d; deferring it for %ds",
+             job_config['machine_type'], job.jid, delay)
+    job.release(priority=stats['pri'], delay=delay)
+    return True
 
-        teuth_bin_path = os.path.join(teuth_path, 'virtualenv', 'bin')
-        if not os.path.isdir(teuth_bin_path):
-            raise RuntimeError("teuthology branch %s at %s not bootstrapped!" %
-                               (teuthology_branch, teuth_bin_path))
+
+def has_capacity(job_config):
+    """
+    :returns: False if the lock server says there aren't enough free machines
+              of any of the job's types for internal.lock_machines to lock
+              them right away; otherwise True - including when we can't tell.
+    """
+    roles = job_config.get('roles')
+    machine_type = job_config.get('machine_type')
+    if not roles or not machine_type or job_config.get('last_in_suite'):
+        return True
+    type_info = get_machine_types(refresh=True)
+    if type_info is None:
+        return True
+    needed = len(roles)
+    if job_config.get('owner', '').startswith('scheduled'):
+        # internal.lock_machines has the lock server wait until enough
+        # machines are free before locking any for automated runs
+        needed = max(needed, MIN_FREE_FOR_SCHEDULED)
+    # The lock server locks all of a job's machines from a single type, and
+    # checks how many of that type are free
+    return any([type_info[t]['free'] >= needed for t in
+                get_multi_machine_types(machine_type) if t in type_info])
+
+
+def record_reserve_to_start(job_config, reserved_at):
+    """
+    Mark the job's 'reserved' phase, and store how long it took from then to
+    starting the job in the job's config, so it ends up in the archive and on
+    the results server.
+    """
+    phases.mark(job_config, 'reserved', reserved_at)
+    job_config['reserve_to_start'] = round(
+        time.time() - job_config['phase_times']['reserved'], 3)
+    log.info("Job %s starting %.1fs after it was reserved",
+             job_config['job_id'], job_config['reserve_to_start'])
+
+
+def prep_job(job_config, job_id, archive_dir, log_file_path,
+             repo_cache=None):
+    """
+    Fill in the worker-specific parts of a freshly-reserved job's config and
+    make sure the teuthology and ceph-qa-suite branches it needs are checked
+    out.
+
+    :param job_config:    The job's config, as loaded from the queue
+    :param job_id:        The job's id in the queue
+    :param archive_dir:   The worker's archive directory
+    :param log_file_path: The path to the worker's log
+    :param repo_cache:    Optional. A RepoCache to fetch branches with
+    :returns:             A tuple: (job_config, teuth_bin_path), or
+                          (None, None) if a branch was not found.
+    """
+    repo_cache = repo_cache or RepoCache()
+    job_config['job_id'] = str(job_id)
+    safe_archive = safepath.munge(job_config['name'])
+    job_config['worker_log'] = log_file_path
+    archive_path_full = os.path.join(
+        archive_dir, safe_archive, str(job_id))
+    job_config['archive_path'] = archive_path_full
+
+    # If the teuthology branch was not specified, default to master and
+    # store that value.
+    teuthology_branch, suite_branch = get_job_branches(job_config)
+    job_config['teuthology_branch'] = teuthology_branch
+
+    try:
+        teuth_path = repo_cache.teuthology(teuthology_branch)
+        # This includes checking teuthology's virtualenv
+        phases.mark(job_config, 'fetched_teuthology')
+        job_config['suite_path'] = repo_cache.qa_suite(suite_branch)
+        phases.mark(job_config, 'fetched_suite')
+    except BranchNotFoundError:
+        log.exception(
+            "Branch not found; throwing job away")
+        # Optionally, we could mark the job as dead, but we don't have a
+        # great way to express why it is dead.
+        report.try_delete_jobs(job_config['name'],
+                               job_config['job_id'])
+        return None, None
+
+    teuth_bin_path = os.path.join(teuth_path, 'virtualenv', 'bin')
+    if not os.path.isdir(teuth_bin_path):
+        raise RuntimeError("teuthology branch %s at %s not bootstrapped!" %
+                           (teuthology_branch, teuth_bin_path))
+
+    log.info('Creating archive dir %s', archive_path_full)
+    safepath.makedirs(archive_dir, safe_archive)
+    return job_config, teuth_bin_path
+
+
+def run_results(job_config, teuth_bin_path, archive_dir):
+    """
+    Start teuthology-results for a last-in-suite job.
+
+    :returns: The teuthology-results process
+    """
+    if teuth_config.results_server:
+        report.try_delete_jobs(job_config['name'],
+                               job_config['job_id'])
+    log.info('Generating results email for %s', job_config['name'])
+    args = [
+        os.path.join(teuth_bin_path, 'teuthology-results'),
+        '--timeout',
+        str(job_config.get('results_timeout', 32400)),
+        '--email',
+        job_config['email'],
+        '--archive-dir',
+        os.path.join(archive_dir, safepath.munge(job_config['name'])),
+        '--name',
+        job_config['name'],
+    ]
+    # Execute teuthology-results, passing 'preexec_fn=os.setpgrp' to
+    # make sure that it will continue to run if this worker process
+    # dies (e.g. because of a restart)
+    result_proc = subprocess.Popen(args=args, preexec_fn=os.setpgrp)
+    log.info("teuthology-results PID: %s", result_proc.pid)
+    return result_proc
+
+
+class JobSlot(object):
+    """
+    One of a WorkerSupervisor's job slots, and the job running in it, if any.
+    """
+    def __init__(self, index):
+        self.index = index
+        self.clear()
+
+    def clear(self):
+        self.job = None
+        self.job_config = None
+        self.process = None
+        self.job_file = None
+        self.started = None
+        self.log_linked = False
+
+    @property
+    def idle(self):
+        return self.job is None
+
+    def to_dict(self):
+        info = dict(slot=self.index, state='idle')
+        if not self.idle:
+            info.update(
+                state='running',
+                name=self.job_config['name'],
+                job_id=self.job_config['job_id'],
+                pid=self.process.pid,
+                started=self.started.strftime('%Y-%m-%d %H:%M:%S'),
+            )
+        return info
+
+
+class WorkerSupervisor(object):
+    """
+    Run up to num_slots jobs at a time, sharing one queue connection and one
+    RepoCache between them. The state of each slot is logged and written, as
+    yaml, to a '.slots' file next to the worker's log whenever it changes.
+
+    Finished jobs are noticed as soon as they exit, using a ChildWatcher, and
+    the heartbeats of all running jobs are sent to the results server
+    together, once every config.watchdog_interval; see
+    report.try_push_heartbeats().
+    """
+    # How often to check on running jobs
+    poll_interval = 5
+
+    def __init__(self, connection, num_slots, archive_dir, log_file_path,
+                 prefetcher=None):
+        self.connection = connection
+        self.slots = [JobSlot(i) for i in range(num_slots)]
+        self.archive_dir = archive_dir
+        self.log_file_path = log_file_path
+        self.state_file_path = log_file_path + '.slots'
+        self.repo_cache = RepoCache(max_age=teuth_config.fetch_max_age)
+        self.prefetcher = prefetcher
+        self.result_procs = list()
+        self.last_heartbeat = time.time()
+        self.child_watcher = None
+
+    @property
+    def idle_slots(self):
+        return [slot for slot in self.slots if slot.idle]
+
+    def run(self):
+        with ChildWatcher() as self.child_watcher:
+            self.write_state()
+            while True:
+                self.run_once()
+
+    def run_once(self):
+        self.result_procs = [proc for proc in self.result_procs
+                             if proc.poll() is None]
+        self.check_slots()
+
+        if need_restart():
+            # Don't take any new jobs; restart once the running ones are
+            # done.
+            if len(self.idle_slots) == len(self.slots):
+                if self.prefetcher:
+                    self.prefetcher.stop()
+                restart()
+            self.child_watcher.wait(self.poll_interval)
+            return
+
+        if not self.idle_slots:
+            self.child_watcher.wait(self.time_to_watchdog())
+            return
+
+        if len(self.idle_slots) == len(self.slots):
+            timeout = 60
+        else:
+            timeout = self.poll_interval
+        job = self.connection.reserve(timeout=timeout)
+        if job is not None:
+            self.start_job(job)
+
+    def start_job(self, job):
+        reserved_at = time.time()
+        job_config = yaml.safe_load(job.body)
+        if defer_job(job, job_config):
+            return
+        # bury the job so it won't be re-run if it fails
+        job.bury()
+        log.info('Reserved job %d', job.jid)
+        log.info('Config is: %s', job.body)
+        job_config, teuth_bin_path = prep_job(
+            job_config,
+            job.jid,
+            self.archive_dir,
+            self.log_file_path,
+            repo_cache=self.repo_cache,
+        )
+        if job_config is None:
+            return
 
         if job_config.get('last_in_suite'):
-            if teuth_config.results_server:
-                report.try_delete_jobs(job_config['name'],
-                                       job_config['job_id'])
-            log.info('Generating results email for %s', job_config['name'])
-            args = [
-                os.path.join(teuth_bin_path, 'teuthology-results'),
-                '--timeout',
-                str(job_config.get('results_timeout', 32400)),
-                '--email',
-                job_config['email'],
-                '--archive-dir',
-                os.path.join(ctx.archive_dir, safe_archive),
-                '--name',
-                job_config['name'],
-            ]
-            # Execute teuthology-results, passing 'preexec_fn=os.setpgrp' to
-            # make sure that it will continue to run if this worker process
-            # dies (e.g. because of a restart)
-            result_proc = subprocess.Popen(args=args, preexec_fn=os.setpgrp)
-            log.info("teuthology-results PID: %s", result_proc.pid)
+            self.result_procs.append(
+                run_results(job_config, teuth_bin_path, self.archive_dir))
+            job.delete()
+            return
+
+        record_reserve_to_start(job_config, reserved_at)
+        slot = self.idle_slots[0]
+        log.info('Running job %d in slot %d', job.jid, slot.index)
+        slot.job = job
+        slot.job_config = job_config
+        slot.started = datetime.utcnow()
+        slot.process, slot.job_file = start_job(job_config, teuth_bin_path)
+        self.write_state()
+
+    def check_slots(self):
+        for slot in self.slots:
+            if slot.idle:
+                continue
+            if not slot.log_linked and \
+                    os.path.isdir(slot.job_config['archive_path']):
+                symlink_worker_log(self.log_file_path,
+                                   slot.job_config['archive_path'])
+                slot.log_linked = True
+            if slot.process.poll() is not None:
+                self.finish_job(slot)
+        if self.time_to_watchdog() <= 0:
+            self.watchdog()
+
+    def time_to_watchdog(self):
+        """
+        :returns: How many seconds until watchdog() is next due
+        """
+        return self.last_heartbeat + teuth_config.watchdog_interval - \
+            time.time()
+
+    def watchdog(self):
+        """
+        Kill jobs that have run for longer than config.max_job_time, and tell
+        the results server, all at once, that the others are still running.
+        """
+        heartbeats = list()
+        for slot in self.slots:
+            if slot.idle:
+                continue
+            job_config = slot.job_config
+            if job_timed_out(slot.started):
+                log.warning("Job ran longer than {max}s. Killing...".format(
+                    max=teuth_config.max_job_time))
+                kill_job(job_config['name'], job_config['job_id'],
+                         teuth_config.archive_base)
+            heartbeats.append(dict(name=job_config['name'],
+                                   job_id=job_config['job_id']))
+        if teuth_config.results_server:
+            report.try_push_heartbeats(heartbeats)
+        self.last_heartbeat = time.time()
+
+    def finish_job(self, slot):
+        process = slot.process
+        if process.returncode != 0:
+            log.error('Child exited with code %d (job %s, slot %d)',
+                      process.returncode, slot.job_config['job_id'],
+                      slot.index)
         else:
-            log.info('Creating archive dir %s', archive_path_full)
-            safepath.makedirs(ctx.archive_dir, safe_archive)
-            log.info('Running job %d', job.jid)
-            run_job(job_config, teuth_bin_path)
-        job.delete()
+            log.info('Success! (job %s, slot %d)',
+                     slot.job_config['job_id'], slot.index)
+        slot.job_file.close()
+        if teuth_config.results_server:
+            report_job_done(slot.job_config)
+        slot.job.delete()
+        slot.clear()
+        self.write_state()
+
+    def write_state(self):
+        states = [slot.to_dict() for slot in self.slots]
+        log.info('Slots: %s', ', '.join(
+            ['{slot}:{state}'.format(**state) for state in states]))
+        try:
+            with file(self.state_file_path, 'w') as state_file:
+                yaml.safe_dump(states, state_file, default_flow_style=False)
+        except IOError:
+            log.exception("Failed to write slot state")
+
+
+class ChildWatcher(object):
+    """
+    Wake up as soon as a child process exits, rather than at the next poll.
+
+    While installed, SIGCHLD makes the interpreter write to a pipe - both
+    through signal.set_wakeup_fd() and from the handler itself - and wait()
+    select()s on the pipe's other end. Use it as a context manager; the
+    previous handler is restored on exit.
+    """
+    def __init__(self):
+        self.read_fd = self.write_fd = None
+        self.old_handler = None
+        self.old_wakeup_fd = None
+
+    def __enter__(self):
+        self.read_fd, self.write_fd = os.pipe()
+        for fd in (self.read_fd, self.write_fd):
+            flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+            fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+            # Keep jobs, and the worker after restart(), from inheriting it
+            flags = fcntl.fcntl(fd, fcntl.F_GETFD)
+            fcntl.fcntl(fd, fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
+        self.old_handler = signal.signal(signal.SIGCHLD, self.handle_sigchld)
+        # Don't interrupt e.g. socket reads on the queue connection
+        signal.siginterrupt(signal.SIGCHLD, False)
+        try:
+            self.old_wakeup_fd = signal.set_wakeup_fd(self.write_fd)
+        except ValueError:
+            # Not the main thread; the handler will have to do
+            self.old_wakeup_fd = None
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.old_wakeup_fd is not None:
+            signal.set_wakeup_fd(self.old_wakeup_fd)
+        signal.signal(signal.SIGCHLD, self.old_handler or signal.SIG_DFL)
+        os.close(self.read_fd)
+        os.close(self.write_fd)
+        self.read_fd = self.write_fd = None
+
+    def handle_sigchld(self, signum, frame):
+        try:
+            os.write(self.write_fd, '\0')
+        except (OSError, TypeError):
+            # The pipe is full, so a wakeup is already pending; or we're
+            # being uninstalled
+            pass
+
+    def wait(self, timeout):
+        """
+        Wait until a child process exits, or timeout seconds pass.
+
+        :returns: True if a child may have exited
+        """
+        try:
+            readable = select.select([self.read_fd], [], [],
+                                     max(timeout, 0))[0]
+        except select.error as exc:
+            if exc.args[0] == errno.EINTR:
+                return True
+            raise
+        if not readable:
+            return False
+        try:
+            while os.read(self.read_fd, 4096):
+                pass
+        except OSError as exc:
+            if exc.errno != errno.EAGAIN:
+                raise
+        return True
+
+
+def job_timed_out(started):
+    """
+    :param started: When the job started, as a UTC datetime
+    :returns:       True if the job has been running longer than
+                    config.max_job_time
+    """
+    run_time = datetime.utcnow() - started
+    total_seconds = run_time.days * 60 * 60 * 24 + run_time.seconds
+    return total_seconds > teuth_config.max_job_time
 
 
 def run_with_watchdog(process, job_config):
@@ -176,23 +678,47 @@ def run_with_watchdog(process, job_config):
         job_id=job_config['job_id'],
     )
 
-    # Sleep once outside of the loop to avoid double-posting jobs
-    time.sleep(teuth_config.watchdog_interval)
-    symlink_worker_log(job_config['worker_log'], job_config['archive_path'])
-    while process.poll() is None:
-        # Kill jobs that have been running longer than the global max
-        run_time = datetime.utcnow() - job_start_time
-        total_seconds = run_time.days * 60 * 60 * 24 + run_time.seconds
-        if total_seconds > teuth_config.max_job_time:
-            log.warning("Job ran longer than {max}s. Killing...".format(
-                max=teuth_config.max_job_time))
-            kill_job(job_info['name'], job_info['job_id'],
-                     teuth_config.archive_base)
-
-        report.try_push_job_info(job_info, dict(status='running'))
-        time.sleep(teuth_config.watchdog_interval)
+    # The job reports itself as running when it starts, so the first
+    # heartbeat isn't due for a while
+    last_heartbeat = time.time()
+    log_linked = False
+    with ChildWatcher() as watcher:
+        while process.poll() is None:
+            if not log_linked and os.path.isdir(job_config['archive_path']):
+                symlink_worker_log(job_config['worker_log'],
+                                   job_config['archive_path'])
+                log_linked = True
+
+            # Kill jobs that have been running longer than the global max
+            if job_timed_out(job_start_time):
+                log.warning("Job ran longer than {max}s. Killing...".format(
+                    max=teuth_config.max_job_time))
+                kill_job(job_info['name'], job_info['job_id'],
+                         teuth_config.archive_base)
+
+            if time.time() - last_heartbeat >= teuth_config.watchdog_interval:
+                report.try_push_heartbeats([job_info])
+                last_heartbeat = time.time()
+
+            timeout = last_heartbeat + teuth_config.watchdog_interval - \
+                time.time()
+            if not log_linked:
+                timeout = min(timeout, WorkerSupervisor.poll_interval)
+            watcher.wait(timeout)
 
     # The job finished. Let's make sure paddles knows.
+    report_job_done(job_config)
+
+
+def report_job_done(job_config):
+    """
+    Once a job's process has exited, make sure paddles knows the job is
+    finished.
+    """
+    job_info = dict(
+        name=job_config['name'],
+        job_id=job_config['job_id'],
+    )
     branches_sans_reporting = ('argonaut', 'bobtail', 'cuttlefish', 'dumpling')
     if job_config.get('teuthology_branch') in branches_sans_reporting:
         # The job ran with a teuthology branch that may not have the reporting
@@ -222,6 +748,37 @@ def run_with_watchdog(process, job_config):
 
 
 def run_job(job_config, teuth_bin_path):
+    p, job_file = start_job(job_config, teuth_bin_path)
+    with job_file:
+        if teuth_config.results_server:
+            log.info("Running with watchdog")
+            try:
+                run_with_watchdog(p, job_config)
+            except Exception:
+                log.exception("run_with_watchdog had an unhandled exception")
+                raise
+        else:
+            log.info("Running without watchdog")
+            # This sleep() is to give the child time to start up and create the
+            # archive dir.
+            time.sleep(5)
+            symlink_worker_log(job_config['worker_log'],
+                               job_config['archive_path'])
+            p.wait()
+
+        if p.returncode != 0:
+            log.error('Child exited with code %d', p.returncode)
+        else:
+            log.info('Success!')
+
+
+def start_job(job_config, teuth_bin_path):
+    """
+    Start the teuthology process for a job.
+
+    :returns: A tuple: (process, job_file). job_file is the temporary file
+              holding the job's config; close it once the process exits.
+    """
     suite_path = job_config['suite_path']
     arg = [
         os.path.join(teuth_bin_path, 'teuthology'),
@@ -251,39 +808,20 @@ def run_job(job_config, teuth_bin_path):
         arg.extend(['--description', job_config['description']])
     arg.append('--')
 
-    with tempfile.NamedTemporaryFile(prefix='teuthology-worker.',
-                                     suffix='.tmp',) as tmp:
-        yaml.safe_dump(data=job_config, stream=tmp)
-        tmp.flush()
-        arg.append(tmp.name)
-        env = os.environ.copy()
-        python_path = env.get('PYTHONPATH', '')
-        python_path = ':'.join([suite_path, python_path]).strip(':')
-        env['PYTHONPATH'] = python_path
-        p = subprocess.Popen(args=arg, env=env)
-        log.info("Job archive: %s", job_config['archive_path'])
-        log.info("Job PID: %s", str(p.pid))
-
-        if teuth_config.results_server:
-            log.info("Running with watchdog")
-            try:
-                run_with_watchdog(p, job_config)
-            except Exception:
-                log.exception("run_with_watchdog had an unhandled exception")
-                raise
-        else:
-            log.info("Running without watchdog")
-            # This sleep() is to give the child time to start up and create the
-            # archive dir.
-            time.sleep(5)
-            symlink_worker_log(job_config['worker_log'],
-                               job_config['archive_path'])
-            p.wait()
-
-        if p.returncode != 0:
-            log.error('Child exited with code %d', p.returncode)
-        else:
-            log.info('Success!')
+    phases.mark(job_config, 'spawned')
+    tmp = tempfile.NamedTemporaryFile(prefix='teuthology-worker.',
+                                      suffix='.tmp',)
+    yaml.safe_dump(data=job_config, stream=tmp)
+    tmp.flush()
+    arg.append(tmp.name)
+    env = os.environ.copy()
+    python_path = env.get('PYTHONPATH', '')
+    python_path = ':'.join([suite_path, python_path]).strip(':')
+    env['PYTHONPATH'] = python_path
+    p = subprocess.Popen(args=arg, env=env)
+    log.info("Job archive: %s", job_config['archive_path'])
+    log.info("Job PID: %s", str(p.pid))
+    return p, tmp
 
 
 def symlink_worker_log(worker_log_path, archive_dir):